@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import sys
+
+from hamjab import benchmark, lib, macros, web
+from hamjab.benchmark import compareToBaseline, loadBaseline, saveBaseline, startClients, Benchmark
+
+from twisted.internet import reactor
+
+parser = argparse.ArgumentParser(description='Benchmark the web -> device server -> device client -> device path with simulated devices')
+subparsers = parser.add_subparsers(dest='mode')
+
+run_parser = subparsers.add_parser('run', help='Run the benchmark')
+run_parser.add_argument('--devices',
+                        help='How many simulated devices to register',
+                        default=4,
+                        type=int)
+run_parser.add_argument('--clients',
+                        help='How many device clients to spread the devices over',
+                        default=2,
+                        type=int)
+run_parser.add_argument('--processes',
+                        help='Run every device client in its own process instead of in the benchmark process',
+                        action='store_true')
+run_parser.add_argument('--latency',
+                        help='How long (in seconds) a simulated device takes to answer a command',
+                        default=0.005,
+                        type=float)
+run_parser.add_argument('--jitter',
+                        help='Up to how much longer (in seconds) a simulated device takes to answer, picked at random for every command',
+                        default=0,
+                        type=float)
+run_parser.add_argument('--concurrency',
+                        help='How many HTTP requests to keep in flight',
+                        default=16,
+                        type=int)
+run_parser.add_argument('--requests',
+                        help='How many HTTP requests to send in total',
+                        default=2000,
+                        type=int)
+run_parser.add_argument('--macroShare',
+                        help='The fraction of requests which run a macro sending a command to every device instead of a single sendCommand',
+                        default=0.1,
+                        type=float)
+run_parser.add_argument('--baseline',
+                        help='A json file of results from an earlier run to compare against, regressions make the exit code 1')
+run_parser.add_argument('--tolerance',
+                        help='How much worse (as a fraction) than the baseline a metric can be before it counts as a regression',
+                        default=0.2,
+                        type=float)
+run_parser.add_argument('--save',
+                        help='Save the results as a json file to use as a baseline later')
+run_parser.add_argument('--verbose',
+                        help='Print the server and client logs instead of dropping them',
+                        action='store_true')
+
+client_parser = subparsers.add_parser('client', help='Run a device client with simulated devices (used by run --processes)')
+client_parser.add_argument('deviceIds',
+                           help='The ids of the simulated devices',
+                           nargs='+')
+client_parser.add_argument('--port',
+                           help='The port of the device server',
+                           required=True,
+                           type=int)
+client_parser.add_argument('--latency',
+                           default=0.005,
+                           type=float)
+client_parser.add_argument('--jitter',
+                           default=0,
+                           type=float)
+
+args = parser.parse_args()
+
+if args.mode == 'client':
+    benchmark.quietLogs(lib)
+    startClients('127.0.0.1', args.port, args.deviceIds, args.latency, args.jitter)
+    reactor.run()
+    sys.exit()
+
+if not args.verbose:
+    benchmark.quietLogs(lib, macros, web)
+
+clientScript = os.path.realpath(__file__) if args.processes else None
+harness = Benchmark(args.devices, args.clients, args.latency, args.jitter, args.concurrency, args.requests, args.macroShare, clientScript)
+
+outcome = {}
+
+def finished(results):
+    outcome['results'] = results
+    reactor.stop()
+
+def failed(failure):
+    outcome['failure'] = failure
+    reactor.stop()
+
+reactor.callWhenRunning(lambda: harness.run().addCallbacks(finished, failed))
+reactor.run()
+
+if 'failure' in outcome:
+    print "Benchmark failed:", outcome['failure'].getErrorMessage()
+    sys.exit(2)
+
+results = outcome['results']
+print json.dumps(results, indent=4, sort_keys=True)
+
+if args.save:
+    saveBaseline(args.save, results)
+    print "Saved the results to", args.save
+
+if args.baseline:
+    regressions = compareToBaseline(results, loadBaseline(args.baseline), args.tolerance)
+    for regression in regressions:
+        print "Regression:", regression
+    if regressions:
+        sys.exit(1)
+    print "No regressions against", args.baseline
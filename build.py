@@ -4,6 +4,8 @@ import os
 import shutil
 import sys
 
+from hamjab.assets import compressAssets
+
 root = os.path.dirname(os.path.realpath(__file__))
 
 def usage():
@@ -58,11 +60,18 @@ if build_type == 'server':
     server_files = [
         'server.py',
         'hamjab/lib.py',
+        'hamjab/macros.py',
         'hamjab/web.py',
+        'hamjab/assets.py',
+        'hamjab/devices',
         'hamjab/resources',
     ]
 
     make_build(server_files)
+    
+    # the server serves these instead of compressing the static files itself when it starts
+    for compressed_file in compressAssets(os.path.join(out_path, 'hamjab', 'resources')):
+        print 'Compressed', os.path.relpath(compressed_file, out_path)
 elif build_type == 'client':
     print 'Building device client...'
 
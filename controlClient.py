@@ -1,3 +1,4 @@
+import json
 import urllib, urllib2
 
 class ControlClient(object):
@@ -14,6 +15,14 @@ class ControlClient(object):
         data = { 'fromClient': 'pythonControlClient', 'deviceId': deviceId, 'command': command }
         return self._request_url(url, data)
 
+    def sendCommands(self, commands):
+        """
+        commands: a list of (deviceId, command) pairs. Returns the list of results in the same order.
+        """
+        data = json.dumps([{'device': deviceId, 'command': command} for deviceId, command in commands])
+        page = urllib2.urlopen(self.url_root + "batch", data=data)
+        return json.loads(page.read())
+
     def sendMacro(self, macroName):
         url = "macro"
         return self._request_url(url, { 'macroName': macroName })
@@ -8,9 +8,11 @@ def eventCallback(deviceServer, deviceId, event):
         The following commands are available on the deviceServer instance:
             deviceServer.runMacro('myMacro')
             deviceServer.sendCommand('deviceId', 'myCommand')
+            deviceServer.getDeviceState('deviceId')
         
-        Both of the above commands return a Twisted Deferred object which you can
-        use to watch for the result if you want. You can also 
+        The first two commands return a Twisted Deferred object which you can
+        use to watch for the result if you want. getDeviceState returns a dict
+        with the last known state of the device (or None if it's not connected).
     """
     #print ("{deviceId} event: {event}".format(deviceId=deviceId, event=event))
     pass
@@ -26,6 +28,7 @@ def commandCallback(deviceServer, deviceId, command, response):
         The following commands are available on the deviceServer instance:
             deviceServer.runMacro('myMacro')
             deviceServer.sendCommand('deviceId', 'myCommand')
+            deviceServer.getDeviceState('deviceId')
     """
     #print ("{deviceId} command: {command} -> {response}".format(deviceId=deviceId, command=command, response=response))
     pass
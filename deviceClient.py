@@ -1,35 +1,90 @@
 import os
 import argparse
+import json
 import pkgutil
 
 from twisted.internet import reactor
-from hamjab.lib import DeviceClientFactory, DEFAULT_DEVICE_SERVER_PORT
+from hamjab.lib import DeviceClientFactory, DeviceClientProtocol, LineDeviceClientProtocol, DEFAULT_DEVICE_SERVER_PORT
 
-excluded_packages = ['test', 'device_lib']
+excluded_packages = ['test', 'device_lib', 'sim']
 device_list = [y for x,y,z in pkgutil.iter_modules([os.path.join('hamjab', 'devices')]) if y not in excluded_packages]
 
+def parse_config_file(parser, config_file_name):
+    """
+    Reads a json file of the form {"devices": [{"deviceType": ..., "deviceConnectionString": ...}, ...]} and returns
+    a list of (deviceType, deviceConnectionString) pairs.
+    """
+    try:
+        with open(config_file_name) as config_file:
+            config = json.load(config_file)
+        devices = [(x['deviceType'], x['deviceConnectionString']) for x in config['devices']]
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        parser.error("Invalid config file {name}: {error}".format(name=config_file_name, error=e))
+    
+    for deviceType, connectionString in devices:
+        if deviceType not in device_list:
+            parser.error("Unknown deviceType {deviceType} in {name}".format(deviceType=deviceType, name=config_file_name))
+    
+    return devices
+
 parser = argparse.ArgumentParser(description='Run a device client')
 parser.add_argument('deviceServerHost',
                     help='The IP or hostname of the device server')
 parser.add_argument('deviceType',
                     help='The id of the device that this client should talk to',
-                    choices=device_list)
+                    choices=device_list,
+                    nargs='?')
 parser.add_argument('deviceConnectionString',
-                    help='The connection string used to connect to the device. For a Serial device this the name of the COM port (ie. COM3 or /dev/ttyS0). For an ethernet device this is the ip/host (and port if it is not the device default).')
+                    help='The connection string used to connect to the device. For a Serial device this the name of the COM port (ie. COM3 or /dev/ttyS0). For an ethernet device this is the ip/host (and port if it is not the device default).',
+                    nargs='?')
+parser.add_argument('--config',
+                    help='A json file listing several devices to run in this client instead of deviceType and deviceConnectionString, they all share one connection to the device server',
+                    type=lambda x: parse_config_file(parser, x))
 parser.add_argument('--deviceServerPort',
                     help='The port of the device server',
                     default=DEFAULT_DEVICE_SERVER_PORT,
                     type=int)
+parser.add_argument('--heartbeatInterval',
+                    help='How often (in seconds) to send heartbeats to the device server',
+                    default=DeviceClientProtocol.heartbeatInterval,
+                    type=float)
+parser.add_argument('--heartbeatMisses',
+                    help='How many heartbeat intervals the device server can be silent for before reconnecting',
+                    default=DeviceClientProtocol.heartbeatMisses,
+                    type=int)
+parser.add_argument('--lineProtocol',
+                    help='Use the old line based protocol, only needed for device servers which don\'t support the framed one',
+                    action='store_true')
 args = parser.parse_args()
 
-try:
-    device = __import__('hamjab.devices.' + args.deviceType, globals(), locals(), ['Device']).Device
-except (ImportError, AttributeError) as e:
-    print e
-    parser.error("Unable to load deviceType {}".format(args.deviceType))
+if args.config:
+    devices = args.config
+elif args.deviceType and args.deviceConnectionString:
+    devices = [(args.deviceType, args.deviceConnectionString)]
+else:
+    parser.error("Either a deviceType and deviceConnectionString or a --config file is required")
+
+if args.lineProtocol and len(devices) > 1:
+    parser.error("The line protocol only supports one device per client")
+
+deviceProtocols = []
+for deviceType, connectionString in devices:
+    try:
+        device = __import__('hamjab.devices.' + deviceType, globals(), locals(), ['Device']).Device
+    except (ImportError, AttributeError) as e:
+        print e
+        parser.error("Unable to load deviceType {}".format(deviceType))
+    
+    deviceProtocol = device(connectionString)
+    deviceProtocol.startConnection()
+    deviceProtocols.append(deviceProtocol)
+
+DeviceClientProtocol.heartbeatInterval = args.heartbeatInterval
+DeviceClientProtocol.heartbeatMisses = args.heartbeatMisses
 
-deviceProtocol = device(args.deviceConnectionString)
-deviceProtocol.startConnection()
+factory = DeviceClientFactory(*deviceProtocols)
+if args.lineProtocol:
+    factory.protocol = LineDeviceClientProtocol
 
-reactor.connectTCP(args.deviceServerHost, args.deviceServerPort, DeviceClientFactory(deviceProtocol))
+reactor.connectTCP(args.deviceServerHost, args.deviceServerPort, factory)
 reactor.run()
\ No newline at end of file
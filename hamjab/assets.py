@@ -0,0 +1,215 @@
+import gzip, hashlib, os, re
+
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# only text compresses well enough to be worth it, images and fonts are already compressed
+COMPRESSIBLE = frozenset(['.css', '.html', '.js', '.json', '.svg', '.txt'])
+
+# the suffix of the precompressed file for each content encoding, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# local src/href URLs in a page, anything with a scheme, a query or a fragment is left alone
+URL_PATTERN = re.compile(r'''\b(src|href)=(["'])([^"'?#:]+)\2''')
+
+def compress(data, encoding):
+    """
+    Returns the data compressed with the content encoding (br or gzip), or None if that encoding isn't available.
+    """
+    if encoding == 'gzip':
+        buffer = BytesIO()
+        # a fixed mtime so the same file always compresses to the same bytes
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as gzipFile:
+            gzipFile.write(data)
+        return buffer.getvalue()
+
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data)
+
+    return None
+
+def acceptedEncodings(header):
+    """
+    Returns the set of content encodings from an Accept-Encoding header, leaving out any with a q of 0.
+    """
+    result = set()
+    for value in (header or '').split(','):
+        parts = [x.strip() for x in value.split(';')]
+        quality = 1.0
+        for param in parts[1:]:
+            name, ignored, number = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0
+        if parts[0] and quality > 0:
+            result.add(parts[0].lower())
+    return result
+
+def compressAssets(root):
+    """
+    Writes a precompressed copy (.gz and, if the brotli module is installed, .br) next to every compressible file
+    under root which is smaller for it. Returns the paths which were written.
+    """
+    written = []
+    for directory, dirNames, fileNames in os.walk(root):
+        for fileName in fileNames:
+            path = os.path.join(directory, fileName)
+            if os.path.splitext(fileName)[1] not in COMPRESSIBLE:
+                continue
+
+            with open(path, 'rb') as assetFile:
+                data = assetFile.read()
+
+            for encoding, suffix in ENCODINGS:
+                compressed = compress(data, encoding)
+                if compressed is not None and len(compressed) < len(data):
+                    with open(path + suffix, 'wb') as compressedFile:
+                        compressedFile.write(compressed)
+                    written.append(path + suffix)
+    return written
+
+class Asset(object):
+    """
+    A static file held in memory: its contents, a short hash of them (used as the version in URLs and for the ETag)
+    and its compressed variants by content encoding.
+    """
+
+    def __init__(self, path, mtime, size, data, variants):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.data = data
+        self.version = hashlib.md5(data).hexdigest()[:12]
+        self.variants = variants
+
+    def etag(self, encoding=None):
+        # each encoding is a different entity so it gets its own tag
+        return '"{version}{suffix}"'.format(version=self.version, suffix='-' + encoding if encoding else '')
+
+    def negotiate(self, acceptEncoding):
+        """
+        Returns (data, encoding) for the client's Accept-Encoding header, encoding is None for the uncompressed data.
+        """
+        accepted = acceptedEncodings(acceptEncoding)
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and encoding in self.variants:
+                return self.variants[encoding], encoding
+        return self.data, None
+
+class AssetIndex(object):
+    """
+    The static files under root, loaded into memory (and compressed) the first time they're needed or all at once by
+    L{load}. Precompressed .gz/.br files (see L{compressAssets}) are used instead of compressing at runtime when they're
+    at least as new as the file.
+
+    A file which changes on disk is reloaded the next time it's served, but the versioned URLs in pages which were
+    already built from it only change once they're built again (or the server restarts).
+
+    HTML pages have the local src/href URLs in them versioned with the hash of the file they point to, relative URLs
+    are resolved from the page's directory and absolute ones from root, which matches how the server lays them out.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._assets = {}
+
+    def load(self):
+        """
+        Loads every file under root, returns how many were loaded.
+        """
+        count = 0
+        for directory, dirNames, fileNames in os.walk(self.root):
+            for fileName in fileNames:
+                if not fileName.endswith(tuple(suffix for encoding, suffix in ENCODINGS)) and self.get(os.path.join(directory, fileName)):
+                    count += 1
+        return count
+
+    def get(self, path):
+        """
+        Returns the L{Asset} for the path (reloading it if it changed on disk) or None if it isn't a readable file.
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._assets.pop(path, None)
+            return None
+
+        asset = self._assets.get(path)
+        if asset is None or asset.mtime != stat.st_mtime or asset.size != stat.st_size:
+            asset = self._load(path, stat)
+            if asset is None:
+                self._assets.pop(path, None)
+            else:
+                self._assets[path] = asset
+        return asset
+
+    def version(self, path):
+        """
+        Returns the version of the file from memory (loading it the first time) or None if it isn't a file.
+        """
+        path = os.path.abspath(path)
+        asset = self._assets.get(path) or self.get(path)
+        return asset.version if asset is not None else None
+
+    def versionUrls(self, html, directory):
+        """
+        Adds ?v=<version> to every src/href in the html which points to a file under root. Links to other pages aren't
+        versioned, pages are always revalidated.
+        """
+        def versioned(match):
+            url = match.group(3)
+            if os.path.splitext(url)[1] == '.html':
+                return match.group(0)
+            if url.startswith('/'):
+                path = os.path.join(self.root, url.lstrip('/'))
+            else:
+                path = os.path.join(directory, url)
+
+            path = os.path.normpath(path)
+            version = self.version(path) if path.startswith(self.root + os.sep) else None
+            if version is None:
+                return match.group(0)
+            return '{attr}={quote}{url}?v={version}{quote}'.format(attr=match.group(1), quote=match.group(2), url=url, version=version)
+
+        return URL_PATTERN.sub(versioned, html)
+
+    def _load(self, path, stat):
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            with open(path, 'rb') as assetFile:
+                data = assetFile.read()
+        except IOError:
+            return None
+
+        extension = os.path.splitext(path)[1]
+        if extension == '.html':
+            data = self.versionUrls(data, os.path.dirname(path))
+
+        variants = {}
+        if extension in COMPRESSIBLE:
+            for encoding, suffix in ENCODINGS:
+                compressed = None if extension == '.html' else self._readPrecompressed(path + suffix, stat.st_mtime)
+                if compressed is None:
+                    compressed = compress(data, encoding)
+                if compressed is not None and len(compressed) < len(data):
+                    variants[encoding] = compressed
+
+        return Asset(path, stat.st_mtime, stat.st_size, data, variants)
+
+    def _readPrecompressed(self, path, mtime):
+        try:
+            if os.stat(path).st_mtime < mtime:
+                return None
+            with open(path, 'rb') as compressedFile:
+                return compressedFile.read()
+        except (IOError, OSError):
+            return None
@@ -0,0 +1,278 @@
+import inspect, json, math, os, random, resource, sys, time
+
+from hamjab.lib import printToConsole, DeviceClientFactory, DeviceServerFactory, QueuedLineSender
+from hamjab.macros import compileMacros
+from hamjab.web import CommandServer
+
+from twisted.internet import reactor, protocol
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.logger import Logger
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.server import Site
+
+BENCHMARK_MACRO = 'benchmark'
+
+def percentile(values, percent):
+    """
+    Returns the nearest-rank percentile of the values, or None if there aren't any.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+def summarize(latencies, errors):
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+    }
+
+# (path into the results, True if a bigger value is better)
+BASELINE_METRICS = [
+    (('throughput', ), True),
+    (('sendCommand', 'p50'), False),
+    (('sendCommand', 'p99'), False),
+    (('macro', 'p50'), False),
+    (('macro', 'p99'), False),
+    (('maxRssMb', ), False),
+]
+
+def compareToBaseline(results, baseline, tolerance=0.2):
+    """
+    Returns a list of messages for every metric which is more than tolerance (a fraction) worse than in the baseline,
+    an empty list means no regressions. Metrics missing from either side are skipped.
+    """
+    regressions = []
+
+    for path, biggerIsBetter in BASELINE_METRICS:
+        current, previous = results, baseline
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            previous = previous.get(key) if isinstance(previous, dict) else None
+
+        if current is None or not previous:
+            continue
+
+        if biggerIsBetter:
+            regressed = current < previous * (1 - tolerance)
+        else:
+            regressed = current > previous * (1 + tolerance)
+
+        if regressed:
+            regressions.append("{metric} regressed from {previous:.4g} to {current:.4g}".format(metric='.'.join(path), previous=previous, current=current))
+
+    return regressions
+
+def loadBaseline(path):
+    with open(path) as baselineFile:
+        return json.load(baselineFile)
+
+def saveBaseline(path, results):
+    with open(path, 'w') as baselineFile:
+        json.dump(results, baselineFile, indent=4, sort_keys=True)
+
+def quietLogs(*modules):
+    """
+    Drops the log events of every class in the modules, a benchmark which prints a line per command mostly measures
+    the console.
+    """
+    for module in modules:
+        for value in vars(module).values():
+            log = vars(value).get('log') if inspect.isclass(value) else None
+            if isinstance(log, Logger):
+                log.observer = lambda event: None
+
+class LoopbackTransport(object):
+    """
+    Stands in for the serial port or socket of a L{SimulatedDevice}: every line written to it is answered after the
+    device's latency plus up to its jitter.
+    """
+
+    disconnecting = False
+
+    def __init__(self, device):
+        self.device = device
+        self._buffer = ''
+
+    def write(self, data):
+        self._buffer += data
+        while self.device.sendDelimiter in self._buffer:
+            line, self._buffer = self._buffer.split(self.device.sendDelimiter, 1)
+            delay = self.device.latency + random.uniform(0, self.device.jitter)
+            reactor.callLater(delay, self.device.dataReceived, self.device.respond(line) + self.device.delimiter)
+
+    def loseConnection(self):
+        pass
+
+class SimulatedDevice(QueuedLineSender):
+    """
+    A device for the device client which answers every command with OK after a configurable latency, so the client's
+    queue is exercised just like it is with real hardware.
+    """
+
+    def __init__(self, deviceId, latency=0.005, jitter=0):
+        QueuedLineSender.__init__(self)
+        self.deviceId = deviceId
+        self.latency = latency
+        self.jitter = jitter
+
+    def startConnection(self):
+        self.makeConnection(LoopbackTransport(self))
+
+    def respond(self, line):
+        return 'OK'
+
+def startClients(host, port, deviceIds, latency, jitter):
+    """
+    Connects a device client for the devices to the device server, returns its connector.
+    """
+    devices = []
+    for deviceId in deviceIds:
+        device = SimulatedDevice(deviceId, latency, jitter)
+        device.startConnection()
+        devices.append(device)
+
+    factory = DeviceClientFactory(*devices)
+    return reactor.connectTCP(host, port, factory)
+
+class ClientProcess(protocol.ProcessProtocol):
+
+    def __init__(self):
+        self.ended = Deferred()
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+class Benchmark(object):
+    """
+    Runs a L{DeviceServerFactory} and a L{CommandServer} on local ports with device clients backed by
+    L{SimulatedDevice}s, then drives HTTP load at it: sendCommand requests spread over every device and a share of
+    requests for a macro which sends a command to every device in parallel.
+
+    The device clients run in this process unless a script is given to start them in their own processes with
+    (script client --port P --latency L --jitter J deviceId...).
+    """
+
+    log = Logger(observer=printToConsole)
+
+    def __init__(self, devices=4, clients=2, latency=0.005, jitter=0, concurrency=16, requests=2000, macroShare=0.1, clientScript=None):
+        self.deviceIds = ['sim_{index}'.format(index=x) for x in range(devices)]
+        self.clients = max(1, min(clients, devices))
+        self.latency = latency
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.requests = requests
+        self.macroShare = macroShare
+        self.clientScript = clientScript
+        self._latencies = {'sendCommand': [], 'macro': []}
+        self._errors = {'sendCommand': 0, 'macro': 0}
+        self._next = 0
+
+    @inlineCallbacks
+    def run(self):
+        """
+        Returns a deferred which fires with the results: throughput (requests per second), the count, errors and
+        p50/p99 latency (in seconds) of each kind of request and the peak memory use of this process.
+        """
+        factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+        factory.macros, warnings = compileMacros({BENCHMARK_MACRO: {'name': 'Benchmark', 'commands': [
+            {'parallel': [{'device': x, 'command': 'PING'} for x in self.deviceIds]},
+        ]}}, lambda deviceId: {})
+
+        devicePort = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        webPort = reactor.listenTCP(0, Site(CommandServer(factory)), interface='127.0.0.1')
+        stoppers = self._startClients(devicePort.getHost().port)
+
+        try:
+            yield self._waitForDevices(factory)
+
+            pool = HTTPConnectionPool(reactor)
+            pool.maxPersistentPerHost = self.concurrency
+            agent = Agent(reactor, pool=pool)
+            baseUrl = 'http://127.0.0.1:{port}/'.format(port=webPort.getHost().port)
+
+            started = time.time()
+            yield DeferredList([self._worker(agent, baseUrl) for x in range(self.concurrency)])
+            elapsed = time.time() - started
+
+            yield pool.closeCachedConnections()
+        finally:
+            for stop in stoppers:
+                yield stop()
+            yield devicePort.stopListening()
+            yield webPort.stopListening()
+
+        returnValue({
+            'requests': self.requests,
+            'elapsed': elapsed,
+            'throughput': self.requests / elapsed,
+            'sendCommand': summarize(self._latencies['sendCommand'], self._errors['sendCommand']),
+            'macro': summarize(self._latencies['macro'], self._errors['macro']),
+            'maxRssMb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        })
+
+    def _startClients(self, port):
+        stoppers = []
+
+        for index in range(self.clients):
+            deviceIds = self.deviceIds[index::self.clients]
+
+            if self.clientScript is None:
+                connector = startClients('127.0.0.1', port, deviceIds, self.latency, self.jitter)
+                stoppers.append(lambda connector=connector: self._stopConnector(connector))
+            else:
+                process = ClientProcess()
+                args = [sys.executable, self.clientScript, 'client', '--port', str(port), '--latency', str(self.latency), '--jitter', str(self.jitter)] + deviceIds
+                transport = reactor.spawnProcess(process, sys.executable, args, env=os.environ, path=os.path.dirname(os.path.realpath(self.clientScript)))
+                stoppers.append(lambda transport=transport, process=process: self._stopProcess(transport, process))
+
+        return stoppers
+
+    def _stopConnector(self, connector):
+        connector.factory.stopTrying()
+        connector.disconnect()
+        return deferLater(reactor, 0, lambda: None)
+
+    def _stopProcess(self, transport, process):
+        transport.signalProcess('TERM')
+        return process.ended
+
+    @inlineCallbacks
+    def _waitForDevices(self, factory, timeout=10):
+        waited = 0
+        while len(factory.devices) < len(self.deviceIds):
+            if waited >= timeout:
+                raise RuntimeError("Only {count} of {total} simulated devices registered".format(count=len(factory.devices), total=len(self.deviceIds)))
+            yield deferLater(reactor, 0.05, lambda: None)
+            waited += 0.05
+
+    @inlineCallbacks
+    def _worker(self, agent, baseUrl):
+        while self._next < self.requests:
+            index = self._next
+            self._next += 1
+
+            if random.random() < self.macroShare:
+                kind = 'macro'
+                url = baseUrl + 'macro?macroName=' + BENCHMARK_MACRO
+            else:
+                kind = 'sendCommand'
+                url = baseUrl + self.deviceIds[index % len(self.deviceIds)] + '/sendCommand?command=PING'
+
+            started = time.time()
+            try:
+                response = yield agent.request('POST', url)
+                yield readBody(response)
+                ok = response.code == 200
+            except Exception as e:
+                self.log.error("Request to {url} failed: {error}", url=url, error=e)
+                ok = False
+
+            if ok:
+                self._latencies[kind].append(time.time() - started)
+            else:
+                self._errors[kind] += 1
@@ -0,0 +1,30 @@
+import os
+import pkgutil
+
+excluded_modules = ('test', 'device_lib', 'sim')
+devices_path = os.path.dirname(os.path.realpath(__file__))
+
+def listDeviceModules():
+    return [name for loader, name, is_pkg in pkgutil.iter_modules([devices_path]) if name not in excluded_modules]
+
+def findStateReducers():
+    """
+    Imports every driver module and returns a dict of device id to the reduceState function of its Device class (the
+    first one wins if several drivers have the same id) and a dict of module name to the error for every module which
+    couldn't be imported.
+    """
+    reducers = {}
+    failures = {}
+    for name in listDeviceModules():
+        try:
+            module = __import__('hamjab.devices.' + name, globals(), locals(), ['Device'])
+        except ImportError as e:
+            failures[name] = e
+            continue
+        
+        device = getattr(module, 'Device', None)
+        deviceId = getattr(device, 'deviceId', None)
+        if deviceId is not None and deviceId not in reducers and hasattr(device, 'reduceState'):
+            reducers[deviceId] = device.reduceState
+    
+    return reducers, failures
@@ -1,8 +1,33 @@
 from hamjab.devices.device_lib import EthernetDevice
 
+# status replies start with the command they belong to, longest prefixes first so SLP isn't read as SI or SD
+STATE_PREFIXES = (
+    ('SLP', 'sleep'),
+    ('PW', 'power'),
+    ('ZM', 'mainZone'),
+    ('MV', 'masterVolume'),
+    ('MU', 'mute'),
+    ('SI', 'input'),
+    ('SD', 'inputMode'),
+    ('SV', 'videoSelect'),
+    ('MS', 'surroundMode'),
+)
+
+def reduce_state(state, line, command=None):
+    # MVMAX is the volume limit, not the volume
+    if line.startswith('MVMAX'):
+        return state
+    
+    for prefix, key in STATE_PREFIXES:
+        if line.startswith(prefix):
+            state[key] = line[len(prefix):]
+            break
+    return state
+
 class Device(EthernetDevice):
     """
     A device module for a Denon AVR-3312 over ethernet. Also tested on Denon AVR-X4000. Refer
     to the documentation for your particular receiver for differences in the commands.
     """
     deviceId = 'denon_avr_3312'
+    reduceState = staticmethod(reduce_state)
@@ -1,7 +1,9 @@
 from hamjab.devices.device_lib import SerialDevice
+from hamjab.devices.denon_avr_3312_ethernet import reduce_state
 
 class Device(SerialDevice):
     """
     An untested device for a Denon AVR-3312 (and related receivers probably)
     """
     deviceId = 'denon_avr_3312'
+    reduceState = staticmethod(reduce_state)
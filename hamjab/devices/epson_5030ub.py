@@ -15,3 +15,13 @@ class Device(SerialDevice):
         line = line.rstrip('\r')
         SerialDevice.lineReceived(self, line)
 
+    @staticmethod
+    def reduceState(state, line, command=None):
+        """
+        Query responses look like PWR=01, keep the latest value of each one.
+        """
+        if '=' in line:
+            key, value = line.split('=', 1)
+            state[key.strip()] = value.strip()
+        return state
+
@@ -1,4 +1,5 @@
 import os
+import re
 
 from hamjab.devices.device_lib import SerialDevice
 
@@ -13,3 +14,18 @@ class Device(SerialDevice):
     delimiter = '\r\n'
     deviceId = os.path.splitext(os.path.basename(__file__))[0]
 
+    sceneStatus = re.compile(r':?ss ([0-9A-GM]+)')
+
+    @staticmethod
+    def reduceState(state, line, command=None):
+        """
+        Scene status lines (:ss 1MMMMMMM) have one character per control unit, either its scene or M if it's missing.
+        The scene of the first control unit is also kept as the overall scene.
+        """
+        match = Device.sceneStatus.match(line)
+        if match:
+            scenes = match.group(1)
+            state['scenes'] = dict((str(i + 1), x) for i, x in enumerate(scenes) if x != 'M')
+            state['scene'] = scenes[0] if scenes[0] != 'M' else None
+        return state
+
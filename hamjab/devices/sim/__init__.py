@@ -0,0 +1,14 @@
+"""
+Emulators for the devices in L{hamjab.devices}, so the drivers, device clients and benchmarks can be run without the
+hardware. Run one with python -m hamjab.devices.sim.
+"""
+
+from hamjab.devices.sim import denon_avr_3312, epson_5030ub, lutron_grx_3000, sony_vpl_hw30es
+
+emulators = dict((x.Emulator.deviceId, x.Emulator) for x in (denon_avr_3312, epson_5030ub, lutron_grx_3000, sony_vpl_hw30es))
+
+def findEmulator(deviceId):
+    """
+    Returns the Emulator class for the device ID or None if there isn't one.
+    """
+    return emulators.get(deviceId)
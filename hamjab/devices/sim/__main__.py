@@ -0,0 +1,50 @@
+import argparse
+
+from hamjab.devices.sim import emulators
+from hamjab.devices.sim.emulator import serveTCP, servePty
+
+from twisted.internet import reactor
+
+parser = argparse.ArgumentParser(prog='python -m hamjab.devices.sim', description='Run an emulated device')
+parser.add_argument('deviceId',
+                    help='The id of the device to emulate',
+                    choices=sorted(emulators))
+parser.add_argument('--tcp',
+                    help='Listen on this TCP port (for ethernet drivers, or anything else which can use a socket)',
+                    type=int)
+parser.add_argument('--pty',
+                    help='Create a pseudo terminal and print its path, serial drivers can open it like a COM port',
+                    action='store_true')
+parser.add_argument('--interface',
+                    help='The interface the TCP port should be bound to',
+                    default='127.0.0.1')
+parser.add_argument('--latency',
+                    help='How long (in seconds) the device takes to answer',
+                    default=0,
+                    type=float)
+parser.add_argument('--jitter',
+                    help='Up to how much longer (in seconds) the device takes to answer, picked at random for every reply',
+                    default=0,
+                    type=float)
+parser.add_argument('--dropRate',
+                    help='The fraction of requests which never get a reply',
+                    default=0,
+                    type=float)
+parser.add_argument('--eventInterval',
+                    help='Send an unsolicited event this often (in seconds), as if the device was changed by hand',
+                    type=float)
+args = parser.parse_args()
+
+if (args.tcp is None) == (not args.pty):
+    parser.error("Exactly one of --tcp or --pty is required")
+
+emulator = emulators[args.deviceId]
+options = {'latency': args.latency, 'jitter': args.jitter, 'dropRate': args.dropRate, 'eventInterval': args.eventInterval}
+
+if args.pty:
+    print "Emulating", args.deviceId, "on", servePty(emulator, **options)
+else:
+    serveTCP(emulator, args.tcp, args.interface, **options)
+    print "Emulating", args.deviceId, "on port", args.tcp
+
+reactor.run()
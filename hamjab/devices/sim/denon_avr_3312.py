@@ -0,0 +1,64 @@
+from hamjab.devices.sim.emulator import DeviceEmulator
+
+class Emulator(DeviceEmulator):
+    """
+    Emulates the control protocol of a Denon AVR-3312 (over ethernet or RS232, they're the same). Commands and replies
+    end with \\r. A command is a two or three letter prefix and a parameter, a ? parameter asks for the current value
+    and every change is echoed back as the new value. Commands it doesn't know aren't answered. Events are the master
+    volume being turned by hand.
+    """
+    
+    deviceId = 'denon_avr_3312'
+    
+    # longest first so SLP isn't read as SI or SD
+    PREFIXES = ('SLP', 'PW', 'ZM', 'MV', 'MU', 'SI', 'SD', 'SV', 'MS')
+    MAX_VOLUME = 98
+    
+    def initialState(self):
+        return {'PW': 'STANDBY', 'ZM': 'OFF', 'MV': '50', 'MU': 'OFF', 'SI': 'DVD', 'SD': 'AUTO', 'SV': 'DVD', 'MS': 'STEREO', 'SLP': 'OFF'}
+    
+    def handle(self, request):
+        request = request.strip()
+        
+        for prefix in self.PREFIXES:
+            if request.startswith(prefix):
+                break
+        else:
+            return None
+        
+        parameter = request[len(prefix):]
+        
+        if parameter == '?':
+            return self._status(prefix)
+        
+        if prefix == 'MV':
+            if parameter in ('UP', 'DOWN'):
+                self._turnVolume(1 if parameter == 'UP' else -1)
+            elif parameter.isdigit():
+                self.state['MV'] = parameter
+            else:
+                return None
+        elif prefix == 'PW':
+            if parameter not in ('ON', 'STANDBY'):
+                return None
+            self.state['PW'] = parameter
+            self.state['ZM'] = 'ON' if parameter == 'ON' else 'OFF'
+            return self._status('PW') + self._status('ZM')
+        else:
+            self.state[prefix] = parameter
+        
+        return self._status(prefix)
+    
+    def event(self):
+        self._turnVolume(self.random.choice((-1, 1)))
+        return self._status('MV')
+    
+    def _turnVolume(self, step):
+        volume = int(self.state['MV'][:2]) + step
+        self.state['MV'] = '{volume:02d}'.format(volume=max(0, min(self.MAX_VOLUME, volume)))
+    
+    def _status(self, prefix):
+        status = prefix + self.state[prefix] + '\r'
+        if prefix == 'MV':
+            status += 'MVMAX {volume}\r'.format(volume=self.MAX_VOLUME)
+        return status
@@ -0,0 +1,139 @@
+import os, random, termios, tty
+
+from twisted.internet import protocol, reactor
+from twisted.internet.stdio import StandardIO
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from hamjab.lib import printToConsole
+
+class DeviceEmulator(protocol.Protocol):
+    """
+    The device end of a serial or network link: it splits what the driver writes into requests, keeps the device's
+    state and answers like the real device would.
+    
+    Every reply is delayed by L{latency} plus a random amount up to L{jitter} seconds and a fraction L{dropRate} of the
+    requests are never answered at all. If L{eventInterval} is set an unsolicited line from L{event} is sent that often.
+    
+    Subclasses set L{inputDelimiter} (what ends a request) and implement L{handle}, or override L{split} for a protocol
+    which isn't delimited.
+    """
+    
+    inputDelimiter = '\r'
+    latency = 0
+    jitter = 0
+    dropRate = 0
+    eventInterval = None
+    
+    log = Logger(observer=printToConsole)
+    
+    def __init__(self, latency=None, jitter=None, dropRate=None, eventInterval=None, clock=reactor, seed=None):
+        if latency is not None:
+            self.latency = latency
+        if jitter is not None:
+            self.jitter = jitter
+        if dropRate is not None:
+            self.dropRate = dropRate
+        if eventInterval is not None:
+            self.eventInterval = eventInterval
+        
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.state = self.initialState()
+        self._buffer = ''
+        self._events = None
+    
+    def initialState(self):
+        return {}
+    
+    def connectionMade(self):
+        if self.eventInterval:
+            self._events = LoopingCall(self._sendEvent)
+            self._events.clock = self.clock
+            self._events.start(self.eventInterval, now=False)
+    
+    def connectionLost(self, reason):
+        if self._events is not None and self._events.running:
+            self._events.stop()
+    
+    def dataReceived(self, data):
+        requests, self._buffer = self.split(self._buffer + data)
+        for request in requests:
+            self._requestReceived(request)
+    
+    def split(self, data):
+        """
+        Returns a list of the complete requests in data and whatever is left over.
+        """
+        requests = data.split(self.inputDelimiter)
+        return requests[:-1], requests[-1]
+    
+    def handle(self, request):
+        """
+        Updates the state for the request and returns the bytes to send back (with their delimiters), or None if the
+        device doesn't answer it. By default nothing is answered.
+        """
+        self.log.debug("Not answering unhandled request {request!r}", request=request)
+        return None
+    
+    def event(self):
+        """
+        Returns an unsolicited reply to send (with its delimiter) as if the device was changed by hand, or None.
+        """
+        return None
+    
+    def _requestReceived(self, request):
+        reply = self.handle(request)
+        
+        if reply is None:
+            return
+        if self.dropRate and self.random.random() < self.dropRate:
+            self.log.debug("Dropping the reply to {request!r}", request=request)
+            return
+        
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            self.clock.callLater(delay, self._write, reply)
+        else:
+            self._write(reply)
+    
+    def _sendEvent(self):
+        reply = self.event()
+        if reply is not None:
+            self._write(reply)
+    
+    def _write(self, data):
+        if self.transport is not None and not getattr(self.transport, 'disconnecting', False):
+            self.transport.write(data)
+
+class EmulatorFactory(protocol.Factory):
+    """
+    Serves an emulator over TCP, every connection gets its own device (and state).
+    """
+    
+    def __init__(self, emulatorClass, **options):
+        self.emulatorClass = emulatorClass
+        self.options = options
+    
+    def buildProtocol(self, addr):
+        return self.emulatorClass(**self.options)
+
+def serveTCP(emulatorClass, port, interface='127.0.0.1', **options):
+    """
+    Listens for connections to an emulated device on port and returns the listening port.
+    """
+    return reactor.listenTCP(port, EmulatorFactory(emulatorClass, **options), interface=interface)
+
+def servePty(emulatorClass, **options):
+    """
+    Connects an emulated device to a new pseudo terminal and returns the path of its other end, which the serial
+    drivers can open like a real serial port.
+    """
+    master, slave = os.openpty()
+    
+    # no echo or newline translation, it has to pass bytes through like a serial cable
+    tty.setraw(slave, termios.TCSANOW)
+    tty.setraw(master, termios.TCSANOW)
+    
+    StandardIO(emulatorClass(**options), stdin=master, stdout=master)
+    return os.ttyname(slave)
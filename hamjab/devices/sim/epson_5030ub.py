@@ -0,0 +1,43 @@
+import re
+
+from hamjab.devices.sim.emulator import DeviceEmulator
+
+class Emulator(DeviceEmulator):
+    """
+    Emulates the ESC/VP21 serial protocol of an Epson 5030UB. Commands end with \\r and every reply ends with the :
+    prompt: a query gets KEY=VALUE\\r: (or ERR\\r: for one it doesn't know), anything else just gets the prompt.
+    """
+    
+    deviceId = 'epson_5030ub'
+    
+    PROMPT = ':'
+    
+    query = re.compile(r'^([A-Z]+)\?$')
+    setting = re.compile(r'^([A-Z]+) (.+)$')
+    
+    def initialState(self):
+        return {'PWR': '00', 'SOURCE': '30', 'LAMP': '1234'}
+    
+    def handle(self, request):
+        request = request.strip()
+        
+        if not request:
+            return self.PROMPT
+        
+        match = self.query.match(request)
+        if match:
+            key = match.group(1)
+            if key not in self.state:
+                return 'ERR\r' + self.PROMPT
+            return '{key}={value}\r{prompt}'.format(key=key, value=self.state[key], prompt=self.PROMPT)
+        
+        match = self.setting.match(request)
+        if not match:
+            return 'ERR\r' + self.PROMPT
+        
+        key, value = match.groups()
+        if key == 'PWR':
+            self.state['PWR'] = '01' if value == 'ON' else '00'
+        elif key not in ('KEY', 'PUSHMEM', 'POPMEM', 'ERASEMEM'):
+            self.state[key] = value
+        return self.PROMPT
@@ -0,0 +1,46 @@
+import re
+
+from hamjab.devices.sim.emulator import DeviceEmulator
+
+class Emulator(DeviceEmulator):
+    """
+    Emulates a Lutron GRX-RS232 with the "Scene Status" dipswitch on. Commands end with \\r and replies with \\r\\n,
+    selecting a scene (or asking with G) is answered with the scene status of all 8 control units (M for a missing
+    one). Events are scenes being selected on the first control unit's buttons.
+    """
+    
+    deviceId = 'lutron_grx_3000'
+    inputDelimiter = '\r'
+    
+    SCENES = '0123456789ABCDEFG'
+    controlUnits = 1
+    
+    selectScene = re.compile(r'^A([0-9A-G])([1-8]+)$')
+    
+    def initialState(self):
+        return {'scenes': ['1'] * self.controlUnits + ['M'] * (8 - self.controlUnits)}
+    
+    def handle(self, request):
+        # commands can be sent with or without the leading colon
+        request = request.strip().lstrip(':')
+        
+        match = self.selectScene.match(request)
+        if match:
+            scene, units = match.groups()
+            for unit in units:
+                if self.state['scenes'][int(unit) - 1] != 'M':
+                    self.state['scenes'][int(unit) - 1] = scene
+            return self._sceneStatus()
+        elif request == 'G':
+            return self._sceneStatus()
+        elif request == 'V':
+            return ':v 6 1 GRX-RS232\r\n'
+        
+        return None
+    
+    def event(self):
+        self.state['scenes'][0] = self.random.choice(self.SCENES)
+        return self._sceneStatus()
+    
+    def _sceneStatus(self):
+        return ':ss {scenes}\r\n'.format(scenes=''.join(self.state['scenes']))
@@ -0,0 +1,73 @@
+import operator
+
+from hamjab.devices.sim.emulator import DeviceEmulator
+
+class Emulator(DeviceEmulator):
+    """
+    Emulates the binary serial protocol of a Sony VPL-HW30ES. Every packet is 8 bytes: 0xA9, the item number (2 bytes),
+    the type (1 byte), the data (2 bytes), a checksum (the OR of the five bytes before it) and 0x9A. Since 0x9A can turn
+    up in the data packets are read by length, a packet which doesn't end in 0x9A gets a framing error.
+    
+    A GET is answered with the item's value (0000 until it has been SET) and a SET with an empty reply.
+    """
+    
+    deviceId = 'sony_vpl_hw30es'
+    
+    START = 0xA9
+    END = 0x9A
+    LENGTH = 8
+    
+    SET = 0x00
+    GET = 0x01
+    REPLY_DATA = 0x02
+    REPLY_NO_DATA = 0x03
+    
+    SUCCESS = '\x00\x00'
+    UNDEFINED_COMMAND = '\x01\x01'
+    CHECKSUM_ERROR = '\xf0\x10'
+    FRAMING_ERROR = '\xf0\x20'
+    
+    def split(self, data):
+        packets = []
+        
+        while data:
+            # skip any noise before the start of a packet
+            start = data.find(chr(self.START))
+            if start == -1:
+                return packets, ''
+            data = data[start:]
+            
+            if len(data) < self.LENGTH:
+                break
+            packets.append(data[:self.LENGTH])
+            data = data[self.LENGTH:]
+        
+        return packets, data
+    
+    def handle(self, packet):
+        packet = bytearray(packet)
+        
+        if packet[7] != self.END:
+            return self._reply(self.FRAMING_ERROR, self.REPLY_NO_DATA)
+        if packet[6] != reduce(operator.__or__, packet[1:6]):
+            return self._reply(self.CHECKSUM_ERROR, self.REPLY_NO_DATA)
+        
+        item, commandType, data = str(packet[1:3]), packet[3], str(packet[4:6])
+        
+        if commandType == self.GET:
+            return self._reply(self.SUCCESS, self.REPLY_DATA, self.state.get(item, '\x00\x00'))
+        elif commandType == self.SET:
+            self.state[item] = data
+            return self._reply(self.SUCCESS, self.REPLY_NO_DATA)
+        
+        return self._reply(self.UNDEFINED_COMMAND, self.REPLY_NO_DATA)
+    
+    def _reply(self, result, replyType, data='\x00\x00'):
+        packet = bytearray(self.LENGTH)
+        packet[0] = self.START
+        packet[1:3] = result
+        packet[3] = replyType
+        packet[4:6] = data
+        packet[6] = reduce(operator.__or__, packet[1:6])
+        packet[7] = self.END
+        return str(packet)
@@ -4,6 +4,9 @@ import operator
 from serial import PARITY_EVEN
 
 from hamjab.devices.device_lib import SerialDevice
+from hamjab.lib import ERROR
+
+from twisted.internet.defer import succeed
 
 class SonyException(Exception):
     pass
@@ -60,10 +63,40 @@ class Device(SerialDevice):
         return self._build_packet(item_number, self.GET)
 
     def raw_command(self, body):
-        # convert them to ints because the _build_packet function expects that if it's a str it has to decode it (but we've already done that) 
-        body_bytes = [ord(x) for x in self._check_format(body, 5)]
-        packet = self._build_packet(body_bytes[0:2], body_bytes[2], body_bytes[3:5])
-        return self.sendLine(packet)
+        return self.sendLine(body)
+
+    def sendLine(self, line, *args, **kwargs):
+        """
+        Takes the 5 byte body of a command (item number, type and data) and sends it as a packet. The body can also be
+        given as a 10 character hex string, anything else is sent as-is. A 10 character string which isn't hex is
+        answered with ERROR without sending anything.
+        """
+        if len(line) == 10:
+            try:
+                line = self._check_format(line, 5)
+            except (TypeError, SonyException):
+                return succeed(ERROR)
+        if len(line) == 5:
+            line = self._body_packet(line)
+        return SerialDevice.sendLine(self, line, *args, **kwargs)
+
+    @staticmethod
+    def reduceState(state, line, command=None):
+        """
+        Commands are hex strings of item number (2 bytes), type (1 byte) and data (2 bytes). A GET reply holds the item's
+        value and a successful SET means the item now has the value that was sent.
+        """
+        if command is not None and len(command) == 5:
+            command = str(command).encode('hex')
+        if command is None or len(command) != 10:
+            return state
+        
+        item, command_type, data = command[0:4].upper(), int(command[4:6], 16), command[6:10].upper()
+        if command_type == Device.GET:
+            state[item] = line
+        elif command_type == Device.SET:
+            state[item] = data
+        return state
 
     def _bytearray_to_str(self, to_convert):
         return str(to_convert).encode('hex').upper()
@@ -118,6 +151,13 @@ class Device(SerialDevice):
     def _checksum(self, data):
         return reduce(operator.__or__, data)
 
+    def _body_packet(self, body):
+        packet = bytearray(7)
+        packet[0] = self.START
+        packet[1:6] = body
+        packet[6] = self._checksum(packet[1:6])
+        return packet
+
     def _build_packet(self, item_number, command_type, data=DUMMY_DATA):
         packet = bytearray(7)
         
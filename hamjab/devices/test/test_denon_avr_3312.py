@@ -0,0 +1,14 @@
+from devices import denon_avr_3312_ethernet, denon_avr_3312_rs232
+from twisted.trial import unittest
+
+class DenonDeviceTestCase(unittest.TestCase):
+    
+    def test_reduce_state(self):
+        state = {}
+        for line in ('PWON', 'MV505', 'MVMAX 98', 'SIDVD', 'SLP030', 'MSDOLBY DIGITAL'):
+            state = denon_avr_3312_ethernet.Device.reduceState(state, line)
+        
+        self.assertEqual({'power': 'ON', 'masterVolume': '505', 'input': 'DVD', 'sleep': '030', 'surroundMode': 'DOLBY DIGITAL'}, state)
+    
+    def test_same_reducer(self):
+        self.assertEqual({'mute': 'ON'}, denon_avr_3312_rs232.Device.reduceState({}, 'MUON'))
@@ -19,3 +19,10 @@ class EpsonDeviceTestCase(unittest.TestCase):
         self.protocol.dataReceived(':')
         
         return d
+
+    def test_reduce_state(self):
+        state = Device.reduceState({}, 'PWR=01', 'PWR?')
+        self.assertEqual({'PWR': '01'}, state)
+        
+        state = Device.reduceState(state, 'ERR')
+        self.assertEqual({'PWR': '01'}, state)
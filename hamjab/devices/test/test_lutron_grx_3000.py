@@ -0,0 +1,14 @@
+from devices.lutron_grx_3000 import Device
+from twisted.trial import unittest
+
+class LutronDeviceTestCase(unittest.TestCase):
+    
+    def test_reduce_state(self):
+        state = Device.reduceState({}, ':ss 3MMMMMMM')
+        self.assertEqual({'scene': '3', 'scenes': {'1': '3'}}, state)
+        
+        state = Device.reduceState(state, ':ss 12MMMMMM', 'G')
+        self.assertEqual({'scene': '1', 'scenes': {'1': '1', '2': '2'}}, state)
+    
+    def test_reduce_state_other_lines(self):
+        self.assertEqual({}, Device.reduceState({}, 'V 1.2'))
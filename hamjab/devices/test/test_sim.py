@@ -0,0 +1,105 @@
+from devices import denon_avr_3312_ethernet, epson_5030ub, lutron_grx_3000, sony_vpl_hw30es
+from devices.sim import findEmulator
+from devices.sim.emulator import DeviceEmulator
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+class EmulatorTestCase(unittest.TestCase):
+    
+    def _connect(self, device, deviceId, **options):
+        self.device = device
+        self.device.makeConnection(proto_helpers.StringTransport())
+        self.clock = Clock()
+        self.emulator = findEmulator(deviceId)(clock=self.clock, seed=1, **options)
+        self.emulator.makeConnection(proto_helpers.StringTransport())
+    
+    def _pump(self):
+        self.emulator.dataReceived(self.device.transport.value())
+        self.device.transport.clear()
+        self.device.dataReceived(self.emulator.transport.value())
+        self.emulator.transport.clear()
+    
+    def _send(self, command):
+        d = self.device.sendLine(command)
+        self._pump()
+        return self.successResultOf(d)
+    
+    def test_epson(self):
+        self._connect(epson_5030ub.Device('COM3'), 'epson_5030ub')
+        
+        self.assertEqual('PWR=00', self._send('PWR?'))
+        self.assertEqual(':', self.emulator.handle('PWR ON'))
+        self.assertEqual('PWR=01', self._send('PWR?'))
+        self.assertEqual('ERR\r:', self.emulator.handle('NOPE?'))
+    
+    def test_lutron(self):
+        self._connect(lutron_grx_3000.Device('COM3'), 'lutron_grx_3000')
+        
+        self.assertEqual(':ss 3MMMMMMM', self._send('A31'))
+        self.assertEqual(':ss 3MMMMMMM', self._send(':G'))
+        self.assertIdentical(None, self.emulator.handle('X'))
+    
+    def test_sony(self):
+        self._connect(sony_vpl_hw30es.Device('COM3'), 'sony_vpl_hw30es')
+        
+        self.assertEqual('0000', self._send('0020000003'))
+        self.assertEqual('0003', self._send('0020010000'))
+        
+        # 0x9A in the data doesn't end the packet early
+        self.assertEqual('0000', self._send('0030009A9A'))
+        self.assertEqual({'\x00\x20': '\x00\x03', '\x00\x30': '\x9a\x9a'}, self.emulator.state)
+    
+    def test_sony_checksum(self):
+        self._connect(sony_vpl_hw30es.Device('COM3'), 'sony_vpl_hw30es')
+        
+        self.emulator.dataReceived('\xA9\x00\x20\x00\x00\x03\x00\x9A')
+        self.assertEqual('\xA9\xf0\x10\x03\x00\x00\xf3\x9A', self.emulator.transport.value())
+    
+    def test_denon(self):
+        self._connect(denon_avr_3312_ethernet.Device('localhost'), 'denon_avr_3312')
+        
+        self.assertEqual('MV50', self._send('MV?'))
+        self.assertEqual([(1, 'MVMAX 98')], self.device.getBufferedEvents(0))
+        self.assertEqual('MV51', self._send('MVUP'))
+        self.assertEqual('PWON', self._send('PWON'))
+        self.assertEqual('ON', self.emulator.state['ZM'])
+    
+    def test_latency(self):
+        self._connect(epson_5030ub.Device('COM3'), 'epson_5030ub', latency=0.5)
+        
+        d = self.device.sendLine('PWR?')
+        self._pump()
+        self.assertNoResult(d)
+        
+        self.clock.advance(0.5)
+        self._pump()
+        self.assertEqual('PWR=00', self.successResultOf(d))
+    
+    def test_dropped(self):
+        self._connect(epson_5030ub.Device('COM3'), 'epson_5030ub', dropRate=1)
+        
+        d = self.device.sendLine('PWR?')
+        self._pump()
+        self.assertNoResult(d)
+        
+        self.device.failPending('TIMEOUT')
+        self.assertEqual('TIMEOUT', self.successResultOf(d))
+    
+    def test_events(self):
+        self._connect(lutron_grx_3000.Device('COM3'), 'lutron_grx_3000', eventInterval=5)
+        
+        self.clock.advance(5)
+        self._pump()
+        self.assertEqual(1, self.device.eventSequence)
+        self.assertTrue(self.device.getBufferedEvents(0)[0][1].startswith(':ss '))
+        
+        self.emulator.connectionLost(None)
+        self.assertEqual([], self.clock.getDelayedCalls())
+    
+    def test_unhandled(self):
+        emulator = DeviceEmulator(clock=Clock())
+        emulator.makeConnection(proto_helpers.StringTransport())
+        
+        emulator.dataReceived('PWR?\r')
+        self.assertEqual('', emulator.transport.value())
@@ -36,6 +36,21 @@ class SonyDeviceTestCase(unittest.TestCase):
         
         return d
 
+    def test_binary_command(self):
+
+        d = self.protocol.sendLine('\x00\x20\x00\x00\x0D')
+        self.assertEqual('\xA9\x00\x20\x00\x00\x0D\x2D\x9A', self.transport.value())
+        
+        d.addCallback(self.assertEqual, '0000')
+        self.protocol.dataReceived('\xA9\x00\x00\x03\x00\x00\x03\x9A')
+        
+        return d
+
+    def test_invalid_hex(self):
+        d = self.protocol.sendLine('zzzzzzzzzz')
+        self.assertEqual('', self.transport.value())
+        self.assertEqual('ERROR', self.successResultOf(d))
+
     def test_invalid_checksum(self):
 
         d = self.protocol.raw_command('0020000003')
@@ -46,3 +61,16 @@ class SonyDeviceTestCase(unittest.TestCase):
         self.protocol.dataReceived('\xA9\x00\x00\x03\xde\xad\x00\x9A')
         
         return d
+
+    def test_reduce_state(self):
+        state = Device.reduceState({}, '0003', '0020010000')
+        self.assertEqual({'0020': '0003'}, state)
+        
+        state = Device.reduceState(state, '0000', '0020000001')
+        self.assertEqual({'0020': '0001'}, state)
+        
+        state = Device.reduceState(state, '0000', '\x00\x20\x00\x00\x02')
+        self.assertEqual({'0020': '0002'}, state)
+        
+        state = Device.reduceState(state, 'garbage')
+        self.assertEqual({'0020': '0002'}, state)
@@ -1,31 +1,69 @@
-import traceback, unicodedata
+import binascii, heapq, json, math, os, re, struct, traceback, unicodedata
+
+from bisect import bisect_left
+
+from collections import deque, namedtuple, OrderedDict
+from itertools import islice
 
 from twisted.logger import Logger, ILogObserver, formatEventAsClassicLogText
 from twisted.internet import protocol, reactor, error
-from twisted.internet.defer import Deferred, returnValue, inlineCallbacks
-from twisted.internet.task import deferLater
+from twisted.internet.defer import CancelledError, Deferred, DeferredList, maybeDeferred, returnValue, inlineCallbacks, succeed
+from twisted.internet.task import deferLater, LoopingCall
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
 from twisted.protocols.basic import LineReceiver
 
 from zope.interface import provider
 
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+# lib.py is also shipped on its own (in the Kodi addon) where there aren't any drivers
+try:
+    from hamjab.devices import findStateReducers
+except ImportError:
+    findStateReducers = None
+
 _reactor = reactor
-def timeoutDeferred(deferred, timeout):
-    delayedCall = _reactor.callLater(timeout, deferred.cancel)
-    def gotResult(result):
-        if delayedCall.active():
-            delayedCall.cancel()
-        return result
-    deferred.addBoth(gotResult)
 
 ############################## constants
 TIMEOUT = 'TIMEOUT'
 NO_DEVICE_FOUND = 'NO_DEVICE_FOUND'
 SUCCESS = 'SUCCESS'
+ERROR = 'ERROR'
+CANCELLED = 'CANCELLED'
+DISCONNECTED = 'DISCONNECTED'
 DELAY = 'DELAY'
 DISABLED = 'DISABLED'
 
+# command priority classes, lower values are sent to the device first
+PRIORITY_MACRO = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_POLL = 2
+
+PRIORITIES = {
+    'macro': PRIORITY_MACRO,
+    'interactive': PRIORITY_INTERACTIVE,
+    'poll': PRIORITY_POLL,
+}
+
 DEFAULT_DEVICE_SERVER_PORT = 8007
 
+# the framed device link (see L{FrameDecoder}). A client which speaks it sends LINK_HELLO as its first line, anything
+# else is taken to be the device ID of a client using the old line protocol.
+LINK_VERSION = 2
+LINK_HELLO = 'HAMJAB/2'
+
+FRAME_HELLO = 0
+FRAME_REQUEST = 1
+FRAME_RESPONSE = 2
+FRAME_EVENT = 3
+FRAME_PING = 4
+FRAME_PONG = 5
+FRAME_TRACE = 6
+
 ################################################### common code
 @provider(ILogObserver)
 def printToConsole(event):
@@ -39,24 +77,268 @@ def my_logger():
     log_observer = log.FileLogObserver(f)
     return log_observer.emit
 
+class TimerEntry(object):
+    """
+    A function scheduled on a L{TimerWheel}. Cancelling it just flags it, the wheel skips it when its slot expires.
+    """
+
+    def __init__(self, wheel, tick, func, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.wheel._cancelled(self)
+
+class TimerWheel(object):
+    """
+    A coarse grained timer for timeouts. Deadlines are rounded up to the next multiple of L{resolution} seconds and
+    everything which lands in the same slot expires together, so there is only ever one reactor delayed call per wheel
+    (for the earliest slot) no matter how many timeouts are pending. Once nothing is pending the delayed call is dropped.
+    """
+
+    log = Logger(observer=printToConsole)
+
+    def __init__(self, resolution=1):
+        self.resolution = resolution
+        self._slots = {}
+        self._ticks = []
+        self._delayedCall = None
+        self._pending = 0
+
+    def __len__(self):
+        return self._pending
+
+    def schedule(self, delay, func, *args):
+        """
+        Calls func(*args) once at least delay seconds have passed, returns a L{TimerEntry} which can be cancelled.
+        """
+        tick = int(math.ceil((_reactor.seconds() + delay) / float(self.resolution)))
+        entry = TimerEntry(self, tick, func, args)
+        
+        if tick not in self._slots:
+            self._slots[tick] = []
+            heapq.heappush(self._ticks, tick)
+        self._slots[tick].append(entry)
+        self._pending += 1
+        
+        self._arm()
+        return entry
+
+    def _cancelled(self, entry):
+        self._pending -= 1
+        
+        # nothing left to time out, forget the cancelled entries instead of waking up for them
+        if not self._pending:
+            self._slots.clear()
+            del self._ticks[:]
+            if self._delayedCall is not None and self._delayedCall.active():
+                self._delayedCall.cancel()
+            self._delayedCall = None
+
+    def _arm(self):
+        when = self._ticks[0] * self.resolution
+        
+        if self._delayedCall is not None and self._delayedCall.active():
+            if self._delayedCall.getTime() <= when:
+                return
+            self._delayedCall.cancel()
+        
+        self._delayedCall = _reactor.callLater(max(0, when - _reactor.seconds()), self._expire)
+
+    def _expire(self):
+        self._delayedCall = None
+        now = _reactor.seconds()
+        
+        while self._ticks and self._ticks[0] * self.resolution <= now:
+            tick = heapq.heappop(self._ticks)
+            for entry in self._slots.pop(tick):
+                if entry.cancelled:
+                    continue
+                entry.cancelled = True
+                self._pending -= 1
+                try:
+                    entry.func(*entry.args)
+                except Exception:
+                    self.log.error("Error in timer callback: {trace}", trace=traceback.format_exc())
+        
+        if self._ticks:
+            self._arm()
+
+class Tracer(object):
+    """
+    Keeps the timestamped spans of the last L{size} traces. A trace follows one web request or macro run through every
+    hop (web, macro, server, client) and each span is a dict with the hop, the span name, the time and any details.
+    Spans for a trace ID of None aren't recorded so untraced commands cost nothing more than the check.
+    """
+    
+    size = 1000
+
+    def __init__(self):
+        self._traces = OrderedDict()
+
+    def __len__(self):
+        return len(self._traces)
+
+    @staticmethod
+    def newTraceId():
+        return binascii.hexlify(os.urandom(8))
+
+    def span(self, traceId, hop, name, **details):
+        if traceId is None:
+            return
+        
+        details.update(hop=hop, span=name, time=_reactor.seconds())
+        self._spans(traceId).append(details)
+
+    def extend(self, traceId, spans):
+        """
+        Adds spans which were recorded elsewhere (eg. by the device client) to the trace.
+        """
+        self._spans(traceId).extend(spans)
+
+    def _spans(self, traceId):
+        spans = self._traces.get(traceId)
+        if spans is None:
+            spans = self._traces[traceId] = []
+            if len(self._traces) > self.size:
+                self._traces.popitem(last=False)
+        return spans
+
+    def get(self, traceId):
+        """
+        Returns the list of spans of the trace or None if it isn't known (any more).
+        """
+        return self._traces.get(traceId)
+
+    def pop(self, traceId):
+        return self._traces.pop(traceId, [])
+
+    def export(self):
+        return dict(self._traces)
+
+class QueuedRequest(object):
+    """
+    A single line waiting to be sent by a L{QueuedLineSender} along with the deferred which will receive its response.
+    """
+
+    def __init__(self, line, deferred, priority=PRIORITY_INTERACTIVE, source=None, timeout=None, traceId=None):
+        self.line = line
+        self.deferred = deferred
+        self.priority = priority
+        self.source = source
+        self.timeout = timeout
+        self.traceId = traceId
+        self.cancelled = False
+        self.timer = None
+        self.sent = False
+        self.waiters = []
+        self.queuedAt = None
+        self.generation = None
+
+class CommandQueue(object):
+    """
+    A queue of L{QueuedRequest}s split into priority classes. Requests in a lower numbered class are always popped
+    before requests in a higher numbered one. Inside a class each source gets its own FIFO and the sources take turns
+    (round-robin) so a single chatty client can't starve the others.
+    
+    Pushing, popping and removing are all O(1): every class is a deque of sources waiting for a turn plus a deque of
+    requests per source. Removed requests are only flagged and get skipped when they reach the front.
+    """
+
+    def __init__(self, numPriorities=len(PRIORITIES)):
+        self._sources = [{} for x in range(numPriorities)]
+        self._rotations = [deque() for x in range(numPriorities)]
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __nonzero__(self):
+        return self._length > 0
+
+    def push(self, request):
+        sources = self._sources[request.priority]
+        
+        if request.source in sources:
+            sources[request.source].append(request)
+        else:
+            sources[request.source] = deque([request])
+            self._rotations[request.priority].append(request.source)
+        
+        self._length += 1
+
+    def pop(self):
+        """
+        Returns the next request which should be sent or None if the queue is empty.
+        """
+        for sources, rotation in zip(self._sources, self._rotations):
+            while rotation:
+                source = rotation.popleft()
+                requests = sources[source]
+                request = requests.popleft()
+                
+                # give the source another turn at the back of the line if it still has work queued
+                if requests:
+                    rotation.append(source)
+                else:
+                    del sources[source]
+                
+                if not request.cancelled:
+                    self._length -= 1
+                    return request
+        return None
+
+    def remove(self, request):
+        if not request.cancelled:
+            request.cancelled = True
+            self._length -= 1
+
 class QueuedLineSender(LineReceiver):
     """
     A class which provides functionality for sending and receiving lines. It expects every line which is sent
     to result in a return line (even if it's empty). It will not send the next line until an answer has been received
     from the previous one - subsequent commands will be queued and executed once a response is received.
     
-    If no response is received after L{timeout} seconds then a TIMEOUT will automatically be returned.
+    Queued commands are sent in priority order (see L{CommandQueue}), so a macro step or a button press doesn't have to
+    wait behind a pile of status polls.
+    
+    Lines in L{coalesceLines} are read-only queries: if the same query is already queued or waiting for its response a
+    new request for it joins that exchange instead of being sent again, and every caller gets the one result.
+    
+    If no response is received after L{timeout} seconds then a TIMEOUT will automatically be returned. The timeout starts
+    when the line is actually written, not when it is queued, and all timeouts share one L{TimerWheel}.
+    
+    If L{metrics} is set to a L{DeviceMetrics} then the time every line spends queued and waiting for its response is
+    recorded in it, along with timeouts and unsolicited lines. Lines sent with a trace ID record queued, sent and
+    response spans for L{traceHop} in L{tracer}.
     """
     delimiter = '\r'
     sendDelimiter = '\r'
     timeout = 30
+    coalesceLines = frozenset()
+    eventBufferSize = 100
+    metrics = None
+    tracer = None
+    traceHop = 'client'
+    deviceId = None
 
     log = Logger(observer=printToConsole)
 
     def __init__(self):
         self.responseDeferred = None
         self.unsoliticedDeferreds = []
-        self._requests = []
+        self._requests = CommandQueue()
+        self._timeouts = TimerWheel()
+        self._exchanges = {}
+        self.eventSequence = 0
+        self._events = deque(maxlen=self.eventBufferSize)
+        self._sentAt = None
+        self._current = None
 
     def lineReceived(self, line):
         if line == '':
@@ -65,47 +347,154 @@ class QueuedLineSender(LineReceiver):
         if not self.responseDeferred:
             self._receivedUnsolicitedLine(line)
         else:
-            current_deferred = self.responseDeferred
-            self.responseDeferred = None
-            
-            # if there are more requests then kick off the next one
-            if self._requests:
-                command, queued_deferred = self._requests.pop(0)
-                self._sendLine(command, queued_deferred)
-            
-            try:
-                line = self._process_line(line)
-                current_deferred.callback(line)
-            except Exception as e:
-                current_deferred.errback(e)
+            self._receivedResponse(line)
+
+    def _receivedResponse(self, line):
+        current_deferred = self.responseDeferred
+        self.responseDeferred = None
+        
+        if self.metrics is not None and line is not TIMEOUT:
+            self.metrics.responseTime.observe(_reactor.seconds() - self._sentAt)
+        
+        if self.tracer is not None and self._current.traceId is not None:
+            self.tracer.span(self._current.traceId, self.traceHop, 'timeout' if line is TIMEOUT else 'response', device=self.deviceId)
+        
+        # if there are more requests then kick off the next one
+        if self._requests:
+            self._sendRequest(self._requests.pop())
+        
+        try:
+            line = self._process_line(line)
+            current_deferred.callback(line)
+        except Exception as e:
+            current_deferred.errback(e)
 
     def _process_line(self, line):
         return line
 
-    def timeoutDeferred(self, deferred):
-        if self.responseDeferred == deferred:
-            self.lineReceived(TIMEOUT)
+    def _cancelRequest(self, request):
+        if self.responseDeferred is request.deferred:
+            # the line is already out, keep waiting for the answer (or the timeout) so it isn't mistaken for the
+            # response to the next line but don't hand it to anybody
+            request.deferred = Deferred()
+            request.deferred.addBoth(self._requestFinished, request)
+            self.responseDeferred = request.deferred
         else:
-            #TODO: should maybe just be an exception
-            self.log.warn("A deferred finished that wasn't in the front of the queue... looking for it to remove it to at least try and stay sane")
-            self._requests = [x for x in self._requests if x[1] != deferred]
+            self._requests.remove(request)
 
-    def sendLine(self, line):
+    def _timeoutRequest(self, request):
+        if self.responseDeferred is request.deferred:
+            if self.metrics is not None:
+                self.metrics.timeouts += 1
+            self._receivedResponse(TIMEOUT)
+
+    def failPending(self, result):
+        """
+        Answers the line which is waiting for its response and every queued line with result right away, for when the
+        other side is known to be gone.
+        """
+        requests = []
+        while self._requests:
+            requests.append(self._requests.pop())
+        
+        if self.responseDeferred is not None:
+            deferred = self.responseDeferred
+            self.responseDeferred = None
+            deferred.callback(result)
+        
+        for request in requests:
+            request.deferred.callback(result)
+
+    def sendLine(self, line, priority=PRIORITY_INTERACTIVE, source=None, timeout=None, traceId=None):
+        """
+        Sends the line to the other side and returns a deferred which will fire with the response. If a line is already
+        waiting for its response this one is queued in the given priority class, commands from the same class take
+        turns by source. The timeout (in seconds) overrides L{timeout} for this line only.
+        """
 
         if type(line) is unicode:
             line = unicodedata.normalize('NFKD', line).encode('ascii', 'ignore')
 
+        if self.coalesceLines and line in self.coalesceLines:
+            return self._joinExchange(line, priority, source, traceId)
+
+        return self._queueRequest(QueuedRequest(line, None, priority, source, timeout, traceId))
+
+    def _queueRequest(self, request):
+        if self.metrics is not None:
+            request.queuedAt = _reactor.seconds()
+        
+        if self.tracer is not None:
+            self.tracer.span(request.traceId, self.traceHop, 'queued', device=self.deviceId)
+        
         # create a deferred to be fired when this line receives a response
-        requestDeferred = Deferred(self.timeoutDeferred)
-        timeoutDeferred(requestDeferred, self.timeout)
+        request.deferred = Deferred(lambda ignored: self._cancelRequest(request))
+        request.deferred.addBoth(self._requestFinished, request)
         
         # if we are in the middle of a line then add this one to a queue
         if self.responseDeferred is None:
-            self._sendLine(line, requestDeferred)
+            self._sendRequest(request)
         else:
-            self._requests.append((line, requestDeferred))
-        return requestDeferred
+            self._requests.push(request)
+        return request.deferred
     
+    def _joinExchange(self, line, priority, source, traceId=None):
+        request = self._exchanges.get(line)
+        
+        # a queued exchange in a worse priority class than this caller would make it wait, start a new one instead
+        if request is None or (not request.sent and request.priority > priority):
+            request = QueuedRequest(line, None, priority, source, None, traceId)
+            self._exchanges[line] = request
+            self._queueRequest(request)
+            request.deferred.addBoth(self._exchangeFinished, request)
+        elif self.tracer is not None:
+            self.tracer.span(traceId, self.traceHop, 'coalesced', device=self.deviceId, joinedTraceId=request.traceId)
+        
+        waiter = Deferred(lambda d: self._leaveExchange(request, d))
+        request.waiters.append(waiter)
+        return waiter
+
+    def _leaveExchange(self, request, waiter):
+        request.waiters.remove(waiter)
+        
+        # nobody wants the answer any more, don't bother sending it if we haven't yet
+        if not request.waiters and not request.sent:
+            self._requests.remove(request)
+            if self._exchanges.get(request.line) is request:
+                del self._exchanges[request.line]
+
+    def _exchangeFinished(self, result, request):
+        if self._exchanges.get(request.line) is request:
+            del self._exchanges[request.line]
+        
+        waiters = request.waiters
+        request.waiters = []
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def _requestFinished(self, result, request):
+        # a cancelled request which is still waiting for its answer keeps its timer
+        if request.timer and self.responseDeferred is not request.deferred:
+            request.timer.cancel()
+        return result
+
+    def _sendRequest(self, request):
+        request.sent = True
+        self._current = request
+        request.timer = self._timeouts.schedule(request.timeout or self.timeout, self._timeoutRequest, request)
+        
+        if self.metrics is not None:
+            self._sentAt = _reactor.seconds()
+            self.metrics.queueTime.observe(self._sentAt - request.queuedAt)
+        
+        if self.tracer is not None:
+            self.tracer.span(request.traceId, self.traceHop, 'sent', device=self.deviceId)
+        
+        self._sendLine(request.line, request.deferred)
+
     def _sendLine(self, line, deferred):
         self.responseDeferred = deferred
         self.transport.write(line + self.sendDelimiter)
@@ -118,32 +507,260 @@ class QueuedLineSender(LineReceiver):
     def _receivedUnsolicitedLine(self, line):
         self.log.debug("Received unsolicited line: {line!r}", line=line)
 
+        if self.metrics is not None:
+            self.metrics.events += 1
+        
+        self.eventSequence += 1
+        self._events.append((self.eventSequence, line))
+
         deferredList = self.unsoliticedDeferreds
         self.unsoliticedDeferreds = []
 
         for deferred in deferredList:
             deferred.callback(line)
     
+    def _unsolicitedFinished(self, result, timer):
+        timer.cancel()
+        return result
+
     @inlineCallbacks
     def getUnsolicitedData(self):
         newDeferred = Deferred(self._timeoutUnsolicited)
-        timeoutDeferred(newDeferred, self.timeout)
+        timer = self._timeouts.schedule(self.timeout, newDeferred.cancel)
+        newDeferred.addBoth(self._unsolicitedFinished, timer)
         
         self.unsoliticedDeferreds.append(newDeferred)
         
         result = yield newDeferred
         returnValue(result)
 
+    def getBufferedEvents(self, since):
+        """
+        Returns a list of the buffered (sequence, line) pairs which came after sequence number since. A since from the
+        future (ie. from before a reconnect) is treated as 0.
+        """
+        if not self._events:
+            return []
+        
+        if since > self.eventSequence:
+            since = 0
+        
+        start = max(0, since - self._events[0][0] + 1)
+        return list(islice(self._events, start, None))
+
+    @inlineCallbacks
+    def getUnsolicitedEvents(self, since):
+        """
+        Returns every buffered event after sequence number since right away, or waits for the next one if there are none.
+        The result is an empty list if nothing arrives before the timeout.
+        """
+        events = self.getBufferedEvents(since)
+        
+        if not events:
+            result = yield self.getUnsolicitedData()
+            if result != TIMEOUT:
+                events = self.getBufferedEvents(since)
+        
+        returnValue(events)
+
+
+##################################################### device link
+FRAME_LENGTH = struct.Struct('!I')
+
+# version, frame type, channel, request id
+FRAME_HEADER = struct.Struct('!BBHI')
+
+def encodeFrame(frameType, requestId, payload, channel=0):
+    """
+    Builds a single frame for the device link: a 4 byte length followed by the header and the payload, which is passed
+    through as-is so it can hold any bytes.
+    """
+    return FRAME_LENGTH.pack(FRAME_HEADER.size + len(payload)) + FRAME_HEADER.pack(LINK_VERSION, frameType, channel, requestId) + payload
+
+class FrameDecoder(object):
+    """
+    Splits the byte stream of the device link back into (frameType, channel, requestId, payload) tuples no matter how
+    TCP splits or joins the frames. Raises ValueError for a frame from a different version or one which is too long.
+    """
+    maxFrameLength = 1024 * 1024
+
+    def __init__(self):
+        self._buffer = ''
+
+    def feed(self, data):
+        buf = self._buffer + data
+        frames = []
+        offset = 0
+        
+        while len(buf) - offset >= FRAME_LENGTH.size:
+            (length,) = FRAME_LENGTH.unpack_from(buf, offset)
+            if length < FRAME_HEADER.size or length > self.maxFrameLength:
+                raise ValueError("Invalid frame length {length}".format(length=length))
+            
+            end = offset + FRAME_LENGTH.size + length
+            if len(buf) < end:
+                break
+            
+            version, frameType, channel, requestId = FRAME_HEADER.unpack_from(buf, offset + FRAME_LENGTH.size)
+            if version != LINK_VERSION:
+                raise ValueError("Unsupported link version {version}".format(version=version))
+            
+            frames.append((frameType, channel, requestId, buf[offset + FRAME_LENGTH.size + FRAME_HEADER.size:end]))
+            offset = end
+        
+        self._buffer = buf[offset:]
+        return frames
+
+class Heartbeat(object):
+    """
+    Calls sendPing every interval seconds and onDead once misses intervals have gone by without L{received} being
+    called, ie. without hearing anything at all from the other side.
+    """
+
+    def __init__(self, sendPing, onDead, interval=1, misses=3):
+        self.sendPing = sendPing
+        self.onDead = onDead
+        self.interval = interval
+        self.misses = misses
+        self._missed = 0
+        self._call = None
+
+    def start(self):
+        self._call = LoopingCall(self._beat)
+        self._call.clock = _reactor
+        self._call.start(self.interval, now=False)
+
+    def stop(self):
+        if self._call is not None and self._call.running:
+            self._call.stop()
+        self._call = None
+
+    def received(self):
+        self._missed = 0
+
+    def _beat(self):
+        self._missed += 1
+        if self._missed >= self.misses:
+            self.stop()
+            self.onDead()
+        else:
+            self.sendPing()
 
 ################################################# device client
 class DeviceClientProtocol(protocol.Protocol):
     """
-    A protocol for the Device Client. It announces its device ID on connection and then waits for commands
-    to be sent to it. When it receives a command it sends the command to the device and then forwards along
+    A protocol for the Device Client. It announces its device IDs on connection and then waits for commands
+    to be sent to them. When it receives a command it sends the command to the device and then forwards along
     the device's response.
+    
+    Everything on the link is framed (see L{FrameDecoder}): requests carry an ID which the response is sent back with,
+    so any number of them can be outstanding and unsolicited data from the device goes out as separate event frames.
+    Every device gets its own channel (its index in deviceProtocols) so one connection can carry several devices.
+    
+    Both sides send heartbeats, if the server isn't heard from for L{heartbeatMisses} intervals the connection is
+    dropped so the factory starts reconnecting.
+    
+    A request which the server sent a trace frame for is passed to the device with its trace ID, and the spans recorded
+    on this side go back in a trace frame just before the response.
+    """
+    heartbeatInterval = 1
+    heartbeatMisses = 3
+    
+    log = Logger(observer=printToConsole)
+    
+    def __init__(self, *deviceProtocols):
+        self.deviceProtocols = deviceProtocols
+        self.tracer = Tracer()
+        self._traceIds = {}
+        self._decoder = FrameDecoder()
+        self._heartbeat = Heartbeat(self._sendPing, self._serverDead, self.heartbeatInterval, self.heartbeatMisses)
+        for channel, deviceProtocol in enumerate(deviceProtocols):
+            deviceProtocol.tracer = self.tracer
+            self._waitForUnsolicited(channel)
+    
+    def _waitForUnsolicited(self, channel):
+        d = self.deviceProtocols[channel].getUnsolicitedData()
+        d.addCallback(self._receivedUnsolicited, channel)
+    
+    def _receivedUnsolicited(self, data, channel):
+        if data != TIMEOUT:
+            self._sendEvent(data, channel)
+        
+        self._waitForUnsolicited(channel)
+    
+    def connectionMade(self):
+        self.transport.write(LINK_HELLO + '\r')
+        for channel, deviceProtocol in enumerate(self.deviceProtocols):
+            self.log.info("Connected, registering device {deviceId!s}", deviceId=deviceProtocol.deviceId)
+            self.transport.write(encodeFrame(FRAME_HELLO, 0, deviceProtocol.deviceId, channel))
+        self._heartbeat.start()
+    
+    def connectionLost(self, reason):
+        self._heartbeat.stop()
+    
+    def _sendPing(self):
+        self.transport.write(encodeFrame(FRAME_PING, 0, ''))
+    
+    def _serverDead(self):
+        self.log.warn("No heartbeat from the device server, dropping the connection")
+        self.transport.abortConnection()
+    
+    def dataReceived(self, data):
+        self._heartbeat.received()
+        
+        try:
+            frames = self._decoder.feed(data)
+        except ValueError as e:
+            self.log.error("Dropping the connection to the device server: {error}", error=e)
+            self.transport.loseConnection()
+            return
+        
+        for frameType, channel, requestId, payload in frames:
+            if frameType == FRAME_PING:
+                self.transport.write(encodeFrame(FRAME_PONG, requestId, ''))
+            elif frameType == FRAME_PONG:
+                pass
+            elif frameType == FRAME_TRACE:
+                self._traceIds[channel, requestId] = payload
+            elif frameType == FRAME_REQUEST and channel < len(self.deviceProtocols):
+                traceId = self._traceIds.pop((channel, requestId), None)
+                # a driver which raises instead of failing its deferred mustn't take the other devices down with it
+                d = maybeDeferred(self._sendRequest, self.deviceProtocols[channel], payload, traceId)
+                d.addErrback(self._requestFailed, payload)
+                d.addCallback(self._sendResponse, requestId, channel, traceId)
+            else:
+                self.log.debug("Ignoring frame of type {frameType} for channel {channel} from the device server", frameType=frameType, channel=channel)
+
+    def _requestFailed(self, failure, line):
+        self.log.info("Command {line!r} failed: {error}", line=line, error=failure.getErrorMessage())
+        return ERROR
+
+    def _sendRequest(self, deviceProtocol, line, traceId):
+        if traceId is None:
+            return deviceProtocol.sendLine(line)
+        
+        self.tracer.span(traceId, 'client', 'received', device=deviceProtocol.deviceId)
+        return deviceProtocol.sendLine(line, traceId=traceId)
+
+    def _sendResponse(self, response, requestId, channel, traceId=None):
+        if traceId is not None:
+            self.tracer.span(traceId, 'client', 'responded', device=self.deviceProtocols[channel].deviceId)
+            spans = json.dumps(self.tracer.pop(traceId), encoding='latin-1')
+            self.transport.write(encodeFrame(FRAME_TRACE, requestId, spans, channel))
+        
+        self.transport.write(encodeFrame(FRAME_RESPONSE, requestId, response, channel))
+    
+    def _sendEvent(self, data, channel):
+        self.transport.write(encodeFrame(FRAME_EVENT, 0, data, channel))
+
+class LineDeviceClientProtocol(LineReceiver):
+    """
+    A device client which speaks the old line protocol: the device ID, commands, responses and unsolicited data all
+    go over the link as \r terminated lines. Only needed to talk to a device server which doesn't understand the
+    framed link.
     """
     
-    lineEnd = '\r'
+    delimiter = '\r'
     
     log = Logger(observer=printToConsole)
     
@@ -154,34 +771,33 @@ class DeviceClientProtocol(protocol.Protocol):
     
     def _receivedUnsolicited(self, data):
         if data != TIMEOUT:
-            self._sendLine(data)
+            self.sendLine(data)
         
         d = self.deviceProtocol.getUnsolicitedData()
         d.addCallback(self._receivedUnsolicited)
     
     def connectionMade(self):
         self.log.info("Connected, registering device {deviceId!s}", deviceId=self.deviceProtocol.deviceId)
-        self._sendLine(self.deviceProtocol.deviceId)
+        self.sendLine(self.deviceProtocol.deviceId)
     
-    def dataReceived(self, data):
-        data = data.rstrip(self.lineEnd)
-        d = self.deviceProtocol.sendLine(data)
-        d.addCallback(self._sendLine)
-        
-    def _sendLine(self, line):
-        self.transport.write(line + self.lineEnd)
+    def lineReceived(self, line):
+        d = self.deviceProtocol.sendLine(line)
+        d.addCallback(self.sendLine)
 
 class DeviceClientFactory(protocol.ReconnectingClientFactory):
     """
     A factory for creating device client protocols which will automatically reconnect and continue to try reconnecting
     for ever. Subsequent failures will cause the wait time to increase up to a max of 60 seconds.
+    
+    All of the given devices share the one connection (and its reconnect logic).
     """
     maxDelay = 60
+    protocol = DeviceClientProtocol
     
     log = Logger(observer=printToConsole)
     
-    def __init__(self, deviceProtocol):
-        self.deviceProtocol = deviceProtocol
+    def __init__(self, *deviceProtocols):
+        self.deviceProtocols = deviceProtocols
     
     def startedConnecting(self, connector):
         self.log.info("Attempting to connect to {destination!s}", destination=connector.getDestination())
@@ -189,7 +805,7 @@ class DeviceClientFactory(protocol.ReconnectingClientFactory):
     def buildProtocol(self, addr):
         self.log.info("Successfully connected to {destination!s}", destination=addr)
         self.resetDelay()
-        return DeviceClientProtocol(self.deviceProtocol)
+        return self.protocol(*self.deviceProtocols)
 
     def clientConnectionLost(self, connector, reason):
         self.log.info("Lost connection. Reason: {reason!s}", reason=reason)
@@ -202,68 +818,630 @@ class DeviceClientFactory(protocol.ReconnectingClientFactory):
 
 ##################################################### device server
 
+DEVICE_RESOURCES_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'resources', 'devices')
+DEVICE_CONFIG_PATH = os.path.join(DEVICE_RESOURCES_PATH, '{deviceId}', 'device.json')
+
+def readDeviceConfig(deviceId, path=DEVICE_CONFIG_PATH):
+    """
+    Returns the parsed device.json for the given device, or an empty dict if there isn't a usable one.
+    """
+    try:
+        with open(path.format(deviceId=deviceId)) as config_file:
+            return json.load(config_file)
+    except (IOError, ValueError):
+        return {}
+
+# a command from a device.json: its format, the set of its arg ids and a compiled regex (which has to match the whole
+# value) for every arg which has a pattern
+CommandSchema = namedtuple('CommandSchema', ['format', 'args', 'patterns'])
+
+def commandSchemas(commands):
+    """
+    Flattens the (possibly grouped) commands from a device.json into a dict of command id to L{CommandSchema}. Raises
+    re.error if an arg has an invalid pattern.
+    """
+    result = {}
+    for command in commands:
+        if 'commands' in command:
+            result.update(commandSchemas(command['commands']))
+        elif 'id' in command and 'command' in command:
+            args = command['command'].get('args', [])
+            patterns = dict((x['id'], re.compile('(?:{pattern})\\Z'.format(pattern=x['pattern']))) for x in args if 'pattern' in x)
+            result[command['id']] = CommandSchema(command['command']['format'], frozenset(x['id'] for x in args), patterns)
+    return result
+
+def formatCommand(schema, args):
+    """
+    Fills in the format of a L{CommandSchema} with the args (a dict of arg id to value) and returns the command. Raises
+    ValueError if the args aren't exactly the command's args, a value has a control character in it (which could end
+    the command early or start another one) or doesn't match its pattern.
+    """
+    if set(args) != schema.args:
+        raise ValueError("takes the args {expected}".format(expected=sorted(schema.args)))
+    
+    for argId, value in args.items():
+        if isinstance(value, basestring) and any(ord(x) < 32 or ord(x) == 127 for x in value):
+            raise ValueError("arg {argId} can't have control characters".format(argId=argId))
+        pattern = schema.patterns.get(argId)
+        if pattern is not None and not pattern.match(u'{0}'.format(value)):
+            raise ValueError("arg {argId} has to match {pattern}".format(argId=argId, pattern=pattern.pattern[3:-3]))
+    
+    try:
+        return schema.format.format(**args)
+    except (KeyError, IndexError, AttributeError, ValueError):
+        raise ValueError("the format {format!r} doesn't match the args".format(format=schema.format))
+
+# everything known about a device from its resources directory: the parsed device.json (empty if it doesn't have a
+# usable one), its name, its command schemas (see commandSchemas, None without a device.json), the names of its other
+# files (the front end) and the mtime of the device.json which was loaded
+DeviceMetadata = namedtuple('DeviceMetadata', ['deviceId', 'name', 'config', 'commands', 'assets', 'mtime'])
+
+class DeviceRegistry(object):
+    """
+    The metadata of every device in the resources directory, loaded once so looking something up never touches the
+    disk. L{check} reloads any device whose device.json has changed (by mtime) and picks up new devices, it's run when
+    inotify sees a change to one of the directories or every L{interval} seconds where inotify isn't available.
+    
+    A device which isn't in the directory gets an empty config and its ID as its name. L{version} goes up every time a
+    check changes something, so anything built from the metadata knows when to rebuild.
+    """
+    interval = 5
+    
+    log = Logger(observer=printToConsole)
+    
+    def __init__(self, path=DEVICE_RESOURCES_PATH, clock=reactor):
+        self.path = path
+        self.clock = clock
+        self._devices = {}
+        self._poller = None
+        self._notifier = None
+        self.version = 0
+        self.check()
+    
+    def __contains__(self, deviceId):
+        return deviceId in self._devices
+    
+    def get(self, deviceId):
+        """
+        Returns the L{DeviceMetadata} for the device or None if it's not in the directory.
+        """
+        return self._devices.get(deviceId)
+    
+    def getConfig(self, deviceId):
+        metadata = self._devices.get(deviceId)
+        return metadata.config if metadata is not None else {}
+    
+    def getName(self, deviceId):
+        metadata = self._devices.get(deviceId)
+        return metadata.name if metadata is not None else deviceId
+    
+    def getCommands(self, deviceId):
+        metadata = self._devices.get(deviceId)
+        return metadata.commands if metadata is not None else None
+    
+    def getAssets(self, deviceId):
+        metadata = self._devices.get(deviceId)
+        return metadata.assets if metadata is not None else frozenset()
+    
+    def check(self):
+        """
+        Reloads the devices which have been added, changed or removed since the last check and returns their IDs.
+        """
+        try:
+            deviceIds = set(x for x in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, x)))
+        except OSError:
+            deviceIds = set()
+        
+        changed = []
+        for deviceId in set(self._devices) - deviceIds:
+            del self._devices[deviceId]
+            changed.append(deviceId)
+        
+        for deviceId in deviceIds:
+            directory = os.path.join(self.path, deviceId)
+            try:
+                mtime = os.stat(os.path.join(directory, 'device.json')).st_mtime
+            except OSError:
+                mtime = None
+            
+            current = self._devices.get(deviceId)
+            if current is None or current.mtime != mtime or current.assets != self._listAssets(directory):
+                self._devices[deviceId] = self._load(deviceId, directory, mtime)
+                changed.append(deviceId)
+        
+        if changed:
+            self.version += 1
+        if changed and (self._poller is not None or self._notifier is not None):
+            self.log.info("Reloaded the metadata of devices {deviceIds}", deviceIds=sorted(changed))
+        return changed
+    
+    def _listAssets(self, directory):
+        try:
+            return frozenset(x for x in os.listdir(directory) if x != 'device.json')
+        except OSError:
+            return frozenset()
+    
+    def _load(self, deviceId, directory, mtime):
+        config = readDeviceConfig(deviceId, os.path.join(self.path, '{deviceId}', 'device.json')) if mtime is not None else {}
+        
+        try:
+            commands = commandSchemas(config.get('commands', [])) if config else None
+        except (KeyError, TypeError, AttributeError, re.error):
+            self.log.warn("Invalid commands in the device.json of {deviceId}", deviceId=deviceId)
+            commands = None
+        
+        return DeviceMetadata(deviceId, config.get('name', deviceId), config, commands, self._listAssets(directory), mtime)
+    
+    def start(self):
+        if inotify is not None and self.clock is reactor:
+            try:
+                self._notifier = inotify.INotify()
+                self._notifier.startReading()
+                self._notifier.watch(FilePath(self.path), mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE,
+                                     autoAdd=True, recursive=True, callbacks=[lambda *args: self.check()])
+                return
+            except Exception:
+                self.log.debug("inotify isn't usable, polling {path} instead: {trace}", path=self.path, trace=traceback.format_exc())
+                self._notifier = None
+        
+        self._poller = LoopingCall(self.check)
+        self._poller.clock = self.clock
+        self._poller.start(self.interval, now=False)
+    
+    def stop(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+class Outbox(object):
+    """
+    Commands for a device which has gone offline, held in the order they were sent until the same device ID registers
+    again. It holds at most L{size} commands and each one is answered with NO_DEVICE_FOUND if the device isn't back
+    within L{timeout} seconds of it being sent, so stale commands are dropped instead of replayed.
+    """
+
+    def __init__(self, size, timeout, timers):
+        self.size = size
+        self.timeout = timeout
+        self._timers = timers
+        self._requests = deque()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def hold(self, command, priority=PRIORITY_INTERACTIVE, source=None, timeout=None, traceId=None):
+        """
+        Returns a deferred which fires with the result of the command once it has been sent, or NO_DEVICE_FOUND right
+        away if the outbox is full.
+        """
+        if self._count >= self.size:
+            return succeed(NO_DEVICE_FOUND)
+        
+        request = QueuedRequest(command, None, priority, source, timeout, traceId)
+        request.deferred = Deferred(lambda ignored: self._cancel(request))
+        request.timer = self._timers.schedule(self.timeout, self._expire, request)
+        
+        self._requests.append(request)
+        self._count += 1
+        return request.deferred
+
+    def _cancel(self, request):
+        if request.sent:
+            request.forwarded.cancel()
+        elif not request.cancelled:
+            request.cancelled = True
+            request.timer.cancel()
+            self._count -= 1
+
+    def _expire(self, request):
+        if not request.cancelled:
+            request.cancelled = True
+            self._count -= 1
+            request.deferred.callback(NO_DEVICE_FOUND)
+
+    def flush(self, device):
+        """
+        Sends every command which is still waiting to the device in order, each caller gets the result of its own.
+        """
+        requests = self._requests
+        self._requests = deque()
+        self._count = 0
+        
+        for request in requests:
+            if request.cancelled:
+                continue
+            
+            request.timer.cancel()
+            request.sent = True
+            request.forwarded = device.sendCommand(request.line, request.priority, request.source, request.timeout, request.traceId)
+            request.forwarded.chainDeferred(request.deferred)
+
+class ResponseCache(object):
+    """
+    A cache of device responses keyed by command, each entry expires after its own TTL. Any invalidation bumps
+    L{generation} so a response to a query which was sent before the invalidation isn't stored afterwards.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, command):
+        """
+        Returns the cached response for command or None if there isn't a fresh one.
+        """
+        entry = self._entries.get(command)
+        if entry is not None:
+            expires, response = entry
+            if expires > _reactor.seconds():
+                self.hits += 1
+                return response
+            del self._entries[command]
+        
+        self.misses += 1
+        return None
+
+    def put(self, command, response, ttl, generation):
+        if generation == self.generation:
+            self._entries[command] = (_reactor.seconds() + ttl, response)
+
+    def invalidate(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class Histogram(object):
+    """
+    Counts observed values (in seconds) into fixed L{buckets}, Prometheus style. Observing is a bisect and a few
+    additions so it's cheap enough for every command.
+    """
+    
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulativeCounts(self):
+        """
+        Returns a list of (upper bound, number of values <= upper bound) pairs, ending with ('+Inf', count).
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class DeviceMetrics(object):
+    """
+    The metrics of a single device ID. They're kept by the L{Metrics} rather than the protocol so they carry on counting
+    when the device reconnects.
+    """
+
+    def __init__(self):
+        self.queueTime = Histogram()
+        self.responseTime = Histogram()
+        self.timeouts = 0
+        self.noDeviceFound = 0
+        self.events = 0
+
+class Metrics(object):
+    """
+    Counters and histograms for the whole server: per device L{DeviceMetrics}, how long each macro takes to run and how
+    long each web route takes to answer. Everything runs in the reactor thread so these are plain attributes.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.macroDurations = {}
+        self.webLatency = {}
+
+    def device(self, deviceId):
+        if deviceId not in self.devices:
+            self.devices[deviceId] = DeviceMetrics()
+        return self.devices[deviceId]
+
+    def observeMacro(self, macroId, seconds):
+        if macroId not in self.macroDurations:
+            self.macroDurations[macroId] = Histogram()
+        self.macroDurations[macroId].observe(seconds)
+
+    def observeRequest(self, route, seconds):
+        if route not in self.webLatency:
+            self.webLatency[route] = Histogram()
+        self.webLatency[route].observe(seconds)
+
 class DeviceServerProtocol(QueuedLineSender):
     """
     A protocol for the server side of the device client communication. It represents a Device Client on the server
     side and is used to send commands to (and return responses from) the device which it represents.
+    
+    Clients which open with L{LINK_HELLO} use the framed link: responses are matched to their request by ID so a late
+    answer to a timed out command or an event which arrives while a command is outstanding can't be mistaken for the
+    response. Older clients just send their device ID and get the line protocol, where any line which arrives while a
+    command is waiting counts as its response.
+    
+    A framed client can register several devices, one per channel. The protocol which owns the connection handles the
+    device on channel 0 itself and creates another (unconnected) one for every other channel, which writes its frames to
+    the same transport. Losing the connection unregisters all of them and answers their outstanding commands with
+    DISCONNECTED straight away.
+    
+    Framed connections send heartbeats every L{heartbeatInterval} seconds and are dropped if nothing is heard from the
+    client for L{heartbeatMisses} intervals, rather than leaving every command to wait for its own timeout.
+    
+    Responses to queries with a TTL in L{cacheTtls} are answered from L{responseCache} while they're fresh. Sending
+    any other (non-query) command or receiving an unsolicited line means the device state may have changed so the
+    whole cache is dropped.
+    
+    If the device's driver has a reduceState(state, line, command) function then every unsolicited line (with a command
+    of None) and command response is run through it to keep L{state} up to date.
     """
     
     timeout = 60
+    heartbeatInterval = 1
+    heartbeatMisses = 3
+    cacheTtls = {}
+    stateReducer = None
+    traceHop = 'server'
     
     def __init__(self, eventCallback, commandCallback):
         QueuedLineSender.__init__(self)
+        self.responseCache = ResponseCache()
+        self.state = {}
         self.deviceId = None
+        self.framed = False
+        self.channel = 0
+        self._channels = {}
+        self._link = None
+        self._decoder = None
+        self._heartbeat = None
+        self._lastRequestId = 0
+        self._pendingRequestId = None
         self._eventCallback = eventCallback
         self._commandCallback = commandCallback
     
     def lineReceived(self, line):
         if not self.deviceId:
+            if line == LINK_HELLO:
+                # the rest of the connection is framed
+                self.framed = True
+                self._decoder = FrameDecoder()
+                self._heartbeat = Heartbeat(self._sendPing, self._clientDead, self.heartbeatInterval, self.heartbeatMisses)
+                self._heartbeat.start()
+                self.setRawMode()
+                return
+            
             self.deviceId = line
             self.factory.addDevice(self)
         else:
             QueuedLineSender.lineReceived(self, line)
 
+    def rawDataReceived(self, data):
+        self._heartbeat.received()
+        
+        try:
+            frames = self._decoder.feed(data)
+        except ValueError as e:
+            self.log.error("Dropping the connection to device {deviceId}: {error}", deviceId=self.deviceId, error=e)
+            self.transport.loseConnection()
+            return
+        
+        for frameType, channel, requestId, payload in frames:
+            if frameType == FRAME_PING:
+                self.transport.write(encodeFrame(FRAME_PONG, requestId, ''))
+            elif frameType == FRAME_PONG:
+                pass
+            elif frameType == FRAME_HELLO and channel not in self._channels:
+                self._openChannel(channel, payload)
+            elif channel in self._channels:
+                self._channels[channel]._frameReceived(frameType, requestId, payload)
+            else:
+                self.log.debug("Ignoring frame for unknown channel {channel}", channel=channel)
+
+    def _sendPing(self):
+        self.transport.write(encodeFrame(FRAME_PING, 0, ''))
+
+    def _clientDead(self):
+        self.log.warn("No heartbeat from the device client for {deviceIds}, dropping the connection", deviceIds=sorted(x.deviceId for x in self._channels.values()))
+        self.transport.abortConnection()
+
+    def _openChannel(self, channel, deviceId):
+        if channel == 0:
+            device = self
+        else:
+            device = self.factory.buildProtocol(None)
+            device.framed = True
+            device.channel = channel
+            device.makeConnection(self.transport)
+        
+        device._link = self
+        self._channels[channel] = device
+        device.deviceId = deviceId
+        self.factory.addDevice(device)
+
+    def _frameReceived(self, frameType, requestId, payload):
+        if frameType == FRAME_RESPONSE:
+            if self.responseDeferred is not None and requestId == self._pendingRequestId:
+                self._receivedResponse(payload)
+            else:
+                self.log.debug("Ignoring late response {requestId} from device {deviceId}", requestId=requestId, deviceId=self.deviceId)
+        elif frameType == FRAME_EVENT:
+            self._receivedUnsolicitedLine(payload)
+        elif frameType == FRAME_TRACE:
+            self._traceReceived(requestId, payload)
+        else:
+            self.log.debug("Ignoring frame of type {frameType} from device {deviceId}", frameType=frameType, deviceId=self.deviceId)
+
+    def _traceReceived(self, requestId, payload):
+        request = self._current
+        if self.tracer is None or requestId != self._pendingRequestId or request.traceId is None:
+            return
+        
+        try:
+            self.tracer.extend(request.traceId, json.loads(payload))
+        except ValueError:
+            self.log.debug("Ignoring invalid trace from device {deviceId}", deviceId=self.deviceId)
+
+    def _queueRequest(self, request):
+        # the response can only be cached if nothing invalidated the cache after the request was queued
+        request.generation = self.responseCache.generation
+        return QueuedLineSender._queueRequest(self, request)
+
+    def _sendLine(self, line, deferred):
+        if not self.framed:
+            return QueuedLineSender._sendLine(self, line, deferred)
+        
+        self._lastRequestId += 1
+        self._pendingRequestId = self._lastRequestId
+        self.responseDeferred = deferred
+        
+        if self.tracer is not None and self._current.traceId is not None:
+            self.transport.write(encodeFrame(FRAME_TRACE, self._pendingRequestId, self._current.traceId, self.channel))
+        self.transport.write(encodeFrame(FRAME_REQUEST, self._pendingRequestId, line, self.channel))
+
     def _receivedUnsolicitedLine(self, line):
+        self.responseCache.invalidate()
+        self._reduceState(line, None)
         self._runCustomCallback(self._eventCallback, self.deviceId, line)
+        self.factory.publishEvent(self.deviceId, line)
         
         QueuedLineSender._receivedUnsolicitedLine(self, line)
     
     def connectionLost(self, reason):
-        if reason.type is not error.ConnectionAborted:
-            self.factory.removeDevice(self)
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+        
+        if not self._channels:
+            self._channels = {0: self}
+        
+        for device in self._channels.values():
+            if device.deviceId:
+                self.factory.removeDevice(device)
+            device.failPending(DISCONNECTED)
 
     def disconnect(self):
-        self.transport.abortConnection()
+        # on a shared connection only this device's channel is closed
+        if self._link is not None and len(self._link._channels) > 1:
+            del self._link._channels[self.channel]
+        else:
+            self.transport.abortConnection()
 
     @inlineCallbacks
-    def sendCommand(self, command):
-        self.log.debug("Sending command {command} to device {deviceId}", command=command, deviceId=self.deviceId)
-        result = yield self.sendLine(command)
-        self.log.debug("Result of command {command} was '{result}'", command=command, result=result)
+    def sendCommand(self, command, priority=PRIORITY_INTERACTIVE, source=None, timeout=None, traceId=None):
+        ttl = self.cacheTtls.get(command)
+        if ttl:
+            result = self.responseCache.get(command)
+            if result is not None:
+                self.log.debug("Answered command {command} for device {deviceId} from the cache", command=command, deviceId=self.deviceId)
+                if self.tracer is not None:
+                    self.tracer.span(traceId, self.traceHop, 'cached', device=self.deviceId)
+                returnValue(result)
+        elif command not in self.coalesceLines:
+            self.responseCache.invalidate()
+        
+        self.log.debug("Sending command {command!r} to device {deviceId}", command=command, deviceId=self.deviceId)
+        deferred = self.sendLine(command, priority, source, timeout, traceId)
+        
+        # a query which joined an exchange is only as fresh as that exchange, not as the moment this caller arrived
+        exchange = self._exchanges.get(command)
+        generation = exchange.generation if exchange is not None else self.responseCache.generation
+        
+        result = yield deferred
+        self.log.debug("Result of command {command!r} was {result!r}", command=command, result=result)
+        
+        if result not in (TIMEOUT, DISCONNECTED):
+            if ttl:
+                self.responseCache.put(command, result, ttl, generation)
+            self._reduceState(result, command)
         
         self._runCustomCallback(self._commandCallback, self.deviceId, command, result)
         
         returnValue(result)
 
+    def _reduceState(self, line, command):
+        if self.stateReducer is None:
+            return
+        
+        try:
+            self.state = self.stateReducer(self.state, line, command)
+        except Exception:
+            self.log.debug("Unable to update the state of {deviceId} from {line!r}: {trace}", deviceId=self.deviceId, line=line, trace=traceback.format_exc())
+
     def _runCustomCallback(self, func, *args):
         try:
             func(self.factory, *args)
         except:
             self.log.debug(traceback.format_exc())
 
+class MacroRun(object):
+    """
+    A single run of a L{Macro<hamjab.macros.Macro>}: its result so far, the deferreds its steps are waiting on (which
+    get cancelled if the run is) and the trace ID its commands are traced under.
+    """
+
+    def __init__(self, macro, traceId=None):
+        self.macro = macro
+        self.traceId = traceId
+        self.result = SUCCESS
+        self.deferred = None
+        self.pending = set()
+        self.started = _reactor.seconds()
+
+    @inlineCallbacks
+    def wait(self, deferred):
+        self.pending.add(deferred)
+        try:
+            result = yield deferred
+        finally:
+            self.pending.discard(deferred)
+        returnValue(result)
+
 class DeviceServerFactory(protocol.Factory):
     """
     A simple factory for DeviceServerProtocol instances. It instantiates a new instance of the protocol every time a new
     device connects. It also manages the list of devices and is a gateway for sending commands to devices.
+    
+    If L{outboxSize} is set (or a device's device.json has an "outbox" object with a size and timeout) then commands for
+    a device which has disconnected are held in an L{Outbox} and sent when it registers again.
     """
     protocol = DeviceServerProtocol
     log = Logger(observer=printToConsole)
     
-    def __init__(self, macros, eventCallback, commandCallback):
+    outboxSize = 0
+    outboxTimeout = 30
+    
+    def __init__(self, macros, eventCallback, commandCallback, registry=None):
         self.devices = {}
         self.macros = macros
+        self.registry = registry if registry is not None else DeviceRegistry()
         self._eventCallback = eventCallback
         self._commandCallback = commandCallback
+        self._eventListeners = []
+        self._runningGroups = {}
+        self._outboxes = {}
+        self._timeouts = TimerWheel()
+        self.metrics = Metrics()
+        self.tracer = Tracer()
+        self.stateReducers = self._loadStateReducers()
     
     def addDevice(self, protocol):
         if protocol.deviceId in self.devices:
@@ -271,15 +1449,88 @@ class DeviceServerFactory(protocol.Factory):
             protocol.disconnect()
         else:
             self.log.info("Device client with id {deviceId} connected", deviceId=protocol.deviceId)
+            
+            config = self.getDeviceConfig(protocol.deviceId)
+            protocol.coalesceLines = frozenset(x['command'] for x in config.get('queries', []))
+            protocol.cacheTtls = dict((x['command'], x['ttl']) for x in config.get('queries', []) if x.get('ttl'))
+            protocol.stateReducer = self.getStateReducer(protocol.deviceId)
+            protocol.metrics = self.metrics.device(protocol.deviceId)
+            protocol.tracer = self.tracer
+            
             self.devices[protocol.deviceId] = protocol
+            
+            outbox = self._outboxes.pop(protocol.deviceId, None)
+            if outbox:
+                self.log.info("Sending {count} held commands to {deviceId}", count=len(outbox), deviceId=protocol.deviceId)
+                outbox.flush(protocol)
     
     def removeDevice(self, protocol):
-        if protocol.deviceId not in self.devices:
-            self.log.warn("Attempted to unregister device {deviceId} but no device was found", deviceId=protocol.deviceId)
+        if self.devices.get(protocol.deviceId) is not protocol:
+            self.log.warn("Attempted to unregister device {deviceId} but it isn't the registered one", deviceId=protocol.deviceId)
         else:
             self.log.info("Device client with id {deviceId} disconnected", deviceId=protocol.deviceId)
             del self.devices[protocol.deviceId]
+            size, timeout = self.getOutboxSettings(protocol.deviceId)
+            if size:
+                self._outboxes[protocol.deviceId] = Outbox(size, timeout, self._timeouts)
+
+    def getOutboxSettings(self, deviceId):
+        """
+        Returns the (size, timeout) of the outbox for the device, a size of 0 means it doesn't get one.
+        """
+        config = self.getDeviceConfig(deviceId).get('outbox', {})
+        return config.get('size', self.outboxSize), config.get('timeout', self.outboxTimeout)
+
+    def hasOutbox(self, deviceId):
+        return deviceId in self._outboxes
+
+    def addEventListener(self, listener):
+        """
+        Registers listener(deviceId, line) to be called for every unsolicited line from any device.
+        """
+        self._eventListeners.append(listener)
+
+    def removeEventListener(self, listener):
+        self._eventListeners.remove(listener)
+
+    def publishEvent(self, deviceId, line):
+        for listener in self._eventListeners:
+            try:
+                listener(deviceId, line)
+            except Exception:
+                self.log.error("Error in event listener: {trace}", trace=traceback.format_exc())
+
+    def getDeviceConfig(self, deviceId):
+        """
+        Returns the parsed device.json for the given device (from the L{DeviceRegistry}), or an empty dict if there
+        isn't a usable one.
+        """
+        return self.registry.getConfig(deviceId)
+
+    def getStateReducer(self, deviceId):
+        return self.stateReducers.get(deviceId)
+    
+    def _loadStateReducers(self):
+        """
+        Returns the state reducer of every driver which can be imported by device id, a driver which can't be imported
+        (a server without pyserial for instance) doesn't get its state tracked so that's logged.
+        """
+        if findStateReducers is None:
+            self.log.warn("The device drivers aren't available, device state won't be tracked")
+            return {}
         
+        reducers, failures = findStateReducers()
+        for name, error in sorted(failures.items()):
+            self.log.warn("Unable to import the driver {name}, the state of its device won't be tracked: {error}", name=name, error=error)
+        return reducers
+
+    def getDeviceState(self, deviceId):
+        """
+        Returns the last known state of the device as built by its driver's state reducer, or None if it's not connected.
+        """
+        if self.isDeviceRegistered(deviceId):
+            return self.devices[deviceId].state
+
     def isDeviceRegistered(self, deviceId):
         return deviceId in self.devices
         
@@ -293,37 +1544,131 @@ class DeviceServerFactory(protocol.Factory):
         return protocol
 
     @inlineCallbacks
-    def sendCommand(self, deviceId, command):
+    def sendCommand(self, deviceId, command, priority=PRIORITY_INTERACTIVE, source=None, timeout=None, traceId=None):
         device = self.getDevice(deviceId)
-        if not device:
-            returnValue(NO_DEVICE_FOUND)
+        if device:
+            result = yield device.sendCommand(command, priority, source, timeout, traceId)
+        elif deviceId in self._outboxes:
+            self.tracer.span(traceId, 'server', 'held', device=deviceId)
+            result = yield self._outboxes[deviceId].hold(command, priority, source, timeout, traceId)
+        else:
+            result = NO_DEVICE_FOUND
+        
+        if result == NO_DEVICE_FOUND:
+            self.metrics.device(deviceId).noDeviceFound += 1
+            self.tracer.span(traceId, 'server', 'noDevice', device=deviceId)
         
-        result = yield device.sendCommand(command)
         returnValue(result)
 
     @inlineCallbacks
-    def runMacro(self, macroName):
+    def sendCommands(self, commands, priority=PRIORITY_INTERACTIVE, source=None):
+        """
+        Sends a list of (deviceId, command) pairs. Commands for different devices are sent in parallel, commands for the
+        same device are sent one at a time in the order given. Returns a list of the results in the same order as the
+        commands, a command which fails with an exception gets ERROR.
+        """
+        results = [None] * len(commands)
+        
+        byDevice = OrderedDict()
+        for index, (deviceId, command) in enumerate(commands):
+            byDevice.setdefault(deviceId, []).append((index, command))
+        
+        yield DeferredList([self._sendInOrder(deviceId, x, results, priority, source) for deviceId, x in byDevice.items()])
+        returnValue(results)
+
+    @inlineCallbacks
+    def _sendInOrder(self, deviceId, indexedCommands, results, priority, source):
+        for index, command in indexedCommands:
+            try:
+                results[index] = yield self.sendCommand(deviceId, command, priority, source)
+            except Exception as e:
+                self.log.info("Command {command} to device {deviceId} failed: {error}", command=command, deviceId=deviceId, error=e)
+                results[index] = ERROR
+
+    def runMacro(self, macroName, traceId=None):
+        """
+        Runs one of the compiled macros (see L{hamjab.macros}), every step starts as soon as the steps in its after set
+        have finished. Returns a deferred which fires with the first failure (NO_DEVICE_FOUND, TIMEOUT or ERROR) or
+        SUCCESS. Cancelling it drops the macro's commands which haven't been sent yet and fires it with CANCELLED.
+        
+        Starting a macro which is in an exclusivity group cancels the macro from that group which is still running.
+        
+        Every command of the run is traced under traceId (a new one if it isn't given), see L{MacroRun.traceId}.
+        """
+        macro = self.macros[macroName]
         self.log.info("Running macro {macroName}", macroName=macroName)
         
-        for command in self.macros[macroName]['commands']:
+        if macro.group is not None and macro.group in self._runningGroups:
+            running = self._runningGroups[macro.group]
+            self.log.info("Macro {macroName} preempts macro {running}", macroName=macroName, running=running.macro.macroId)
+            running.deferred.cancel()
+        
+        run = MacroRun(macro, traceId or Tracer.newTraceId())
+        self.tracer.span(run.traceId, 'macro', 'started', macro=macroName)
+        run.deferred = Deferred(lambda ignored: self._stopMacro(run))
+        if macro.group is not None:
+            self._runningGroups[macro.group] = run
+        
+        deferreds = []
+        for step in macro.steps:
+            deferreds.append(self._runMacroStep(run, step, [deferreds[x] for x in step.after]))
+        
+        DeferredList(deferreds).addCallback(self._macroFinished, run)
+        return run.deferred
+
+    def _stopMacro(self, run):
+        self.log.info("Cancelling macro {macroName}", macroName=run.macro.macroId)
+        
+        run.result = CANCELLED
+        for deferred in list(run.pending):
+            deferred.cancel()
+        
+        self._macroFinished(None, run)
+
+    def _macroFinished(self, ignored, run):
+        if self._runningGroups.get(run.macro.group) is run:
+            del self._runningGroups[run.macro.group]
+        
+        if not run.deferred.called:
+            self.metrics.observeMacro(run.macro.macroId, _reactor.seconds() - run.started)
+            self.tracer.span(run.traceId, 'macro', 'finished', macro=run.macro.macroId, result=run.result)
+            if run.result == SUCCESS:
+                self.log.info("Finished running macro {macroName}", macroName=run.macro.macroId)
+            run.deferred.callback(run.result)
+
+    @inlineCallbacks
+    def _runMacroStep(self, run, step, dependencies):
+        if dependencies:
+            yield DeferredList(dependencies)
+        
+        # something else in the macro already failed, don't start anything new
+        if run.result != SUCCESS:
+            returnValue(None)
+        
+        deviceId = step.deviceId
+        macroName = run.macro.macroId
+        
+        try:
+            if deviceId == DELAY:
+                self.log.debug("Starting a delay task for {length} seconds", length=step.delay)
+                yield run.wait(deferLater(_reactor, step.delay, lambda: None))
+                returnValue(None)
             
-            deviceId = command['device']
+            try:
+                result = yield run.wait(self.sendCommand(deviceId, step.command, PRIORITY_MACRO, macroName, step.timeout, run.traceId))
+            except CancelledError:
+                raise
+            except Exception as e:
+                self.log.info("Command {command} failed in macro {macroName}: {error}", command=step.command, macroName=macroName, error=e)
+                result = ERROR
             
-            if deviceId == DELAY:
-                length = int(command['command'])
-                self.log.debug("Starting a delay task for {length} seconds", length=length)
-                yield deferLater(reactor, length, lambda x: None, DELAY)
-
-            elif not self.isDeviceRegistered(deviceId):
+            if result == NO_DEVICE_FOUND:
                 self.log.info("Device {device} not online, can't finish macro {macroName}", device=deviceId, macroName=macroName)
-                returnValue(NO_DEVICE_FOUND)
-            
-            else:
-                device = self.getDevice(deviceId)
-                result = yield device.sendCommand(command['command'])
-                if result == (NO_DEVICE_FOUND, TIMEOUT):
-                    self.log.info("Error occurred while running macro {macroName}: {result}", macroName=macroName, result=result)
-                    returnValue(result)
-        
-        self.log.info("Finished running macro {macroName}", macroName=macroName)
-        returnValue(SUCCESS)
+        except CancelledError:
+            returnValue(None)
+        
+        self.tracer.span(run.traceId, 'macro', 'done', device=deviceId, command=step.command, result=result)
+        
+        if result in (NO_DEVICE_FOUND, TIMEOUT, ERROR, DISCONNECTED) and run.result == SUCCESS:
+            self.log.info("Error occurred while running macro {macroName}: {result}", macroName=macroName, result=result)
+            run.result = result
@@ -0,0 +1,293 @@
+import json, os, traceback
+
+from collections import namedtuple
+
+from hamjab.lib import commandSchemas, formatCommand, printToConsole, readDeviceConfig, DELAY
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+from twisted.python.filepath import FilePath
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+# a single precompiled step of a macro. command is the final string to send (or None for a delay), delay is the number
+# of seconds to wait for a DELAY step, timeout overrides the device's timeout and after is the set of indexes of the
+# steps that have to finish first.
+MacroStep = namedtuple('MacroStep', ['deviceId', 'command', 'delay', 'timeout', 'after'])
+
+# group is the name of the macro's exclusivity group (or None), starting a macro cancels the one from its group which
+# is still running
+Macro = namedtuple('Macro', ['macroId', 'name', 'group', 'steps'])
+
+class MacroError(Exception):
+    def __init__(self, errors):
+        Exception.__init__(self, "\n".join(errors))
+        self.errors = errors
+
+class MacroCompiler(object):
+    """
+    Turns the macros from a macro file into L{Macro}s made of immutable L{MacroStep}s, checking everything it can along
+    the way so mistakes show up when the server starts instead of halfway through running a macro. Every problem is
+    collected in L{errors} (or L{warnings} for things which might still work) before L{compile} gives up.
+    
+    A step is either {"device": ..., "command": ...} with a raw command or {"device": ..., "commandId": ..., "args": {...}}
+    which is looked up in the device's device.json and filled in. Steps can have a "timeout" in seconds, an "id" and an
+    "after" list of earlier ids to wait for. See L{hamjab.lib.DeviceServerFactory.runMacro} for how they're run.
+    """
+
+    def __init__(self, getDeviceConfig):
+        self.getDeviceConfig = getDeviceConfig
+        self.errors = []
+        self.warnings = []
+        self._schemas = {}
+
+    def compile(self, macros):
+        """
+        Returns a dict of macro id to L{Macro}, raises L{MacroError} if any of them aren't valid.
+        """
+        if type(macros) is not dict:
+            self.errors.append("The macro file must contain a json object of macro id to macro")
+            raise MacroError(self.errors)
+        
+        result = {}
+        for macroId in sorted(macros):
+            macro = self._compileMacro(macroId, macros[macroId])
+            if macro:
+                result[macroId] = macro
+        
+        if self.errors:
+            raise MacroError(self.errors)
+        return result
+
+    def _compileMacro(self, macroId, macro):
+        if type(macro) is not dict or 'commands' not in macro or type(macro['commands']) is not list:
+            self.errors.append("Macro {macroId}: must be an object with a list of commands".format(macroId=macroId))
+            return None
+        
+        self._steps = []
+        self._ids = {}
+        self._lastOnDevice = {}
+        self._macroId = macroId
+        
+        group = macro.get('group')
+        if group is not None and not isinstance(group, basestring):
+            self.errors.append("Macro {macroId}: group must be a string".format(macroId=macroId))
+        
+        self._addSequence(macro['commands'], frozenset())
+        
+        return Macro(macroId, macro.get('name', macroId), group, tuple(self._steps))
+
+    def _error(self, index, message):
+        self.errors.append("Macro {macroId}, step {index}: {message}".format(macroId=self._macroId, index=index, message=message))
+
+    def _addSequence(self, steps, after):
+        for step in steps:
+            if type(step) is dict and 'parallel' in step:
+                if type(step['parallel']) is not list:
+                    self._error(len(self._steps), "parallel must be a list")
+                    continue
+                
+                ends = set()
+                for branch in step['parallel']:
+                    ends |= self._addSequence(branch if type(branch) is list else [branch], after)
+                after = frozenset(ends)
+            else:
+                index = self._addStep(step, after)
+                if index is not None:
+                    after = frozenset([index])
+        return after
+
+    def _addStep(self, step, after):
+        index = len(self._steps)
+        
+        if type(step) is not dict or 'device' not in step:
+            self._error(index, "must be an object with a device")
+            return None
+        
+        deviceId = step['device']
+        after = set(after)
+        
+        for stepId in step.get('after', ()):
+            if stepId not in self._ids:
+                self._error(index, "waits for unknown step {stepId!r}, only earlier steps can be waited for".format(stepId=stepId))
+            else:
+                after.add(self._ids[stepId])
+        
+        if 'id' in step:
+            if step['id'] in self._ids:
+                self._error(index, "duplicate id {stepId!r}".format(stepId=step['id']))
+            self._ids[step['id']] = index
+        
+        timeout = step.get('timeout')
+        if timeout is not None and (type(timeout) not in (int, float) or timeout <= 0):
+            self._error(index, "timeout must be a positive number of seconds")
+            timeout = None
+        
+        command = delay = None
+        if deviceId == DELAY:
+            try:
+                delay = int(step.get('command'))
+                if delay < 0:
+                    raise ValueError()
+            except (TypeError, ValueError):
+                self._error(index, "DELAY needs a whole number of seconds, not {command!r}".format(command=step.get('command')))
+        else:
+            command = self._resolveCommand(index, deviceId, step)
+            
+            if deviceId in self._lastOnDevice:
+                after.add(self._lastOnDevice[deviceId])
+            self._lastOnDevice[deviceId] = index
+        
+        self._steps.append(MacroStep(deviceId, command, delay, timeout, frozenset(after)))
+        return index
+
+    def _resolveCommand(self, index, deviceId, step):
+        schema = self._getSchema(deviceId)
+        if schema is None:
+            self.warnings.append("Macro {macroId}, step {index}: device {deviceId} has no device.json, its commands can't be checked".format(macroId=self._macroId, index=index, deviceId=deviceId))
+        
+        if 'commandId' not in step:
+            if not isinstance(step.get('command'), basestring):
+                self._error(index, "needs a command or a commandId")
+                return None
+            return step['command']
+        
+        if schema is None:
+            self._error(index, "commandId needs a device with a device.json")
+            return None
+        
+        commandId = step['commandId']
+        if commandId not in schema:
+            self._error(index, "device {deviceId} has no command {commandId!r}".format(deviceId=deviceId, commandId=commandId))
+            return None
+        
+        args = step.get('args', {})
+        if type(args) is not dict:
+            self._error(index, "command {commandId} takes the args {expected}".format(commandId=commandId, expected=sorted(schema[commandId].args)))
+            return None
+        
+        try:
+            return formatCommand(schema[commandId], args)
+        except ValueError as e:
+            self._error(index, "command {commandId} {error}".format(commandId=commandId, error=e))
+            return None
+
+    def _getSchema(self, deviceId):
+        """
+        Returns a dict of command id to L{CommandSchema<hamjab.lib.CommandSchema>} for the device or None if it doesn't
+        have a device.json.
+        """
+        if deviceId not in self._schemas:
+            config = self.getDeviceConfig(deviceId)
+            self._schemas[deviceId] = commandSchemas(config.get('commands', [])) if config else None
+        return self._schemas[deviceId]
+
+def compileMacros(macros, getDeviceConfig):
+    """
+    Compiles the macros with a L{MacroCompiler}, returns (macros, warnings) or raises L{MacroError}.
+    """
+    compiler = MacroCompiler(getDeviceConfig)
+    result = compiler.compile(macros)
+    return result, compiler.warnings
+
+def loadMacroFile(path, getDeviceConfig=readDeviceConfig):
+    """
+    Reads and compiles a macro file, returns (macros, warnings) or raises L{MacroError}.
+    """
+    try:
+        with open(path) as macro_file:
+            macros = json.load(macro_file)
+    except (IOError, ValueError) as e:
+        raise MacroError(["Unable to read {path}: {error}".format(path=path, error=e)])
+    
+    return compileMacros(macros, getDeviceConfig)
+
+class MacroFileWatcher(object):
+    """
+    Watches a macro file and swaps a freshly compiled macro table into the factory whenever it changes. Changes are
+    picked up with inotify where it's available and by polling the file's mtime every L{interval} seconds otherwise.
+    
+    The table is replaced in one assignment so a macro which is already running finishes with the steps it started with.
+    A file with errors is logged and ignored, the old macros stay in place until it's fixed.
+    """
+    interval = 2
+    
+    log = Logger(observer=printToConsole)
+
+    def __init__(self, path, factory, getDeviceConfig=readDeviceConfig, clock=reactor):
+        self.path = path
+        self.factory = factory
+        self.getDeviceConfig = getDeviceConfig
+        self.clock = clock
+        self._mtime = self._getMtime()
+        self._failedMtime = None
+        self._poller = None
+        self._notifier = None
+
+    def start(self):
+        if inotify is not None and self.clock is reactor:
+            try:
+                self._notifier = inotify.INotify()
+                self._notifier.startReading()
+                self._notifier.watch(FilePath(os.path.dirname(os.path.abspath(self.path))),
+                                     mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE,
+                                     callbacks=[self._fileChanged])
+                return
+            except Exception:
+                self.log.debug("inotify isn't usable, polling {path} instead: {trace}", path=self.path, trace=traceback.format_exc())
+                self._notifier = None
+        
+        self._poller = LoopingCall(self.check)
+        self._poller.clock = self.clock
+        self._poller.start(self.interval, now=False)
+
+    def stop(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+    def _fileChanged(self, ignored, filepath, mask):
+        if filepath.basename() == os.path.basename(self.path):
+            self.check()
+
+    def _getMtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def check(self):
+        """
+        Reloads the macros if the file's mtime has changed since the last load, returns True if the macros were swapped.
+        
+        The mtime is only recorded once the file loads, a file which was caught half written is tried again even if the
+        rest of it is written within the same mtime tick. The errors are only logged the first time for each mtime.
+        """
+        mtime = self._getMtime()
+        if mtime is None or mtime == self._mtime:
+            return False
+        
+        try:
+            macros, warnings = loadMacroFile(self.path, self.getDeviceConfig)
+        except MacroError as e:
+            if mtime != self._failedMtime:
+                self.log.error("Not reloading macros from {path}:\n  {errors}", path=self.path, errors="\n  ".join(e.errors))
+            self._failedMtime = mtime
+            return False
+        
+        self._mtime = mtime
+        self._failedMtime = None
+        
+        for warning in warnings:
+            self.log.warn(warning)
+        
+        self.factory.macros = macros
+        self.log.info("Reloaded {count} macros from {path}", count=len(macros), path=self.path)
+        return True
@@ -54,7 +54,7 @@ var pollForStatus = function() {
         pollTimeout = setTimeout(pollForStatus, pollTimeoutSec*1000);
     };
     
-    sendCommand("PWR?", callback);
+    sendCommand("PWR?", callback, 'poll');
 };
 
 var setLights = function(curPowerStatus) {
@@ -86,9 +86,11 @@ var setLights = function(curPowerStatus) {
     powerStatus = curPowerStatus;
 };
 
-var sendCommand = function(command, success) {
+var sendCommand = function(command, success, priority) {
     var url = '../sendCommand';
     var data = { fromClient: 'webGui', command: command }
+    if (priority !== undefined)
+        data.priority = priority;
     $.post(url, data, function(data) {
         if (success !== undefined)
             success(data);
@@ -49,13 +49,29 @@ $(document).ready(function() {
     
     sendCommand(':G', handleSceneSelect);
     
-    requestUnsolicited();
+    if (window.EventSource !== undefined) {
+        listenForEvents();
+    }
+    else {
+        requestUnsolicited();
+    }
 });
 
+var listenForEvents = function() {
+    var events = new EventSource('../events');
+    events.onmessage = function(e) {
+        handleSceneSelect(JSON.parse(e.data).data);
+    };
+};
+
+var lastEvent = 0;
 var requestUnsolicited = function() {
     var url = '../getUnsolicited';
-    $.get(url, function(data) {
-        handleSceneSelect(data);
+    $.get(url, { since: lastEvent }, function(data) {
+        $.each(data.events, function(i, e) {
+            handleSceneSelect(e.data);
+        });
+        lastEvent = data.last;
         requestUnsolicited();
     })
     .fail(function() {
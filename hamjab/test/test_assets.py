@@ -0,0 +1,75 @@
+import gzip, os
+
+from io import BytesIO
+
+from hamjab.assets import acceptedEncodings, compressAssets, AssetIndex
+from twisted.trial import unittest
+
+class AssetIndexTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.root = os.path.abspath(self.mktemp())
+        self._write('home/code.js', 'var x = 1;\n' * 100)
+        self._write('home/index.html', '<script src="code.js"></script><a href="../help/index.html">help</a><a href="http://example.com/a.js">x</a>')
+        self._write('help/index.html', '<script src="/home/code.js"></script><script src="missing.js"></script>')
+        self.assets = AssetIndex(self.root)
+    
+    def _write(self, path, data, mtime=None):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as assetFile:
+            assetFile.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+    
+    def test_versioned_urls(self):
+        version = self.assets.version(os.path.join(self.root, 'home', 'code.js'))
+        
+        home = self.assets.get(os.path.join(self.root, 'home', 'index.html')).data
+        self.assertIn('src="code.js?v={version}"'.format(version=version), home)
+        self.assertIn('href="../help/index.html"', home)
+        self.assertIn('href="http://example.com/a.js"', home)
+        
+        help = self.assets.get(os.path.join(self.root, 'help', 'index.html')).data
+        self.assertIn('src="/home/code.js?v={version}"'.format(version=version), help)
+        self.assertIn('src="missing.js"', help)
+    
+    def test_compressed(self):
+        asset = self.assets.get(os.path.join(self.root, 'home', 'code.js'))
+        
+        data, encoding = asset.negotiate('gzip, deflate')
+        self.assertEqual('gzip', encoding)
+        self.assertEqual(asset.data, gzip.GzipFile(fileobj=BytesIO(data)).read())
+        self.assertNotEqual(asset.etag(), asset.etag(encoding))
+        
+        self.assertEqual((asset.data, None), asset.negotiate('gzip;q=0, identity'))
+        self.assertEqual((asset.data, None), asset.negotiate(None))
+    
+    def test_precompressed(self):
+        path = os.path.join(self.root, 'home', 'code.js')
+        self.assertIn(path + '.gz', compressAssets(self.root))
+        self._write('home/code.js.gz', 'precompressed', os.stat(path).st_mtime + 1)
+        
+        asset = self.assets.get(path)
+        self.assertEqual(('precompressed', 'gzip'), asset.negotiate('gzip'))
+    
+    def test_reload(self):
+        path = os.path.join(self.root, 'home', 'code.js')
+        asset = self.assets.get(path)
+        self.assertIdentical(asset, self.assets.get(path))
+        
+        self._write('home/code.js', 'var y;', 1000)
+        self.assertEqual('var y;', self.assets.get(path).data)
+        self.assertNotEqual(asset.version, self.assets.get(path).version)
+        
+        os.remove(path)
+        self.assertIdentical(None, self.assets.get(path))
+    
+    def test_load(self):
+        compressAssets(self.root)
+        self.assertEqual(3, self.assets.load())
+    
+    def test_accepted_encodings(self):
+        self.assertEqual(set(['gzip', 'br']), acceptedEncodings('gzip, deflate;q=0, BR;q=0.5'))
+        self.assertEqual(set(), acceptedEncodings(''))
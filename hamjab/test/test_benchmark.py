@@ -0,0 +1,24 @@
+from hamjab.benchmark import compareToBaseline, percentile, summarize
+from twisted.trial import unittest
+
+class BenchmarkTestCase(unittest.TestCase):
+    
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(99, percentile(values, 99))
+        self.assertEqual(7, percentile([7], 99))
+        self.assertIdentical(None, percentile([], 50))
+    
+    def test_summarize(self):
+        self.assertEqual({'count': 2, 'errors': 1, 'p50': 0.1, 'p99': 0.2}, summarize([0.2, 0.1], 1))
+    
+    def test_compare(self):
+        baseline = {'throughput': 100, 'sendCommand': {'p50': 0.01, 'p99': 0.1}, 'maxRssMb': 50}
+        
+        self.assertEqual([], compareToBaseline({'throughput': 90, 'sendCommand': {'p50': 0.011, 'p99': 0.05}, 'maxRssMb': 55}, baseline))
+        
+        regressions = compareToBaseline({'throughput': 70, 'sendCommand': {'p50': 0.01, 'p99': 0.2}, 'macro': {'p50': 1}}, baseline)
+        self.assertEqual(2, len(regressions))
+        self.assertIn('throughput', regressions[0])
+        self.assertIn('sendCommand.p99', regressions[1])
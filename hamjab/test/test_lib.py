@@ -1,6 +1,13 @@
+import json, os, time
+
+from collections import deque
+
 from hamjab import lib
-from hamjab.lib import QueuedLineSender
+from hamjab.lib import commandSchemas, encodeFrame, formatCommand, readDeviceConfig, CommandSchema, DeviceClientProtocol, DeviceRegistry, DeviceServerFactory, DeviceServerProtocol, FrameDecoder, QueuedLineSender, CommandQueue, QueuedRequest, TimerWheel, PRIORITY_MACRO, PRIORITY_INTERACTIVE, PRIORITY_POLL
+from hamjab.macros import compileMacros
+from twisted.internet.defer import Deferred
 from twisted.internet.task import Clock
+from twisted.logger import Logger, LogLevel
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
@@ -11,10 +18,10 @@ class QueuedLineSenderTestCase(unittest.TestCase):
         self.transport = proto_helpers.StringTransport()
         self.protocol.makeConnection(self.transport)
         
-        self._reactor = hamjab.lib._reactor
+        self._reactor = lib._reactor
     
     def tearDown(self):
-        hamjab.lib._reactor = self._reactor
+        lib._reactor = self._reactor
     
     def test_commands_queueing(self):
         d = self.protocol.sendLine('test1')
@@ -56,7 +63,7 @@ class QueuedLineSenderTestCase(unittest.TestCase):
 
     def test_simple_command_timeout(self):
         
-        hamjab.lib._reactor = Clock()
+        lib._reactor = Clock()
         
         d = self.protocol.sendLine('test')
         self.assertEqual('test\r', self.transport.value())
@@ -66,7 +73,7 @@ class QueuedLineSenderTestCase(unittest.TestCase):
         self.protocol.dataReceived('an')
         self.protocol.dataReceived('swer')
 
-        hamjab.lib._reactor.advance(self.protocol.timeout)
+        lib._reactor.advance(self.protocol.timeout)
         
         return d
 
@@ -78,3 +85,1099 @@ class QueuedLineSenderTestCase(unittest.TestCase):
         self.protocol.dataReceived('data\r')
 
         return d
+
+    def test_priority_order(self):
+        lib._reactor = Clock()
+        
+        self.protocol.sendLine('first')
+        self.transport.clear()
+        
+        poll = self.protocol.sendLine('poll', PRIORITY_POLL)
+        interactive = self.protocol.sendLine('interactive', PRIORITY_INTERACTIVE)
+        macro = self.protocol.sendLine('macro', PRIORITY_MACRO)
+        
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('macro\r', self.transport.value())
+        self.transport.clear()
+        
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('interactive\r', self.transport.value())
+        self.transport.clear()
+
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('poll\r', self.transport.value())
+
+    def test_cancel_queued(self):
+        lib._reactor = Clock()
+        
+        self.protocol.sendLine('first')
+        self.transport.clear()
+        
+        d = self.protocol.sendLine('second')
+        self.protocol.sendLine('third')
+        d.addErrback(lambda x: None)
+        d.cancel()
+        self.assertEqual(1, len(self.protocol._requests))
+        
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('third\r', self.transport.value())
+
+    def test_cancel_sent(self):
+        lib._reactor = Clock()
+        
+        d = self.protocol.sendLine('first')
+        self.protocol.sendLine('second')
+        self.transport.clear()
+        
+        d.addErrback(lambda x: None)
+        d.cancel()
+        
+        # the answer to the cancelled line still has to arrive before the next one goes out
+        self.assertEqual('', self.transport.value())
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('second\r', self.transport.value())
+    
+    def test_cancel_sent_keeps_timeout(self):
+        lib._reactor = Clock()
+        
+        d = self.protocol.sendLine('first')
+        self.protocol.sendLine('second')
+        self.transport.clear()
+        
+        d.addErrback(lambda x: None)
+        d.cancel()
+        lib._reactor.advance(self.protocol.timeout)
+        self.assertEqual('second\r', self.transport.value())
+
+    def test_timeout_starts_when_sent(self):
+        lib._reactor = Clock()
+        
+        d = self.protocol.sendLine('test1')
+        d.addCallback(self.assertEqual, 'answer')
+        lib._reactor.advance(self.protocol.timeout - 1)
+        
+        d2 = self.protocol.sendLine('test2')
+        self.protocol.dataReceived('answer\r')
+        
+        # test2 has been queued for longer than the timeout but was only just sent
+        lib._reactor.advance(self.protocol.timeout - 1)
+        self.assertFalse(d2.called)
+        
+        d2.addCallback(self.assertEqual, 'TIMEOUT')
+        lib._reactor.advance(1)
+        
+        return d2
+
+    def test_one_delayed_call(self):
+        lib._reactor = Clock()
+        
+        for i in range(20):
+            self.protocol.sendLine('test')
+            self.protocol.getUnsolicitedData()
+        
+        self.assertEqual(1, len(lib._reactor.getDelayedCalls()))
+
+    def test_coalesce_queued(self):
+        lib._reactor = Clock()
+        self.protocol.coalesceLines = frozenset(['PWR?'])
+        
+        self.protocol.sendLine('first')
+        self.transport.clear()
+        
+        d = self.protocol.sendLine('PWR?', PRIORITY_POLL)
+        d2 = self.protocol.sendLine('PWR?', PRIORITY_POLL)
+        self.assertEqual(1, len(self.protocol._requests))
+        
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('PWR?\r', self.transport.value())
+        self.protocol.dataReceived('PWR=01\r')
+        
+        self.assertEqual('PWR=01', self.successResultOf(d))
+        self.assertEqual('PWR=01', self.successResultOf(d2))
+
+    def test_coalesce_in_flight(self):
+        self.protocol.coalesceLines = frozenset(['PWR?'])
+        
+        d = self.protocol.sendLine('PWR?')
+        self.transport.clear()
+        d2 = self.protocol.sendLine('PWR?')
+        self.assertEqual('', self.transport.value())
+        
+        self.protocol.dataReceived('PWR=01\r')
+        self.assertEqual('PWR=01', self.successResultOf(d))
+        self.assertEqual('PWR=01', self.successResultOf(d2))
+        
+        # the exchange is finished so the next query goes to the device again
+        d3 = self.protocol.sendLine('PWR?')
+        self.assertEqual('PWR?\r', self.transport.value())
+        self.protocol.dataReceived('PWR=00\r')
+        self.assertEqual('PWR=00', self.successResultOf(d3))
+
+    def test_coalesce_traced(self):
+        self.protocol.coalesceLines = frozenset(['PWR?'])
+        self.protocol.tracer = lib.Tracer()
+        
+        d = self.protocol.sendLine('PWR?', traceId='abc')
+        d2 = self.protocol.sendLine('PWR?', traceId='def')
+        
+        self.protocol.dataReceived('PWR=01\r')
+        self.assertEqual('PWR=01', self.successResultOf(d))
+        self.assertEqual('PWR=01', self.successResultOf(d2))
+        
+        spans = self.protocol.tracer.get('def')
+        self.assertEqual(['coalesced'], [x['span'] for x in spans])
+        self.assertEqual('abc', spans[0]['joinedTraceId'])
+
+    def test_coalesce_only_configured(self):
+        lib._reactor = Clock()
+        self.protocol.coalesceLines = frozenset(['PWR?'])
+        
+        self.protocol.sendLine('PWR ON')
+        self.protocol.sendLine('PWR ON')
+        self.assertEqual(1, len(self.protocol._requests))
+
+    def test_coalesce_cancel_waiter(self):
+        lib._reactor = Clock()
+        self.protocol.coalesceLines = frozenset(['PWR?'])
+        
+        self.protocol.sendLine('first')
+        self.transport.clear()
+        
+        d = self.protocol.sendLine('PWR?')
+        d2 = self.protocol.sendLine('PWR?')
+        d.addErrback(lambda x: None)
+        d.cancel()
+        self.assertEqual(1, len(self.protocol._requests))
+        
+        # once the last waiter is gone the query is dropped from the queue
+        d2.addErrback(lambda x: None)
+        d2.cancel()
+        self.assertEqual(0, len(self.protocol._requests))
+        
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('', self.transport.value())
+
+    def test_coalesce_higher_priority(self):
+        lib._reactor = Clock()
+        self.protocol.coalesceLines = frozenset(['PWR?'])
+        
+        self.protocol.sendLine('first')
+        self.transport.clear()
+        
+        self.protocol.sendLine('PWR?', PRIORITY_POLL)
+        self.protocol.sendLine('other', PRIORITY_INTERACTIVE)
+        self.protocol.sendLine('PWR?', PRIORITY_MACRO)
+        self.assertEqual(3, len(self.protocol._requests))
+        
+        self.protocol.dataReceived('answer\r')
+        self.assertEqual('PWR?\r', self.transport.value())
+
+    def test_unsolicited_events_buffered(self):
+        self.protocol.dataReceived('one\rtwo\rthree\r')
+        
+        self.assertEqual([(1, 'one'), (2, 'two'), (3, 'three')], self.successResultOf(self.protocol.getUnsolicitedEvents(0)))
+        self.assertEqual([(3, 'three')], self.successResultOf(self.protocol.getUnsolicitedEvents(2)))
+
+    def test_unsolicited_events_wait(self):
+        self.protocol.dataReceived('one\r')
+        
+        d = self.protocol.getUnsolicitedEvents(1)
+        self.assertNoResult(d)
+        
+        self.protocol.dataReceived('two\r')
+        self.assertEqual([(2, 'two')], self.successResultOf(d))
+
+    def test_unsolicited_events_timeout(self):
+        lib._reactor = Clock()
+        
+        d = self.protocol.getUnsolicitedEvents(0)
+        lib._reactor.advance(self.protocol.timeout)
+        self.assertEqual([], self.successResultOf(d))
+
+    def test_unsolicited_events_overflow(self):
+        self.protocol._events = deque(maxlen=2)
+        self.protocol.dataReceived('one\rtwo\rthree\r')
+        
+        self.assertEqual([(2, 'two'), (3, 'three')], self.protocol.getBufferedEvents(0))
+        
+        # a sequence number from before a reconnect gets everything
+        self.assertEqual([(2, 'two'), (3, 'three')], self.protocol.getBufferedEvents(50))
+
+class TimerWheelTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self._reactor = lib._reactor
+        self.clock = lib._reactor = Clock()
+        self.wheel = TimerWheel()
+        self.expired = []
+    
+    def tearDown(self):
+        lib._reactor = self._reactor
+    
+    def test_batch_expiry(self):
+        self.wheel.schedule(5, self.expired.append, 'a')
+        self.clock.advance(0.5)
+        self.wheel.schedule(4.5, self.expired.append, 'b')
+        self.wheel.schedule(10, self.expired.append, 'c')
+        
+        self.assertEqual(3, len(self.wheel))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        
+        self.clock.advance(4.5)
+        self.assertEqual(['a', 'b'], self.expired)
+        
+        self.clock.advance(5)
+        self.assertEqual(['a', 'b'], self.expired)
+        self.clock.advance(1)
+        self.assertEqual(['a', 'b', 'c'], self.expired)
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual([], self.clock.getDelayedCalls())
+    
+    def test_rounds_up(self):
+        self.clock.advance(0.2)
+        self.wheel.schedule(1, self.expired.append, 'a')
+        
+        self.clock.advance(1)
+        self.assertEqual([], self.expired)
+        self.clock.advance(0.8)
+        self.assertEqual(['a'], self.expired)
+    
+    def test_earlier_deadline_rearms(self):
+        self.wheel.schedule(10, self.expired.append, 'late')
+        self.wheel.schedule(2, self.expired.append, 'early')
+        
+        self.clock.advance(2)
+        self.assertEqual(['early'], self.expired)
+    
+    def test_cancel(self):
+        entry = self.wheel.schedule(5, self.expired.append, 'a')
+        self.wheel.schedule(5, self.expired.append, 'b')
+        entry.cancel()
+        
+        self.clock.advance(5)
+        self.assertEqual(['b'], self.expired)
+    
+    def test_cancel_all_drops_delayed_call(self):
+        entries = [self.wheel.schedule(x, self.expired.append, x) for x in range(1, 5)]
+        for entry in entries:
+            entry.cancel()
+        
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+class CommandQueueTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.queue = CommandQueue()
+    
+    def _push(self, line, priority=PRIORITY_INTERACTIVE, source=None):
+        request = QueuedRequest(line, None, priority, source)
+        self.queue.push(request)
+        return request
+    
+    def _popAll(self):
+        result = []
+        while self.queue:
+            result.append(self.queue.pop().line)
+        return result
+    
+    def test_empty(self):
+        self.assertEqual(0, len(self.queue))
+        self.assertEqual(None, self.queue.pop())
+    
+    def test_fifo_in_class(self):
+        for line in ('a', 'b', 'c'):
+            self._push(line)
+        self.assertEqual(['a', 'b', 'c'], self._popAll())
+    
+    def test_priority_classes(self):
+        self._push('poll', PRIORITY_POLL)
+        self._push('interactive', PRIORITY_INTERACTIVE)
+        self._push('macro', PRIORITY_MACRO)
+        self.assertEqual(['macro', 'interactive', 'poll'], self._popAll())
+    
+    def test_round_robin_sources(self):
+        for line in ('a1', 'a2', 'a3'):
+            self._push(line, PRIORITY_POLL, 'tabA')
+        self._push('b1', PRIORITY_POLL, 'tabB')
+        self._push('c1', PRIORITY_POLL, 'tabC')
+        self.assertEqual(['a1', 'b1', 'c1', 'a2', 'a3'], self._popAll())
+    
+    def test_remove(self):
+        self._push('a')
+        b = self._push('b')
+        self._push('c')
+        self.queue.remove(b)
+        self.queue.remove(b)
+        self.assertEqual(2, len(self.queue))
+        self.assertEqual(['a', 'c'], self._popAll())
+    
+    def _timeOperations(self, size):
+        """
+        Fills a queue with size requests and returns the best time (of a few runs) to push, remove and pop a fixed
+        number of requests on top of that.
+        """
+        best = None
+        for run in range(3):
+            queue = CommandQueue()
+            for i in xrange(size):
+                queue.push(QueuedRequest('fill', None, i % 3, i % 7))
+            
+            extra = [QueuedRequest('extra', None, i % 3, i % 7) for i in xrange(2000)]
+            
+            start = time.time()
+            for request in extra:
+                queue.push(request)
+            for request in extra[::2]:
+                queue.remove(request)
+            for i in xrange(2000):
+                queue.pop()
+            elapsed = time.time() - start
+            
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+    
+    def test_operations_constant_time(self):
+        small = self._timeOperations(1000)
+        large = self._timeOperations(100000)
+        
+        # an O(n) remove/pop would be ~100 times slower on the large queue, leave lots of room for timing noise
+        self.assertTrue(large < small * 10, "push/remove/pop got slower with queue size: {0} vs {1}".format(small, large))
+
+class DeviceServerFactoryTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self._reactor = lib._reactor
+        self.clock = lib._reactor = Clock()
+        self.factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+    
+    def tearDown(self):
+        lib._reactor = self._reactor
+    
+    def _connect(self, deviceId):
+        protocol = self.factory.buildProtocol(None)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(deviceId + '\r')
+        protocol.transport.clear()
+        return protocol
+    
+    def _query(self, protocol, command, response):
+        d = self.factory.sendCommand(protocol.deviceId, command)
+        if protocol.transport.value():
+            protocol.transport.clear()
+            protocol.dataReceived(response + '\r')
+        return self.successResultOf(d)
+    
+    def test_device_config(self):
+        config = self.factory.getDeviceConfig('epson_5030ub')
+        self.assertEqual('epson_5030ub', config['id'])
+        self.assertEqual({}, self.factory.getDeviceConfig('no_such_device'))
+    
+    def test_coalesce_lines_from_config(self):
+        protocol = self._connect('epson_5030ub')
+        self.assertTrue(self.factory.isDeviceRegistered('epson_5030ub'))
+        self.assertEqual(frozenset(['PWR?']), protocol.coalesceLines)
+    
+    def test_cache_ttl(self):
+        protocol = self._connect('epson_5030ub')
+        self.assertEqual({'PWR?': 2}, protocol.cacheTtls)
+        
+        self.assertEqual('PWR=01', self._query(protocol, 'PWR?', 'PWR=01'))
+        self.assertEqual('PWR=01', self._query(protocol, 'PWR?', 'PWR=00'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'size': 1}, protocol.responseCache.stats())
+        
+        self.clock.advance(2)
+        self.assertEqual('PWR=00', self._query(protocol, 'PWR?', 'PWR=00'))
+    
+    def test_cache_invalidated_by_write(self):
+        protocol = self._connect('epson_5030ub')
+        
+        self._query(protocol, 'PWR?', 'PWR=00')
+        self._query(protocol, 'PWR ON', 'OK')
+        self.assertEqual('PWR=01', self._query(protocol, 'PWR?', 'PWR=01'))
+    
+    def test_cache_invalidated_by_unsolicited(self):
+        protocol = self._connect('epson_5030ub')
+        
+        self._query(protocol, 'PWR?', 'PWR=00')
+        protocol.dataReceived('something happened\r')
+        self.assertEqual('PWR=01', self._query(protocol, 'PWR?', 'PWR=01'))
+    
+    def test_cache_ignores_stale_response(self):
+        protocol = self._connect('epson_5030ub')
+        
+        d = self.factory.sendCommand('epson_5030ub', 'PWR?')
+        d2 = self.factory.sendCommand('epson_5030ub', 'PWR ON')
+        protocol.dataReceived('PWR=00\r')
+        protocol.dataReceived('OK\r')
+        self.assertEqual('PWR=00', self.successResultOf(d))
+        self.assertEqual('OK', self.successResultOf(d2))
+        
+        # the power state read before PWR ON went out mustn't be served afterwards
+        self.assertEqual(0, len(protocol.responseCache))
+    
+    def test_cache_ignores_joined_stale_response(self):
+        protocol = self._connect('epson_5030ub')
+        
+        d = self.factory.sendCommand('epson_5030ub', 'PWR?')
+        d2 = self.factory.sendCommand('epson_5030ub', 'PWR ON')
+        d3 = self.factory.sendCommand('epson_5030ub', 'PWR?')
+        protocol.dataReceived('PWR=00\r')
+        protocol.dataReceived('OK\r')
+        self.assertEqual('PWR=00', self.successResultOf(d))
+        self.assertEqual('OK', self.successResultOf(d2))
+        
+        # the second query joined the one sent before PWR ON so its answer is just as stale
+        self.assertEqual('PWR=00', self.successResultOf(d3))
+        self.assertEqual(0, len(protocol.responseCache))
+        protocol.transport.clear()
+        self.assertEqual('PWR=01', self._query(protocol, 'PWR?', 'PWR=01'))
+    
+    def test_state_reducer(self):
+        protocol = self._connect('epson_5030ub')
+        self.assertNotEqual(None, protocol.stateReducer)
+        
+        self._query(protocol, 'PWR?', 'PWR=01')
+        self.assertEqual({'PWR': '01'}, self.factory.getDeviceState('epson_5030ub'))
+        
+        protocol.dataReceived('LAMP=1200\r')
+        self.assertEqual({'PWR': '01', 'LAMP': '1200'}, self.factory.getDeviceState('epson_5030ub'))
+    
+    def test_state_reducers_loaded_once(self):
+        events = []
+        reduceState = lambda state, line, command=None: state
+        self.patch(lib, 'findStateReducers', lambda: ({'epson_5030ub': reduceState}, {'sony_vpl_hw30es': ImportError('No module named serial')}))
+        self.patch(DeviceServerFactory, 'log', Logger(observer=events.append))
+        
+        factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+        self.assertEqual(['sony_vpl_hw30es'], [x['name'] for x in events if x['log_level'] == LogLevel.warn])
+        
+        self.patch(lib, 'findStateReducers', None)
+        self.assertIdentical(reduceState, factory.getStateReducer('epson_5030ub'))
+        self.assertEqual(None, factory.getStateReducer('sony_vpl_hw30es'))
+    
+    def test_no_state_reducer(self):
+        protocol = self._connect('no_such_device')
+        self.assertEqual(None, protocol.stateReducer)
+        
+        self._query(protocol, 'PWR?', 'PWR=01')
+        self.assertEqual({}, self.factory.getDeviceState('no_such_device'))
+        self.assertEqual(None, self.factory.getDeviceState('not_connected'))
+    
+    def test_send_commands(self):
+        epson = self._connect('epson_5030ub')
+        lutron = self._connect('lutron_grx_3000')
+        
+        d = self.factory.sendCommands([('epson_5030ub', 'PWR ON'), ('lutron_grx_3000', ':A11'), ('epson_5030ub', 'KEY 3B'), ('missing', 'X')])
+        
+        # both devices get their first command right away, the second epson command waits for the first one
+        self.assertEqual('PWR ON\r', epson.transport.value())
+        self.assertEqual(':A11\r', lutron.transport.value())
+        epson.transport.clear()
+        
+        lutron.dataReceived('OK\r')
+        epson.dataReceived('OK1\r')
+        self.assertEqual('KEY 3B\r', epson.transport.value())
+        epson.dataReceived('OK2\r')
+        
+        self.assertEqual(['OK1', 'OK', 'OK2', lib.NO_DEVICE_FOUND], self.successResultOf(d))
+    
+    def test_outbox_disabled(self):
+        self._connect('epson_5030ub').connectionLost(None)
+        self.assertEqual(lib.NO_DEVICE_FOUND, self.successResultOf(self.factory.sendCommand('epson_5030ub', 'PWR ON')))
+    
+    def test_outbox_flushed_in_order(self):
+        self.factory.outboxSize = 10
+        epson = self._connect('epson_5030ub')
+        epson.connectionLost(None)
+        
+        first = self.factory.sendCommand('epson_5030ub', 'PWR ON')
+        second = self.factory.sendCommand('epson_5030ub', 'KEY 3B')
+        self.assertNoResult(first)
+        
+        epson = self.factory.buildProtocol(None)
+        epson.makeConnection(proto_helpers.StringTransport())
+        epson.dataReceived('epson_5030ub\r')
+        self.assertEqual('PWR ON\r', epson.transport.value())
+        epson.transport.clear()
+        epson.dataReceived('OK1\r')
+        self.assertEqual('KEY 3B\r', epson.transport.value())
+        epson.dataReceived('OK2\r')
+        
+        self.assertEqual(['OK1', 'OK2'], [self.successResultOf(first), self.successResultOf(second)])
+    
+    def test_outbox_bounded(self):
+        self.factory.outboxSize = 1
+        self._connect('epson_5030ub').connectionLost(None)
+        
+        held = self.factory.sendCommand('epson_5030ub', 'PWR ON')
+        self.assertEqual(lib.NO_DEVICE_FOUND, self.successResultOf(self.factory.sendCommand('epson_5030ub', 'KEY 3B')))
+        
+        # held commands which are too old are dropped instead of replayed
+        self.clock.advance(self.factory.outboxTimeout)
+        self.assertEqual(lib.NO_DEVICE_FOUND, self.successResultOf(held))
+        
+        epson = self._connect('epson_5030ub')
+        self.assertIdentical(None, epson.responseDeferred)
+    
+    def test_outbox_cancel(self):
+        self.factory.outboxSize = 10
+        self._connect('epson_5030ub').connectionLost(None)
+        
+        d = self.factory.sendCommand('epson_5030ub', 'PWR ON')
+        d.addErrback(lambda x: None)
+        d.cancel()
+        
+        epson = self._connect('epson_5030ub')
+        self.assertIdentical(None, epson.responseDeferred)
+        self.assertEqual([], self.clock.getDelayedCalls())
+    
+    def _setMacros(self, macros):
+        self.factory.macros, warnings = compileMacros(macros, readDeviceConfig)
+    
+    def test_macro_sequential(self):
+        epson = self._connect('epson_5030ub')
+        lutron = self._connect('lutron_grx_3000')
+        self._setMacros({'on': {'name': 'On', 'commands': [
+            {'device': 'epson_5030ub', 'command': 'PWR ON'},
+            {'device': 'lutron_grx_3000', 'command': ':A11'},
+        ]}})
+        
+        d = self.factory.runMacro('on')
+        self.assertEqual('', lutron.transport.value())
+        epson.dataReceived('OK\r')
+        self.assertEqual(':A11\r', lutron.transport.value())
+        lutron.dataReceived('OK\r')
+        
+        self.assertEqual(lib.SUCCESS, self.successResultOf(d))
+    
+    def test_macro_parallel(self):
+        epson = self._connect('epson_5030ub')
+        lutron = self._connect('lutron_grx_3000')
+        self._setMacros({'movie': {'name': 'Movie', 'commands': [
+            {'parallel': [
+                [{'device': 'epson_5030ub', 'command': 'PWR ON'}, {'device': 'DELAY', 'command': '5'}, {'device': 'epson_5030ub', 'command': 'KEY 3B'}],
+                {'device': 'lutron_grx_3000', 'command': ':A11'},
+            ]},
+            {'device': 'lutron_grx_3000', 'command': ':A21'},
+        ]}})
+        
+        d = self.factory.runMacro('movie')
+        self.assertEqual('PWR ON\r', epson.transport.value())
+        self.assertEqual(':A11\r', lutron.transport.value())
+        epson.transport.clear()
+        lutron.transport.clear()
+        
+        epson.dataReceived('OK\r')
+        lutron.dataReceived('OK\r')
+        self.clock.advance(5)
+        self.assertEqual('KEY 3B\r', epson.transport.value())
+        
+        # the last step waits for the whole group
+        self.assertEqual('', lutron.transport.value())
+        epson.dataReceived('OK\r')
+        self.assertEqual(':A21\r', lutron.transport.value())
+        lutron.dataReceived('OK\r')
+        
+        self.assertEqual(lib.SUCCESS, self.successResultOf(d))
+    
+    def test_macro_failure(self):
+        epson = self._connect('epson_5030ub')
+        self._setMacros({'on': {'name': 'On', 'commands': [
+            {'parallel': [
+                {'device': 'epson_5030ub', 'command': 'PWR ON'},
+                {'device': 'lutron_grx_3000', 'command': ':A11'},
+            ]},
+            {'device': 'epson_5030ub', 'command': 'KEY 3B'},
+        ]}})
+        
+        d = self.factory.runMacro('on')
+        epson.transport.clear()
+        epson.dataReceived('OK\r')
+        
+        self.assertEqual(lib.NO_DEVICE_FOUND, self.successResultOf(d))
+        self.assertEqual('', epson.transport.value())
+    
+    def test_macro_timeout(self):
+        epson = self._connect('epson_5030ub')
+        self._setMacros({'on': {'name': 'On', 'commands': [
+            {'device': 'epson_5030ub', 'command': 'PWR ON'},
+            {'device': 'epson_5030ub', 'command': 'KEY 3B'},
+        ]}})
+        
+        d = self.factory.runMacro('on')
+        epson.transport.clear()
+        self.clock.advance(epson.timeout)
+        
+        self.assertEqual(lib.TIMEOUT, self.successResultOf(d))
+        self.assertEqual('', epson.transport.value())
+    
+    def test_macro_step_timeout(self):
+        epson = self._connect('epson_5030ub')
+        self._setMacros({'on': {'name': 'On', 'commands': [
+            {'device': 'epson_5030ub', 'commandId': 'setPowerOn', 'timeout': 5},
+        ]}})
+        
+        d = self.factory.runMacro('on')
+        self.assertEqual('PWR ON\r', epson.transport.value())
+        self.clock.advance(5)
+        
+        self.assertEqual(lib.TIMEOUT, self.successResultOf(d))
+    
+    def test_macro_cancel(self):
+        epson = self._connect('epson_5030ub')
+        self._setMacros({'on': {'name': 'On', 'commands': [
+            {'device': 'epson_5030ub', 'command': 'PWR ON'},
+            {'device': 'epson_5030ub', 'command': 'KEY 3B'},
+        ]}})
+        
+        d = self.factory.runMacro('on')
+        epson.sendCommand('PWR?')
+        epson.transport.clear()
+        d.cancel()
+        
+        self.assertEqual(lib.CANCELLED, self.successResultOf(d))
+        epson.dataReceived('OK\r')
+        self.assertEqual('PWR?\r', epson.transport.value())
+    
+    def test_macro_cancel_drops_queued(self):
+        epson = self._connect('epson_5030ub')
+        self._setMacros({'on': {'name': 'On', 'commands': [
+            {'parallel': [
+                {'device': 'DELAY', 'command': '5'},
+                {'device': 'epson_5030ub', 'command': 'KEY 3B'},
+            ]},
+        ]}})
+        
+        epson.sendCommand('PWR?')
+        d = self.factory.runMacro('on')
+        self.assertEqual(1, len(epson._requests))
+        d.cancel()
+        
+        self.assertEqual(lib.CANCELLED, self.successResultOf(d))
+        self.assertEqual(0, len(epson._requests))
+        
+        # only the timeout of the query is left
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+    
+    def test_macro_preempted(self):
+        epson = self._connect('epson_5030ub')
+        self._setMacros({
+            'movie': {'name': 'Movie', 'group': 'theater', 'commands': [
+                {'device': 'epson_5030ub', 'command': 'PWR ON'},
+                {'device': 'DELAY', 'command': '10'},
+                {'device': 'epson_5030ub', 'command': 'KEY 3B'},
+            ]},
+            'off': {'name': 'Off', 'group': 'theater', 'commands': [
+                {'device': 'epson_5030ub', 'command': 'PWR OFF'},
+            ]},
+        })
+        
+        movie = self.factory.runMacro('movie')
+        epson.dataReceived('OK\r')
+        epson.transport.clear()
+        
+        off = self.factory.runMacro('off')
+        self.assertEqual(lib.CANCELLED, self.successResultOf(movie))
+        self.assertEqual('PWR OFF\r', epson.transport.value())
+        epson.dataReceived('OK\r')
+        
+        self.clock.advance(10)
+        self.assertEqual(lib.SUCCESS, self.successResultOf(off))
+        self.assertEqual('PWR OFF\r', epson.transport.value())
+    
+    def test_metrics(self):
+        epson = self._connect('epson_5030ub')
+        
+        self.factory.sendCommand('epson_5030ub', 'PWR ON')
+        self.factory.sendCommand('epson_5030ub', 'KEY 3B')
+        self.clock.advance(0.2)
+        epson.dataReceived('OK\r')
+        self.clock.advance(epson.timeout + 1)
+        epson.dataReceived('PWR=01\r')
+        self.factory.sendCommand('lutron_grx_3000', ':A11')
+        
+        metrics = self.factory.metrics.devices['epson_5030ub']
+        self.assertEqual(2, metrics.queueTime.count)
+        self.assertEqual(0.2, metrics.queueTime.sum)
+        self.assertEqual(1, metrics.responseTime.count)
+        self.assertEqual(1, metrics.timeouts)
+        self.assertEqual(1, metrics.events)
+        self.assertEqual(1, self.factory.metrics.devices['lutron_grx_3000'].noDeviceFound)
+        
+        # a reconnected device keeps counting
+        epson.connectionLost(None)
+        self.assertIdentical(metrics, self._connect('epson_5030ub').metrics)
+    
+    def test_macro_trace(self):
+        epson = self._connect('epson_5030ub')
+        self._setMacros({'on': {'name': 'On', 'commands': [
+            {'device': 'epson_5030ub', 'command': 'PWR ON'},
+            {'device': 'lutron_grx_3000', 'command': ':A11'},
+        ]}})
+        
+        d = self.factory.runMacro('on', 'abc')
+        epson.dataReceived('OK\r')
+        self.assertEqual(lib.NO_DEVICE_FOUND, self.successResultOf(d))
+        
+        spans = [(x['hop'], x['span'], x.get('device')) for x in self.factory.tracer.get('abc')]
+        self.assertEqual([
+            ('macro', 'started', None),
+            ('server', 'queued', 'epson_5030ub'),
+            ('server', 'sent', 'epson_5030ub'),
+            ('server', 'response', 'epson_5030ub'),
+            ('macro', 'done', 'epson_5030ub'),
+            ('server', 'noDevice', 'lutron_grx_3000'),
+            ('macro', 'done', 'lutron_grx_3000'),
+            ('macro', 'finished', None),
+        ], spans)
+    
+    def test_metrics_macro_duration(self):
+        self._setMacros({'wait': {'name': 'Wait', 'commands': [{'device': 'DELAY', 'command': '5'}]}})
+        
+        d = self.factory.runMacro('wait')
+        self.clock.advance(5)
+        
+        self.assertEqual(lib.SUCCESS, self.successResultOf(d))
+        histogram = self.factory.metrics.macroDurations['wait']
+        self.assertEqual((1, 5), (histogram.count, histogram.sum))
+
+class HistogramTestCase(unittest.TestCase):
+    
+    def test_cumulative(self):
+        histogram = lib.Histogram()
+        for value in (0.001, 0.005, 0.3, 100):
+            histogram.observe(value)
+        
+        counts = dict(histogram.cumulativeCounts())
+        self.assertEqual(2, counts[0.005])
+        self.assertEqual(2, counts[0.25])
+        self.assertEqual(3, counts[60])
+        self.assertEqual(4, counts['+Inf'])
+        self.assertEqual(4, histogram.count)
+
+class DeviceRegistryTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = self.mktemp()
+        os.makedirs(os.path.join(self.path, 'tv'))
+        self._write('tv', {'id': 'tv', 'name': 'TV', 'commands': [
+            {'name': 'Power', 'commands': [{'id': 'power', 'command': {'format': 'PWR {state}', 'args': [{'id': 'state'}]}}]},
+        ]}, 1000)
+        with open(os.path.join(self.path, 'tv', 'index.html'), 'w') as asset:
+            asset.write('<html/>')
+        
+        self.clock = Clock()
+        self.registry = DeviceRegistry(self.path, self.clock)
+        self.registry.start()
+    
+    def tearDown(self):
+        self.registry.stop()
+    
+    def _write(self, deviceId, config, mtime):
+        configPath = os.path.join(self.path, deviceId, 'device.json')
+        with open(configPath, 'w') as configFile:
+            json.dump(config, configFile)
+        os.utime(configPath, (mtime, mtime))
+    
+    def test_lookup(self):
+        self.assertEqual('TV', self.registry.getName('tv'))
+        self.assertEqual({'power': CommandSchema('PWR {state}', frozenset(['state']), {})}, self.registry.getCommands('tv'))
+        self.assertEqual(frozenset(['index.html']), self.registry.getAssets('tv'))
+        self.assertEqual('tv', self.registry.getConfig('tv')['id'])
+        
+        self.assertEqual('radio', self.registry.getName('radio'))
+        self.assertEqual({}, self.registry.getConfig('radio'))
+        self.assertIdentical(None, self.registry.getCommands('radio'))
+    
+    def test_unchanged(self):
+        metadata = self.registry.get('tv')
+        self.clock.advance(self.registry.interval)
+        self.assertIdentical(metadata, self.registry.get('tv'))
+    
+    def test_reload(self):
+        self._write('tv', {'id': 'tv', 'name': 'Television'}, 2000)
+        os.makedirs(os.path.join(self.path, 'radio'))
+        self._write('radio', {'id': 'radio', 'name': 'Radio'}, 2000)
+        
+        self.assertEqual('TV', self.registry.getName('tv'))
+        self.clock.advance(self.registry.interval)
+        self.assertEqual('Television', self.registry.getName('tv'))
+        self.assertEqual({}, self.registry.getCommands('tv'))
+        self.assertEqual('Radio', self.registry.getName('radio'))
+    
+    def test_removed(self):
+        os.remove(os.path.join(self.path, 'tv', 'index.html'))
+        self.assertEqual(['tv'], self.registry.check())
+        self.assertEqual(frozenset(), self.registry.getAssets('tv'))
+    
+    def test_factory(self):
+        factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None, self.registry)
+        self.assertEqual('TV', factory.getDeviceConfig('tv')['name'])
+
+class FormatCommandTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.schema = commandSchemas([{'id': 'scene', 'command': {'format': 'A{scene}{units}', 'args': [
+            {'id': 'scene', 'pattern': '[0-9A-G]'},
+            {'id': 'units'},
+        ]}}])['scene']
+    
+    def test_format(self):
+        self.assertEqual('A21', formatCommand(self.schema, {'scene': '2', 'units': '1'}))
+        self.assertEqual('A21', formatCommand(self.schema, {'scene': 2, 'units': 1}))
+    
+    def test_invalid(self):
+        for args in ({'scene': '2'}, {'scene': '2', 'units': '1', 'extra': 'x'}, {'scene': 'H', 'units': '1'}, {'scene': '22', 'units': '1'}, {'scene': '2', 'units': '1\rPWR OFF'}):
+            self.assertRaises(ValueError, formatCommand, self.schema, args)
+    
+    def test_format_mismatch(self):
+        schema = CommandSchema('PWR {state}', frozenset(['power']), {})
+        self.assertRaises(ValueError, formatCommand, schema, {'power': 'ON'})
+        
+        schema = CommandSchema('PWR {power.state}', frozenset(['power']), {})
+        self.assertRaises(ValueError, formatCommand, schema, {'power': 'ON'})
+
+class FrameDecoderTestCase(unittest.TestCase):
+    
+    def test_split_and_joined(self):
+        data = encodeFrame(lib.FRAME_REQUEST, 1, 'PWR ON') + encodeFrame(lib.FRAME_REQUEST, 2, 'a\rb')
+        decoder = FrameDecoder()
+        
+        self.assertEqual([], decoder.feed(data[:3]))
+        self.assertEqual([(lib.FRAME_REQUEST, 0, 1, 'PWR ON')], decoder.feed(data[3:-2]))
+        self.assertEqual([(lib.FRAME_REQUEST, 0, 2, 'a\rb')], decoder.feed(data[-2:]))
+    
+    def test_invalid(self):
+        frame = encodeFrame(lib.FRAME_REQUEST, 1, 'x')
+        
+        self.assertRaises(ValueError, FrameDecoder().feed, frame[:4] + chr(1) + frame[5:])
+        self.assertRaises(ValueError, FrameDecoder().feed, '\xff\xff\xff\xff')
+
+class FakeDevice(object):
+    
+    def __init__(self, deviceId='fake'):
+        self.deviceId = deviceId
+        self.sent = []
+    
+    def sendLine(self, line):
+        d = Deferred()
+        self.sent.append((line, d))
+        return d
+    
+    def getUnsolicitedData(self):
+        self.unsolicited = Deferred()
+        return self.unsolicited
+
+class DeviceClientProtocolTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self._reactor = lib._reactor
+        self.clock = lib._reactor = Clock()
+        self.device = FakeDevice()
+        self.protocol = DeviceClientProtocol(self.device)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+    
+    def tearDown(self):
+        lib._reactor = self._reactor
+    
+    def _frames(self):
+        frames = FrameDecoder().feed(self.transport.value().split('\r', 1)[1])
+        self.transport.clear()
+        return frames
+    
+    def test_registers(self):
+        self.assertTrue(self.transport.value().startswith(lib.LINK_HELLO + '\r'))
+        self.assertEqual([(lib.FRAME_HELLO, 0, 0, 'fake')], self._frames())
+    
+    def test_out_of_order(self):
+        self.transport.clear()
+        
+        # both requests arrive in a single read
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_REQUEST, 1, 'first') + encodeFrame(lib.FRAME_REQUEST, 2, 'second'))
+        self.assertEqual(['first', 'second'], [line for line, d in self.device.sent])
+        
+        self.device.sent[1][1].callback('two')
+        self.device.unsolicited.callback('event')
+        self.device.sent[0][1].callback('one')
+        
+        frames = FrameDecoder().feed(self.transport.value())
+        self.assertEqual([(lib.FRAME_RESPONSE, 0, 2, 'two'), (lib.FRAME_EVENT, 0, 0, 'event'), (lib.FRAME_RESPONSE, 0, 1, 'one')], frames)
+    
+    def test_channels(self):
+        other = FakeDevice('other')
+        protocol = DeviceClientProtocol(self.device, other)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        
+        frames = FrameDecoder().feed(transport.value().split('\r', 1)[1])
+        self.assertEqual([(lib.FRAME_HELLO, 0, 0, 'fake'), (lib.FRAME_HELLO, 1, 0, 'other')], frames)
+        transport.clear()
+        
+        protocol.dataReceived(encodeFrame(lib.FRAME_REQUEST, 7, 'query', 1))
+        self.assertEqual([], self.device.sent)
+        other.sent[0][1].callback('answer')
+        other.unsolicited.callback('event')
+        
+        frames = FrameDecoder().feed(transport.value())
+        self.assertEqual([(lib.FRAME_RESPONSE, 1, 7, 'answer'), (lib.FRAME_EVENT, 1, 0, 'event')], frames)
+
+    def test_device_raises(self):
+        broken = FakeDevice('broken')
+        broken.sendLine = lambda line: int(line)
+        protocol = DeviceClientProtocol(broken, self.device)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        transport.clear()
+        
+        protocol.dataReceived(encodeFrame(lib.FRAME_REQUEST, 1, 'zzzzzzzzzz', 0) + encodeFrame(lib.FRAME_REQUEST, 2, 'query', 1))
+        self.device.sent[0][1].callback('answer')
+        
+        self.assertFalse(transport.disconnecting)
+        frames = FrameDecoder().feed(transport.value())
+        self.assertEqual([(lib.FRAME_RESPONSE, 0, 1, lib.ERROR), (lib.FRAME_RESPONSE, 1, 2, 'answer')], frames)
+    
+    def test_heartbeat(self):
+        self.transport.clear()
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_PING, 0, ''))
+        self.assertEqual([(lib.FRAME_PONG, 0, 0, '')], FrameDecoder().feed(self.transport.value()))
+        self.transport.clear()
+        
+        self.clock.advance(self.protocol.heartbeatInterval)
+        self.assertEqual([(lib.FRAME_PING, 0, 0, '')], FrameDecoder().feed(self.transport.value()))
+        
+        self.clock.pump([self.protocol.heartbeatInterval] * (self.protocol.heartbeatMisses - 1))
+        self.assertTrue(self.transport.disconnecting)
+        self.protocol.connectionLost(None)
+    
+    def test_trace(self):
+        device = QueuedLineSender()
+        device.deviceId = 'fake'
+        device.makeConnection(proto_helpers.StringTransport())
+        protocol = DeviceClientProtocol(device)
+        protocol.makeConnection(self.transport)
+        self.transport.clear()
+        
+        protocol.dataReceived(encodeFrame(lib.FRAME_TRACE, 1, 'abc') + encodeFrame(lib.FRAME_REQUEST, 1, 'PWR?'))
+        self.assertEqual('PWR?\r', device.transport.value())
+        device.dataReceived('PWR=01\r')
+        
+        (trace, response) = FrameDecoder().feed(self.transport.value())
+        self.assertEqual((lib.FRAME_TRACE, 0, 1), trace[:3])
+        self.assertEqual(['received', 'queued', 'sent', 'response', 'responded'], [x['span'] for x in json.loads(trace[3])])
+        self.assertEqual((lib.FRAME_RESPONSE, 0, 1, 'PWR=01'), response)
+        self.assertEqual(0, len(protocol.tracer))
+        protocol.connectionLost(None)
+
+class FramedDeviceServerProtocolTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self._reactor = lib._reactor
+        self.clock = lib._reactor = Clock()
+        self.factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.protocol.dataReceived(lib.LINK_HELLO + '\r' + encodeFrame(lib.FRAME_HELLO, 0, 'epson_5030ub'))
+        self.protocol.transport.clear()
+    
+    def tearDown(self):
+        self.protocol._heartbeat.stop()
+        lib._reactor = self._reactor
+    
+    def _requests(self):
+        frames = FrameDecoder().feed(self.protocol.transport.value())
+        self.protocol.transport.clear()
+        return [(requestId, payload) for frameType, channel, requestId, payload in frames if frameType == lib.FRAME_REQUEST]
+    
+    def _advance(self, seconds):
+        # keep answering the heartbeats like a live client would
+        for i in range(seconds):
+            self.clock.advance(1)
+            self.protocol.dataReceived(encodeFrame(lib.FRAME_PONG, 0, ''))
+    
+    def test_registered(self):
+        self.assertTrue(self.protocol.framed)
+        self.assertIdentical(self.protocol, self.factory.getDevice('epson_5030ub'))
+    
+    def test_event_while_waiting(self):
+        d = self.factory.sendCommand('epson_5030ub', 'PWR?')
+        self.assertEqual([(1, 'PWR?')], self._requests())
+        
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_EVENT, 0, 'PWR=01'))
+        self.assertNoResult(d)
+        self.assertEqual([(1, 'PWR=01')], self.protocol.getBufferedEvents(0))
+        
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_RESPONSE, 1, 'PWR=00'))
+        self.assertEqual('PWR=00', self.successResultOf(d))
+    
+    def test_trace(self):
+        d = self.factory.sendCommand('epson_5030ub', 'PWR ON', traceId='abc')
+        
+        frames = FrameDecoder().feed(self.protocol.transport.value())
+        self.assertEqual([(lib.FRAME_TRACE, 0, 1, 'abc'), (lib.FRAME_REQUEST, 0, 1, 'PWR ON')], frames)
+        
+        clientSpans = json.dumps([{'hop': 'client', 'span': 'sent', 'time': 5}])
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_TRACE, 1, clientSpans) + encodeFrame(lib.FRAME_RESPONSE, 1, 'OK'))
+        self.assertEqual('OK', self.successResultOf(d))
+        
+        spans = self.factory.tracer.get('abc')
+        self.assertEqual([('server', 'queued'), ('server', 'sent'), ('client', 'sent'), ('server', 'response')], [(x['hop'], x['span']) for x in spans])
+    
+    def test_late_response_ignored(self):
+        d = self.factory.sendCommand('epson_5030ub', 'PWR ON', timeout=5)
+        self._advance(5)
+        self.assertEqual(lib.TIMEOUT, self.successResultOf(d))
+        
+        d = self.factory.sendCommand('epson_5030ub', 'PWR?')
+        self.assertEqual([(1, 'PWR ON'), (2, 'PWR?')], self._requests())
+        
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_RESPONSE, 1, 'OK'))
+        self.assertNoResult(d)
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_RESPONSE, 2, 'PWR=01'))
+        self.assertEqual('PWR=01', self.successResultOf(d))
+    
+    def test_channels(self):
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_HELLO, 0, 'lutron_grx_3000', 1))
+        lutron = self.factory.getDevice('lutron_grx_3000')
+        self.assertEqual(1, lutron.channel)
+        
+        epsonResult = self.factory.sendCommand('epson_5030ub', 'PWR?')
+        lutronResult = self.factory.sendCommand('lutron_grx_3000', ':G')
+        frames = FrameDecoder().feed(self.protocol.transport.value())
+        self.assertEqual([(lib.FRAME_REQUEST, 0, 1, 'PWR?'), (lib.FRAME_REQUEST, 1, 1, ':G')], frames)
+        
+        # the second device answers first
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_RESPONSE, 1, '~:ss 1', 1))
+        self.assertEqual('~:ss 1', self.successResultOf(lutronResult))
+        self.assertNoResult(epsonResult)
+        
+        self.protocol.connectionLost(None)
+        self.assertEqual({}, self.factory.devices)
+    
+    def test_duplicate_channel(self):
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_HELLO, 0, 'lutron_grx_3000', 1) + encodeFrame(lib.FRAME_HELLO, 0, 'epson_5030ub', 2))
+        
+        self.assertFalse(self.protocol.transport.disconnecting)
+        self.assertEqual(['epson_5030ub', 'lutron_grx_3000'], sorted(self.factory.devices))
+        self.assertIdentical(self.protocol, self.factory.getDevice('epson_5030ub'))
+    
+    def test_heartbeat_kept_alive(self):
+        self._advance(self.protocol.heartbeatInterval * self.protocol.heartbeatMisses * 2)
+        
+        self.assertFalse(self.protocol.transport.disconnecting)
+        self.protocol.connectionLost(None)
+    
+    def test_dead_client_fails_pending(self):
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_HELLO, 0, 'lutron_grx_3000', 1))
+        epson = [self.factory.sendCommand('epson_5030ub', 'PWR?'), self.factory.sendCommand('epson_5030ub', 'PWR ON')]
+        lutron = self.factory.sendCommand('lutron_grx_3000', ':G')
+        
+        self.clock.pump([self.protocol.heartbeatInterval] * self.protocol.heartbeatMisses)
+        self.assertTrue(self.protocol.transport.disconnecting)
+        self.protocol.connectionLost(None)
+        
+        self.assertEqual([lib.DISCONNECTED] * 3, [self.successResultOf(x) for x in epson + [lutron]])
+        self.assertEqual({}, self.factory.devices)
+        self.assertEqual([], self.clock.getDelayedCalls())
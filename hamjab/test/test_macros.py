@@ -0,0 +1,147 @@
+import json, os
+
+from hamjab.lib import DeviceServerFactory
+from hamjab.macros import compileMacros, MacroError, MacroFileWatcher
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+CONFIGS = {
+    'a': {'commands': [
+        {'id': 'power', 'command': {'format': 'PWR {state}', 'args': [{'id': 'state'}]}},
+        {'name': 'Group', 'commands': [{'id': 'menu', 'command': {'format': 'MENU', 'args': []}}]},
+    ]},
+    'b': {'commands': []},
+    'c': {'commands': []},
+}
+
+class MacroCompilerTestCase(unittest.TestCase):
+    
+    def _compile(self, steps):
+        macros, warnings = compileMacros({'test': {'name': 'Test', 'commands': steps}}, lambda x: CONFIGS.get(x, {}))
+        return macros['test']
+    
+    def _plan(self, steps):
+        return [(step.command or str(step.delay), sorted(step.after)) for step in self._compile(steps).steps]
+    
+    def _errors(self, steps):
+        e = self.assertRaises(MacroError, self._compile, steps)
+        return e.errors
+    
+    def test_sequential(self):
+        steps = [{'device': 'a', 'command': '1'}, {'device': 'b', 'command': '2'}, {'device': 'DELAY', 'command': '3'}]
+        self.assertEqual([('1', []), ('2', [0]), ('3', [1])], self._plan(steps))
+    
+    def test_parallel(self):
+        steps = [
+            {'device': 'a', 'command': '1'},
+            {'parallel': [{'device': 'b', 'command': '2'}, [{'device': 'c', 'command': '3'}, {'device': 'c', 'command': '4'}]]},
+            {'device': 'a', 'command': '5'},
+        ]
+        self.assertEqual([('1', []), ('2', [0]), ('3', [0]), ('4', [2]), ('5', [0, 1, 3])], self._plan(steps))
+    
+    def test_same_device_ordered(self):
+        steps = [{'parallel': [{'device': 'a', 'command': '1'}, {'device': 'a', 'command': '2'}, {'device': 'DELAY', 'command': '3'}]}]
+        self.assertEqual([('1', []), ('2', [0]), ('3', [])], self._plan(steps))
+    
+    def test_after(self):
+        steps = [{'parallel': [
+            {'id': 'projector', 'device': 'a', 'command': '1'},
+            {'device': 'b', 'command': '2'},
+            {'device': 'c', 'command': '3', 'after': ['projector']},
+        ]}]
+        self.assertEqual([('1', []), ('2', []), ('3', [0])], self._plan(steps))
+    
+    def test_command_id(self):
+        macro = self._compile([
+            {'device': 'a', 'commandId': 'power', 'args': {'state': 'ON'}, 'timeout': 10},
+            {'device': 'a', 'commandId': 'menu'},
+        ])
+        
+        self.assertEqual('Test', macro.name)
+        self.assertEqual(('PWR ON', 10), (macro.steps[0].command, macro.steps[0].timeout))
+        self.assertEqual(('MENU', None), (macro.steps[1].command, macro.steps[1].timeout))
+    
+    def test_unknown_device_warns(self):
+        macros, warnings = compileMacros({'test': {'commands': [{'device': 'kodi', 'command': 'play'}]}}, lambda x: {})
+        
+        self.assertEqual('test', macros['test'].name)
+        self.assertEqual(1, len(warnings))
+    
+    def test_all_errors_reported(self):
+        errors = self._errors([
+            {'device': 'a', 'command': '1', 'after': ['nope']},
+            {'device': 'a', 'commandId': 'missing'},
+            {'device': 'a', 'commandId': 'power'},
+            {'device': 'DELAY', 'command': 'soon'},
+            {'device': 'b', 'command': '2', 'timeout': -1},
+            {'command': '3'},
+        ])
+        
+        self.assertEqual(6, len(errors))
+    
+    def test_duplicate_id(self):
+        self.assertEqual(1, len(self._errors([{'id': 'x', 'device': 'a', 'command': '1'}, {'id': 'x', 'device': 'b', 'command': '2'}])))
+    
+    def test_bad_structure(self):
+        self.assertRaises(MacroError, compileMacros, {'test': {'name': 'Test'}}, lambda x: {})
+        self.assertRaises(MacroError, compileMacros, [], lambda x: {})
+    
+    def test_group(self):
+        macros, warnings = compileMacros({'on': {'group': 'theater', 'commands': []}, 'other': {'commands': []}}, lambda x: {})
+        
+        self.assertEqual('theater', macros['on'].group)
+        self.assertEqual(None, macros['other'].group)
+        self.assertRaises(MacroError, compileMacros, {'on': {'group': 1, 'commands': []}}, lambda x: {})
+
+class MacroFileWatcherTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.path = self.mktemp()
+        self._write({'on': {'name': 'On', 'commands': [{'device': 'a', 'command': '1'}]}})
+        
+        self.clock = Clock()
+        self.factory = DeviceServerFactory(compileMacros(json.load(open(self.path)), lambda x: {})[0], lambda *args: None, lambda *args: None)
+        self.watcher = MacroFileWatcher(self.path, self.factory, lambda x: {}, self.clock)
+        self.watcher.start()
+    
+    def tearDown(self):
+        self.watcher.stop()
+    
+    def _write(self, macros, mtime=None):
+        with open(self.path, 'w') as macro_file:
+            json.dump(macros, macro_file)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+    
+    def test_unchanged(self):
+        macros = self.factory.macros
+        self.clock.advance(self.watcher.interval)
+        self.assertIdentical(macros, self.factory.macros)
+    
+    def test_reload(self):
+        old = self.factory.macros['on']
+        self._write({'on': {'name': 'All on', 'commands': [{'device': 'a', 'command': '2'}]}}, 1000)
+        self.clock.advance(self.watcher.interval)
+        
+        self.assertEqual('All on', self.factory.macros['on'].name)
+        
+        # anything still holding the old macro keeps its steps
+        self.assertEqual('1', old.steps[0].command)
+    
+    def test_invalid_file_ignored(self):
+        macros = self.factory.macros
+        self._write({'on': {'name': 'On', 'commands': [{'device': 'DELAY', 'command': 'soon'}]}}, 1000)
+        self.clock.advance(self.watcher.interval)
+        
+        self.assertIdentical(macros, self.factory.macros)
+    
+    def test_fixed_with_same_mtime(self):
+        with open(self.path, 'w') as macro_file:
+            macro_file.write('{"on": {"name": "All on", "comm')
+        os.utime(self.path, (1000, 1000))
+        self.clock.advance(self.watcher.interval)
+        self.assertEqual('On', self.factory.macros['on'].name)
+        
+        self._write({'on': {'name': 'All on', 'commands': [{'device': 'a', 'command': '2'}]}}, 1000)
+        self.clock.advance(self.watcher.interval)
+        self.assertEqual('All on', self.factory.macros['on'].name)
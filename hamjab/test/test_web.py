@@ -0,0 +1,420 @@
+import base64
+import json
+import os
+
+from StringIO import StringIO
+
+from hamjab import lib, web
+from hamjab.assets import AssetIndex
+from hamjab.lib import encodeFrame, DeviceServerFactory, FrameDecoder, QueuedLineSender
+from hamjab.web import BatchResource, CommandServer, DeviceResource, EventStream, EventStreamResource, EventStreamSubscriber, GetUnsolicitedResource, StaticFile, TraceResource
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+from twisted.web import http
+from twisted.web.resource import getChildForRequest
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.template import XMLFile
+from twisted.web.test.requesthelper import DummyRequest
+
+class StreamingRequest(DummyRequest):
+    """
+    DummyRequest pulls from a registered producer until it's unregistered, which never happens for an event stream.
+    """
+    producer = None
+    
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+class EventStreamTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.clock = Clock()
+        self.factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+        self.eventStream = EventStream(self.factory, self.clock)
+    
+    def _subscribe(self, deviceId=None):
+        request = StreamingRequest([''])
+        result = EventStreamResource(self.eventStream, deviceId).render_GET(request)
+        self.assertEqual(NOT_DONE_YET, result)
+        del request.written[:]
+        return request
+    
+    def _events(self, request):
+        return [json.loads(x[len('data: '):].strip()) for x in request.written if x.startswith('data: ')]
+    
+    def test_broadcast(self):
+        requests = [self._subscribe() for x in range(3)]
+        lutron = self._subscribe('lutron_grx_3000')
+        self.assertEqual(4, len(self.eventStream))
+        
+        self.factory.publishEvent('epson_5030ub', 'PWR=01')
+        self.factory.publishEvent('lutron_grx_3000', ':ss 1MMMMMMM')
+        
+        for request in requests:
+            self.assertEqual([{'device': 'epson_5030ub', 'data': 'PWR=01'}, {'device': 'lutron_grx_3000', 'data': ':ss 1MMMMMMM'}], self._events(request))
+        self.assertEqual([{'device': 'lutron_grx_3000', 'data': ':ss 1MMMMMMM'}], self._events(lutron))
+    
+    def test_unsubscribe_on_finish(self):
+        request = self._subscribe()
+        request.processingFailed(Exception("Connection lost"))
+        
+        self.assertEqual(0, len(self.eventStream))
+        self.factory.publishEvent('epson_5030ub', 'PWR=01')
+        self.assertEqual([], request.written)
+    
+    def test_slow_subscriber(self):
+        slow = self._subscribe()
+        fast = self._subscribe()
+        
+        slow.producer.pauseProducing()
+        self.factory.publishEvent('epson_5030ub', 'PWR=01')
+        self.assertEqual([], slow.written)
+        self.assertEqual(1, len(self._events(fast)))
+        
+        slow.producer.resumeProducing()
+        self.assertEqual(1, len(self._events(slow)))
+    
+    def test_keep_alive(self):
+        request = self._subscribe()
+        
+        self.clock.advance(self.eventStream.keepAliveInterval)
+        self.assertEqual([EventStream.keepAlive], request.written)
+        
+        request.processingFailed(Exception("Connection lost"))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+class EventStreamSubscriberTestCase(unittest.TestCase):
+    
+    def test_bounded_buffer(self):
+        request = StreamingRequest([''])
+        subscriber = EventStreamSubscriber(request, maxBuffered=2)
+        
+        subscriber.pauseProducing()
+        for event in ('a', 'b', 'c', 'd'):
+            subscriber.send(event)
+        self.assertEqual([], request.written)
+        self.assertEqual(2, subscriber.dropped)
+        
+        subscriber.resumeProducing()
+        self.assertEqual([EventStream.formatEvent(2, 'overflow'), 'c', 'd'], request.written)
+        
+        subscriber.send('e')
+        self.assertEqual('e', request.written[-1])
+
+class GetUnsolicitedResourceTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.device = QueuedLineSender()
+        self.device.makeConnection(proto_helpers.StringTransport())
+    
+    def test_since(self):
+        self.device.dataReceived('one\rtwo\r')
+        
+        request = DummyRequest([''])
+        GetUnsolicitedResource(self.device, 1).render(request)
+        
+        self.assertEqual(1, request.finished)
+        self.assertEqual({'last': 2, 'events': [{'seq': 2, 'data': 'two'}]}, json.loads(''.join(request.written)))
+    
+    def test_since_waits(self):
+        request = DummyRequest([''])
+        GetUnsolicitedResource(self.device, 0).render(request)
+        self.assertEqual(0, request.finished)
+        
+        self.device.dataReceived('one\r')
+        self.assertEqual({'last': 1, 'events': [{'seq': 1, 'data': 'one'}]}, json.loads(''.join(request.written)))
+
+class BatchResourceTestCase(unittest.TestCase):
+    
+    def test_parse(self):
+        body = json.dumps([{'device': 'epson_5030ub', 'command': 'PWR ON'}, {'device': 'lutron_grx_3000', 'command': ':A{scene}1', 'args': {'scene': '3'}}])
+        self.assertEqual([('epson_5030ub', 'PWR ON'), ('lutron_grx_3000', ':A31')], BatchResource.parseCommands(body))
+    
+    def test_parse_invalid(self):
+        for body in ('not json', '{}', '[1]', '[{"device": "x"}]', '[{"device": "x", "command": 5}]', '[{"device": "x", "command": "{a}"}]', '[{"device": "x", "command": "a", "args": []}]',
+                     '[{"device": "x", "command": "{a.b}", "args": {"a": "1"}}]', '[{"device": "x", "command": "{"}]'):
+            self.assertRaises(ValueError, BatchResource.parseCommands, body)
+    
+    def test_get(self):
+        request = DummyRequest(['batch'])
+        request.content = StringIO('[]')
+        resource = getChildForRequest(CommandServer(DeviceServerFactory({}, lambda *args: None, lambda *args: None)), request)
+        resource.render(request)
+        self.assertEqual(405, request.responseCode)
+        self.assertEqual(['POST'], request.responseHeaders.getRawHeaders('allow'))
+
+class ConditionalRequest(DummyRequest):
+    """
+    DummyRequest ignores ETags, this one answers If-None-Match like a real request.
+    """
+    setETag = http.Request.setETag.im_func
+    etag = None
+
+class CommandServerTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self._reactor = lib._reactor
+        lib._reactor = Clock()
+        self.factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+        self._connect('epson_5030ub')
+        self.server = CommandServer(self.factory)
+        
+        # the template path is relative to the root of the repo, the tests don't run from there
+        template = os.path.join(os.path.dirname(web.__file__), 'resources', 'home', 'index.html')
+        self.server.home.renderers['index'].renderer.loader = XMLFile(FilePath(template))
+    
+    def tearDown(self):
+        lib._reactor = self._reactor
+        CommandServer.isDisabled = False
+    
+    def _connect(self, deviceId):
+        protocol = self.factory.buildProtocol(None)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(deviceId + '\r')
+        return protocol
+    
+    def _home(self, etag=None):
+        request = ConditionalRequest(['home', ''])
+        if etag is not None:
+            request.requestHeaders.setRawHeaders('if-none-match', [etag])
+        request.rendered = getChildForRequest(self.server, request).render(request)
+        return request
+    
+    def test_home_page_cached(self):
+        first = self._home()
+        self.assertIn('Epson PowerLite Home Cinema 5030UB', first.rendered)
+        
+        second = self._home()
+        self.assertIdentical(first.rendered, second.rendered)
+        self.assertEqual(first.etag, second.etag)
+    
+    def test_home_page_not_modified(self):
+        etag = self._home().etag
+        
+        request = self._home(etag)
+        self.assertEqual(http.NOT_MODIFIED, request.responseCode)
+        self.assertEqual('', request.rendered)
+    
+    def test_home_page_invalidated(self):
+        first = self._home()
+        
+        self._connect('sony_vpl_hw30es')
+        second = self._home(first.etag)
+        self.assertIn('sony_vpl_hw30es', second.rendered)
+        self.assertNotEqual(first.etag, second.etag)
+        
+        toggle = DummyRequest(['toggleStatus'])
+        getChildForRequest(self.server, toggle).render(toggle)
+        third = self._home(second.etag)
+        self.assertNotIn('sony_vpl_hw30es', third.rendered)
+        self.assertIn('Enable', third.rendered)
+    
+    def _command(self, path, args, method='POST'):
+        request = DummyRequest(path.split('/'))
+        request.path = '/' + path
+        request.method = method
+        request.args = args
+        return getChildForRequest(self.server, request), request
+    
+    def test_command(self):
+        resource, request = self._command('epson_5030ub/command/saveMemory', {'memory_kind': ['01'], 'memory_number': ['2'], 'priority': ['macro']})
+        self.assertEqual('PUSHMEM 01 2', resource.command)
+        self.assertEqual(lib.PRIORITY_MACRO, resource.priority)
+        
+        resource.render(request)
+        self.assertEqual('PUSHMEM 01 2\r', self.factory.getDevice('epson_5030ub').transport.value())
+    
+    def test_command_get(self):
+        resource, request = self._command('epson_5030ub/command/setPowerOn', {}, 'GET')
+        resource.render(request)
+        
+        self.assertEqual(405, request.responseCode)
+        self.assertEqual(['POST'], request.responseHeaders.getRawHeaders('allow'))
+        self.assertEqual('', self.factory.getDevice('epson_5030ub').transport.value())
+    
+    def test_command_held(self):
+        self.factory.outboxSize = 10
+        self.factory.getDevice('epson_5030ub').connectionLost(None)
+        
+        resource, request = self._command('epson_5030ub/command/setPowerOn', {})
+        resource.render(request)
+        
+        protocol = self._connect('epson_5030ub')
+        self.assertEqual('PWR ON\r', protocol.transport.value())
+    
+    def test_command_rejected(self):
+        for path, args in [('epson_5030ub/command/saveMemory', {'memory_kind': ['01']}),
+                           ('epson_5030ub/command/saveMemory', {'memory_kind': ['01'], 'memory_number': ['2\rPWR OFF']}),
+                           ('epson_5030ub/command/setPowerOn', {'priority': ['urgent']}),
+                           ('epson_5030ub/command/noSuchCommand', {})]:
+            resource, request = self._command(path, args)
+            self.assertNotIsInstance(resource, web.SendCommandResource)
+            resource.render(request)
+            self.assertIn(request.responseCode, (404, 500))
+        
+        self.assertEqual('', self.factory.getDevice('epson_5030ub').transport.value())
+    
+    def test_device_resource_kept(self):
+        request = DummyRequest(['epson_5030ub', 'state'])
+        request.path = '/epson_5030ub/state'
+        first = self.server.getChild('epson_5030ub', request)
+        self.assertIdentical(first, self.server.getChild('epson_5030ub', request))
+        
+        self.factory.getDevice('epson_5030ub').connectionLost(None)
+        self._connect('epson_5030ub')
+        self.assertNotIdentical(first, self.server.getChild('epson_5030ub', request))
+
+class StaticFileTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        root = os.path.abspath(self.mktemp())
+        os.makedirs(root)
+        self.path = os.path.join(root, 'code.js')
+        with open(self.path, 'w') as assetFile:
+            assetFile.write('var x = 1;\n' * 100)
+        
+        self.resource = StaticFile(self.path)
+        self.resource.assets = AssetIndex(root)
+        self.version = self.resource.assets.version(self.path)
+    
+    def _get(self, args={}, headers={}):
+        request = ConditionalRequest([''])
+        request.args = args
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(name, [value])
+        request.rendered = self.resource.render(request)
+        return request
+    
+    def test_compressed(self):
+        request = self._get(headers={'accept-encoding': 'gzip'})
+        self.assertEqual(['gzip'], request.responseHeaders.getRawHeaders('content-encoding'))
+        self.assertEqual(self.resource.assets.get(self.path).variants['gzip'], request.rendered)
+        
+        plain = self._get()
+        self.assertEqual('var x = 1;\n' * 100, plain.rendered)
+        self.assertEqual(None, plain.responseHeaders.getRawHeaders('content-encoding'))
+    
+    def test_cache_control(self):
+        versioned = self._get({'v': [self.version]})
+        self.assertIn('immutable', versioned.responseHeaders.getRawHeaders('cache-control')[0])
+        
+        for request in (self._get(), self._get({'v': ['old']})):
+            self.assertEqual(['no-cache'], request.responseHeaders.getRawHeaders('cache-control'))
+    
+    def test_not_modified(self):
+        etag = self._get(headers={'accept-encoding': 'gzip'}).etag
+        
+        request = self._get(headers={'accept-encoding': 'gzip', 'if-none-match': etag})
+        self.assertEqual(http.NOT_MODIFIED, request.responseCode)
+        self.assertEqual('', request.rendered)
+        
+        # the uncompressed file is a different entity
+        self.assertEqual('var x = 1;\n' * 100, self._get(headers={'if-none-match': etag}).rendered)
+
+class BinarySendCommandTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self._reactor = lib._reactor
+        lib._reactor = Clock()
+        self.factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.protocol.dataReceived(lib.LINK_HELLO + '\r' + encodeFrame(lib.FRAME_HELLO, 0, 'sony_vpl_hw30es'))
+        self.protocol.transport.clear()
+        self.resource = DeviceResource(self.protocol, None)
+    
+    def tearDown(self):
+        lib._reactor = self._reactor
+    
+    def _send(self, command):
+        request = DummyRequest(['sendCommand'])
+        request.method = 'POST'
+        request.args = {'command': [command], 'encoding': ['base64']}
+        request.rendered = self.resource.getChild('sendCommand', request).render(request)
+        return request
+    
+    def test_round_trip(self):
+        request = self._send(base64.b64encode('\x00\x20\r{a}'))
+        
+        frames = FrameDecoder().feed(self.protocol.transport.value())
+        self.assertEqual([(lib.FRAME_REQUEST, 0, 1, '\x00\x20\r{a}')], [x for x in frames if x[0] == lib.FRAME_REQUEST])
+        
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_RESPONSE, 1, '\r\x00\xff'))
+        self.assertEqual(['\r\x00\xff'], [base64.b64decode(x) for x in request.written])
+    
+    def test_trace(self):
+        request = self._send(base64.b64encode('\x00'))
+        traceId = request.responseHeaders.getRawHeaders('x-trace-id')[0]
+        self.protocol.dataReceived(encodeFrame(lib.FRAME_RESPONSE, 1, '\xff'))
+        
+        trace = DummyRequest([traceId])
+        body = json.loads(TraceResource(self.factory.tracer, traceId).render(trace))
+        self.assertEqual(traceId, body['traceId'])
+        self.assertEqual(['received', 'queued', 'sent', 'response', 'done'], [x['span'] for x in body['spans']])
+        self.assertEqual(u'\xff', body['spans'][-1]['result'])
+        
+        unknown = DummyRequest(['nothing'])
+        TraceResource(self.factory.tracer, 'nothing').render(unknown)
+        self.assertEqual(404, unknown.responseCode)
+    
+    def test_invalid(self):
+        request = self._send('not base64!')
+        
+        self.assertEqual('', self.protocol.transport.value())
+        self.assertIn('base64', request.rendered)
+
+class MetricsTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self._reactor = lib._reactor
+        lib._reactor = Clock()
+        self.factory = DeviceServerFactory({}, lambda *args: None, lambda *args: None)
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+        self.protocol.dataReceived('epson_5030ub\r')
+        self.server = CommandServer(self.factory)
+    
+    def tearDown(self):
+        lib._reactor = self._reactor
+    
+    def _get(self, path):
+        request = DummyRequest(path.split('/'))
+        request.path = '/' + path
+        request.rendered = getChildForRequest(self.server, request).render(request)
+        return request
+    
+    def test_render(self):
+        self.factory.sendCommand('epson_5030ub', 'PWR ON')
+        self.factory.sendCommand('epson_5030ub', 'PWR OFF')
+        
+        metrics = self._get('metrics').rendered
+        
+        self.assertIn('# TYPE hamjab_command_queue_seconds histogram\n', metrics)
+        self.assertIn('hamjab_command_queue_seconds_bucket{device="epson_5030ub",le="+Inf"} 1\n', metrics)
+        self.assertIn('hamjab_command_queue_depth{device="epson_5030ub"} 1\n', metrics)
+        self.assertIn('hamjab_command_timeouts_total{device="epson_5030ub"} 0\n', metrics)
+    
+    def test_list_devices(self):
+        self.assertEqual(['epson_5030ub'], json.loads(self._get('listDevices').rendered))
+        
+        request = DummyRequest(['listDevices'])
+        request.args = {'names': ['1']}
+        rendered = getChildForRequest(self.server, request).render(request)
+        self.assertEqual({'epson_5030ub': 'Epson PowerLite Home Cinema 5030UB'}, json.loads(rendered))
+    
+    def test_front_end_index(self):
+        self.assertEqual(404, self._get('epson_5030ub/frontEnd/nothing.js').responseCode)
+    
+    def test_request_latency(self):
+        request = self._get('epson_5030ub/state')
+        request.finish()
+        self._get('nothing/here').finish()
+        self._get('epson_5030ub/random1').finish()
+        self._get('epson_5030ub/random2').finish()
+        
+        self.assertEqual(['/epson_5030ub/other', '/epson_5030ub/state', 'other'], sorted(self.factory.metrics.webLatency))
+        
+        metrics = self._get('metrics').rendered
+        self.assertIn('hamjab_http_request_seconds_count{route="/epson_5030ub/state"} 1\n', metrics)
@@ -1,21 +1,33 @@
+import base64
+import binascii
 import json
 import os.path
 
-from hamjab.lib import printToConsole, NO_DEVICE_FOUND, SUCCESS
+from collections import deque
 
+from hamjab.assets import compress, Asset, AssetIndex, ENCODINGS
+from hamjab.lib import formatCommand, printToConsole, Tracer, CANCELLED, DISCONNECTED, ERROR, NO_DEVICE_FOUND, SUCCESS, TIMEOUT, PRIORITIES, PRIORITY_INTERACTIVE
+
+from twisted.internet import reactor
 from twisted.internet.defer import returnValue, inlineCallbacks
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 from twisted.python.filepath import FilePath
+from twisted.web import http
 from twisted.web.resource import Resource, NoResource, ErrorPage, ForbiddenResource
 from twisted.web.server import NOT_DONE_YET
-from twisted.web.static import File
-from twisted.web.template import Element, renderer, XMLFile, renderElement
+from twisted.web.static import File, getTypeAndEncoding
+from twisted.web.template import Element, renderer, XMLFile, flattenString, renderElement
 from twisted.web.error import UnsupportedMethod
 
+from zope.interface import implementer
+
 
 class DeviceListResource(Resource):
     """
-    A resource which returns the list of active devices as a json list.
+    A resource which returns the list of active devices as a json list, or as a json object of device id to device name
+    (from the device registry) if the names argument is given.
     """
     isLeaf = True
 
@@ -24,9 +36,116 @@ class DeviceListResource(Resource):
 
     def render_GET(self, request):
         request.setHeader("content-type", "application/json")
+        if 'names' in request.args:
+            registry = self.deviceServerFactory.registry
+            return json.dumps(dict((x, registry.getName(x)) for x in self.deviceServerFactory.devices))
         return json.dumps(self.deviceServerFactory.devices.keys())
     
     
+
+class CacheStatsResource(Resource):
+    """
+    A resource which returns the response cache hit/miss counters of a device as json.
+    """
+    isLeaf = True
+
+    def __init__(self, device):
+        Resource.__init__(self)
+        self.device = device
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "application/json")
+        return json.dumps(self.device.responseCache.stats())
+
+class MetricsResource(Resource):
+    """
+    A resource which returns the server's L{Metrics<hamjab.lib.Metrics>} in the Prometheus text exposition format.
+    """
+    isLeaf = True
+
+    def __init__(self, deviceServerFactory):
+        Resource.__init__(self)
+        self.deviceServerFactory = deviceServerFactory
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "text/plain; version=0.0.4")
+        
+        metrics = self.deviceServerFactory.metrics
+        devices = sorted(metrics.devices.items())
+        lines = []
+        
+        self._histograms(lines, 'hamjab_command_queue_seconds', 'Time commands wait in the queue before they are sent.', 'device', [(x, y.queueTime) for x, y in devices])
+        self._histograms(lines, 'hamjab_command_response_seconds', 'Time from sending a command to receiving its response.', 'device', [(x, y.responseTime) for x, y in devices])
+        
+        queueDepths = [(x, len(y._requests)) for x, y in sorted(self.deviceServerFactory.devices.items())]
+        self._values(lines, 'hamjab_command_queue_depth', 'gauge', 'Commands waiting to be sent to a connected device.', queueDepths)
+        self._values(lines, 'hamjab_command_timeouts_total', 'counter', 'Commands which timed out waiting for a response.', [(x, y.timeouts) for x, y in devices])
+        self._values(lines, 'hamjab_no_device_found_total', 'counter', 'Commands for a device which was not connected.', [(x, y.noDeviceFound) for x, y in devices])
+        self._values(lines, 'hamjab_unsolicited_events_total', 'counter', 'Unsolicited lines received from a device.', [(x, y.events) for x, y in devices])
+        
+        self._histograms(lines, 'hamjab_macro_duration_seconds', 'Time taken to run a macro.', 'macro', sorted(metrics.macroDurations.items()))
+        self._histograms(lines, 'hamjab_http_request_seconds', 'Time taken to answer a web request.', 'route', sorted(metrics.webLatency.items()))
+        
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _label(name, value):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '%s="%s"' % (name, value)
+
+    def _values(self, lines, name, kind, description, values, labelName='device'):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labelValue, value in values:
+            lines.append('%s{%s} %s' % (name, self._label(labelName, labelValue), value))
+
+    def _histograms(self, lines, name, description, labelName, histograms):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s histogram' % (name, ))
+        for labelValue, histogram in histograms:
+            label = self._label(labelName, labelValue)
+            for bound, count in histogram.cumulativeCounts():
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, bound, count))
+            lines.append('%s_sum{%s} %r' % (name, label, histogram.sum))
+            lines.append('%s_count{%s} %d' % (name, label, histogram.count))
+
+class TraceResource(Resource):
+    """
+    A resource which returns the spans of a trace as json, or every trace which is still kept if no trace ID is given.
+    """
+    isLeaf = True
+
+    def __init__(self, tracer, traceId):
+        Resource.__init__(self)
+        self.tracer = tracer
+        self.traceId = traceId
+
+    def render_GET(self, request):
+        if not self.traceId:
+            result = self.tracer.export()
+        else:
+            spans = self.tracer.get(self.traceId)
+            if spans is None:
+                return NoResource("Unknown trace").render(request)
+            result = {'traceId': self.traceId, 'spans': spans}
+        
+        request.setHeader("content-type", "application/json")
+        return json.dumps(result, encoding='latin-1')
+
+class DeviceStateResource(Resource):
+    """
+    A resource which returns the last known state of a device (as tracked by its driver's state reducer) as json.
+    """
+    isLeaf = True
+
+    def __init__(self, device):
+        Resource.__init__(self)
+        self.device = device
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "application/json")
+        return json.dumps(self.device.state)
+
 class ArgUtils(object):
     """
     A helper class with a few methods to simplify and standardize dealing with request arguments.
@@ -40,6 +159,19 @@ class ArgUtils(object):
     @staticmethod
     def _get_args(request, args):
         return [request.args[x][0] for x in args]
+    
+    @staticmethod
+    def _get_priority(request):
+        """
+        Returns (priority, None) for the optional priority argument or (None, an error page) if it isn't a valid one.
+        """
+        if 'priority' not in request.args:
+            return PRIORITY_INTERACTIVE, None
+        
+        (priorityName,) = ArgUtils._get_args(request, ('priority',))
+        if priorityName not in PRIORITIES:
+            return None, ErrorPage(500, "Invalid parameter", "priority must be one of " + ', '.join(sorted(PRIORITIES)))
+        return PRIORITIES[priorityName], None
 
 
 class DeferredLeafResource(Resource):
@@ -74,46 +206,92 @@ class DeferredLeafResource(Resource):
     def _delayedRender(self, request):
         raise Exception("Shouldn't call this")
 
+    @staticmethod
+    def _traceId(request):
+        """
+        Returns the trace ID from the request's X-Trace-Id header (or a new one if it doesn't have a sensible one) and
+        sends it back in the same header.
+        """
+        traceId = request.getHeader('x-trace-id')
+        if not traceId or len(traceId) > 64 or not traceId.replace('-', '').isalnum():
+            traceId = Tracer.newTraceId()
+        
+        request.setHeader('x-trace-id', traceId)
+        return traceId
+
 class SendCommandResource(DeferredLeafResource):
     """
     A resource which receives a request to sendCommand and uses the query parameters given to send a command
     to the specified device. It will wait until the command result comes back before sending the response.
+    
+    With binary set the command has already been decoded from base64 and the response is base64 encoded too, except
+    for a status like TIMEOUT which is sent as-is with a 500.
+    
+    The command is traced (see L{Tracer}) under the ID in the X-Trace-Id header of the response.
     """
     log = Logger(observer=printToConsole)
 
-    def __init__(self, device, command):
+    statuses = frozenset([NO_DEVICE_FOUND, TIMEOUT, ERROR, CANCELLED, DISCONNECTED])
+
+    def __init__(self, device, command, priority=PRIORITY_INTERACTIVE, binary=False):
         DeferredLeafResource.__init__(self, ('POST', ))
         self.device = device
         self.command = command
+        self.priority = priority
+        self.binary = binary
 
     @inlineCallbacks
     def _delayedRender(self, request):
-        result = yield self.device.sendCommand(self.command)
+        tracer = self.device.tracer
+        traceId = self._traceId(request)
+        tracer.span(traceId, 'web', 'received', device=self.device.deviceId, command=self.command)
+        
+        result = yield self.device.sendCommand(self.command, self.priority, request.getClientIP(), None, traceId)
 
         if not self.do_render:
             self.log.debug("Command finished with result {result} but nobody is waiting for the result", result=result)
+            tracer.span(traceId, 'web', 'abandoned', result=result)
             returnValue(None)
             
-        if result == NO_DEVICE_FOUND:
+        if result in (NO_DEVICE_FOUND, DISCONNECTED) or (self.binary and result in self.statuses):
             request.setResponseCode(500)
-            request.write(NO_DEVICE_FOUND)
+            request.write(result)
+        elif self.binary:
+            request.write(base64.b64encode(str(result)))
         else:
             request.write(str(result))
         request.finish()
+        
+        tracer.span(traceId, 'web', 'done', result=result)
 
 class GetUnsolicitedResource(DeferredLeafResource):
     """
-    A resource which handles requests for unsolicited messages for a particular device.
+    A resource which handles requests for unsolicited messages for a particular device. Without a sequence number it
+    waits for the next message and returns it as text. With one it returns json with every buffered message after that
+    sequence number (waiting only if there are none) and the last sequence number to pass as since on the next request.
     """
     
     log = Logger(observer=printToConsole)
 
-    def __init__(self, device):
+    def __init__(self, device, since=None):
         DeferredLeafResource.__init__(self, ('GET',))
         self.device = device
+        self.since = since
 
     @inlineCallbacks
     def _delayedRender(self, request):
+        if self.since is not None:
+            events = yield self.device.getUnsolicitedEvents(self.since)
+            
+            if not self.do_render:
+                returnValue(None)
+            
+            last = events[-1][0] if events else self.device.eventSequence
+            request.setHeader("content-type", "application/json")
+            request.write(json.dumps({'last': last, 'events': [{'seq': x, 'data': y} for x, y in events]}))
+            request.finish()
+            returnValue(None)
+        
         result = yield self.device.getUnsolicitedData()
 
         if not self.do_render:
@@ -127,23 +305,170 @@ class GetUnsolicitedResource(DeferredLeafResource):
             request.write(str(result))
         request.finish()
 
+@implementer(IPushProducer)
+class EventStreamSubscriber(object):
+    """
+    A single client of an L{EventStream}. It is registered as a streaming producer on its request so the transport tells
+    it when the client stops keeping up, after which events wait in a buffer of at most L{maxBuffered} entries. If that
+    fills up the oldest events are dropped and the client gets an overflow event with the count once it catches up.
+    """
+
+    def __init__(self, request, deviceId=None, maxBuffered=100):
+        self.request = request
+        self.deviceId = deviceId
+        self.paused = False
+        self.dropped = 0
+        self._buffer = deque(maxlen=maxBuffered)
+
+    def send(self, payload):
+        if not self.paused:
+            self.request.write(payload)
+        else:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(payload)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        
+        if self.dropped:
+            self.request.write(EventStream.formatEvent(self.dropped, 'overflow'))
+            self.dropped = 0
+        
+        while self._buffer and not self.paused:
+            self.request.write(self._buffer.popleft())
+
+    def stopProducing(self):
+        self.paused = True
+        self._buffer.clear()
+
+class EventStream(object):
+    """
+    Broadcasts unsolicited device data to every connected L{EventStreamSubscriber} as Server-Sent Events. It registers a
+    single listener with the device server and formats each event once no matter how many clients are listening. A
+    comment is sent every L{keepAliveInterval} seconds so idle connections aren't closed by proxies or browsers.
+    """
+
+    keepAliveInterval = 15
+    keepAlive = ':\n\n'
+
+    def __init__(self, deviceServerFactory, clock=reactor):
+        self.deviceServerFactory = deviceServerFactory
+        self._subscribers = {}
+        self._count = 0
+        self._keepAliveCall = LoopingCall(self._sendToAll, self.keepAlive)
+        self._keepAliveCall.clock = clock
+        
+        deviceServerFactory.addEventListener(self.publish)
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def formatEvent(data, event=None):
+        lines = []
+        if event:
+            lines.append('event: ' + event)
+        lines.append('data: ' + json.dumps(data))
+        return '\n'.join(lines) + '\n\n'
+
+    def subscribe(self, subscriber):
+        self._subscribers.setdefault(subscriber.deviceId, set()).add(subscriber)
+        self._count += 1
+        
+        if not self._keepAliveCall.running:
+            self._keepAliveCall.start(self.keepAliveInterval, now=False)
+
+    def unsubscribe(self, subscriber):
+        subscribers = self._subscribers.get(subscriber.deviceId)
+        if subscribers and subscriber in subscribers:
+            subscribers.remove(subscriber)
+            self._count -= 1
+            if not subscribers:
+                del self._subscribers[subscriber.deviceId]
+        
+        if not self._count and self._keepAliveCall.running:
+            self._keepAliveCall.stop()
+
+    def publish(self, deviceId, line):
+        payload = self.formatEvent({'device': deviceId, 'data': line})
+        
+        for key in (deviceId, None):
+            for subscriber in list(self._subscribers.get(key, ())):
+                subscriber.send(payload)
+
+    def _sendToAll(self, payload):
+        for subscribers in self._subscribers.values():
+            for subscriber in list(subscribers):
+                subscriber.send(payload)
+
+class EventStreamResource(Resource):
+    """
+    A resource which holds the connection open and streams unsolicited data from one device (or all of them) to the
+    client as Server-Sent Events. Each event's data is a json object with the device id and the unsolicited line.
+    """
+
+    isLeaf = True
+
+    def __init__(self, eventStream, deviceId=None):
+        Resource.__init__(self)
+        self.eventStream = eventStream
+        self.deviceId = deviceId
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "text/event-stream")
+        request.setHeader("cache-control", "no-cache")
+        
+        subscriber = EventStreamSubscriber(request, self.deviceId)
+        request.registerProducer(subscriber, True)
+        self.eventStream.subscribe(subscriber)
+        
+        finished = request.notifyFinish()
+        finished.addBoth(lambda ignored: self.eventStream.unsubscribe(subscriber))
+        
+        # send something right away so the client knows the stream is open
+        request.write(EventStream.keepAlive)
+        
+        return NOT_DONE_YET
+
+class OfflineDevice(object):
+    """
+    Stands in for a device which is offline but has an outbox so its sendCommand requests are held until it's back.
+    """
+
+    def __init__(self, deviceServerFactory, deviceId):
+        self.deviceServerFactory = deviceServerFactory
+        self.deviceId = deviceId
+        self.tracer = deviceServerFactory.tracer
+
+    def sendCommand(self, command, priority=PRIORITY_INTERACTIVE, source=None, timeout=None, traceId=None):
+        return self.deviceServerFactory.sendCommand(self.deviceId, command, priority, source, timeout, traceId)
+
 class DeviceResource(Resource):
     """
-    The resource which serves up all resource related to a device (currently sendCommand, frontEnd, and getUnsolicited). 
+    The resource which serves up all resource related to a device (currently sendCommand, command, frontEnd, getUnsolicited, events, state and cacheStats). 
     """
     
     isLeaf = False
+    routes = frozenset(['sendCommand', 'command', 'frontEnd', 'help', 'getUnsolicited', 'events', 'state', 'cacheStats'])
     
     log = Logger(observer=printToConsole)
 
-    def __init__(self, device):
+    def __init__(self, device, eventStream, registry=None):
         Resource.__init__(self)
         self.device = device
+        self.eventStream = eventStream
+        self.registry = registry
+        self.frontEnd = StaticFile('hamjab/resources/devices/{device}'.format(device=device.deviceId))
+        self.help = StaticFile('hamjab/resources/help/')
 
     def getChild(self, name, request):
         if name == 'sendCommand':
             if request.method == 'GET':
-                return File('hamjab/resources/help/sendCommand.html')
+                return StaticFile('hamjab/resources/help/sendCommand.html')
 
             args = ('command',)
             for arg in args:
@@ -153,33 +478,153 @@ class DeviceResource(Resource):
                 
             (command,) = ArgUtils._get_args(request, args)
             
-            try:
-                other_args = dict([(x, request.args[x][0]) for x in request.args if x not in args])
-                command = command.format(**other_args)
-
-            except KeyError:
-                return ErrorPage(200, "Command Error", "Missing arguments for command")
+            priority, error = ArgUtils._get_priority(request)
+            if error:
+                return error
+            
+            binary = False
+            if 'encoding' in request.args:
+                (encoding,) = ArgUtils._get_args(request, ('encoding',))
+                if encoding != 'base64':
+                    return ErrorPage(500, "Invalid parameter", "encoding must be base64")
+                binary = True
+            
+            if binary:
+                # an opaque payload, it's passed through to the device untouched
+                try:
+                    command = base64.b64decode(command)
+                except (TypeError, binascii.Error):
+                    return ErrorPage(500, "Invalid parameter", "command isn't valid base64")
+            else:
+                try:
+                    other_args = dict([(x, request.args[x][0]) for x in request.args if x not in args + ('priority', 'encoding')])
+                    command = command.format(**other_args)
+    
+                except KeyError:
+                    return ErrorPage(200, "Command Error", "Missing arguments for command")
                        
-            return SendCommandResource(self.device, command)
+            return SendCommandResource(self.device, command, priority, binary)
+        
+        elif name == 'command':
+            # a command from the device's device.json by id, its args are checked before anything is queued
+            if request.method != 'POST':
+                request.setHeader("allow", "POST")
+                return ErrorPage(405, "Method Not Allowed", "Commands have to be sent with a POST")
+            
+            commandId = ''.join(request.postpath[:1])
+            commands = self.registry.getCommands(self.device.deviceId) if self.registry is not None else None
+            if not commands or commandId not in commands:
+                return NoResource("The device has no command " + repr(commandId))
+            
+            priority, error = ArgUtils._get_priority(request)
+            if error:
+                return error
+            
+            args = dict((x, request.args[x][0]) for x in request.args if x != 'priority')
+            try:
+                command = formatCommand(commands[commandId], args)
+            except ValueError as e:
+                return ErrorPage(500, "Invalid parameter", "{commandId} {error}".format(commandId=commandId, error=e))
+            
+            return SendCommandResource(self.device, command, priority)
         
         elif name == 'frontEnd':
-            return File('hamjab/resources/devices/{device}'.format(device=self.device.deviceId))
+            # anything which isn't in the registry's index of the device's files is a 404 without touching the disk
+            asset = ''.join(request.postpath[:1])
+            if asset and self.registry is not None and asset not in self.registry.getAssets(self.device.deviceId):
+                return NoResource()
+            return self.frontEnd
 
         elif name == 'help':
-            return File('hamjab/resources/help/')
+            return self.help
 
         elif name == 'getUnsolicited':
-            return GetUnsolicitedResource(self.device)
+            since = None
+            if 'since' in request.args:
+                try:
+                    since = int(request.args['since'][0])
+                except ValueError:
+                    return ErrorPage(500, "Invalid parameter", "since must be a sequence number")
+            
+            return GetUnsolicitedResource(self.device, since)
+        
+        elif name == 'events':
+            return EventStreamResource(self.eventStream, self.device.deviceId)
+        
+        elif name == 'state':
+            return DeviceStateResource(self.device)
+        
+        elif name == 'cacheStats':
+            return CacheStatsResource(self.device)
         
         else:
             self.log.warn("Unknown page requested: {name!r} as part of {path}", name=repr(name), path=request.path)
 
         return NoResource()
 
+class BatchResource(DeferredLeafResource):
+    """
+    A resource which sends a list of commands (to any number of devices) and returns all of their results as a json
+    list in the same order. Commands for different devices are sent in parallel, commands for the same device in order.
+    """
+    
+    log = Logger(observer=printToConsole)
+
+    def __init__(self, deviceServerFactory, commands):
+        DeferredLeafResource.__init__(self, ('POST',))
+        self.deviceServerFactory = deviceServerFactory
+        self.commands = commands
+
+    @staticmethod
+    def parseCommands(body):
+        """
+        Turns a json list of {device, command, args} objects into a list of (deviceId, command) pairs with the args
+        filled in to the command. Raises ValueError if anything about it isn't valid.
+        """
+        try:
+            entries = json.loads(body)
+        except ValueError:
+            raise ValueError("The body must be a json list")
+        
+        if type(entries) is not list:
+            raise ValueError("The body must be a json list")
+        
+        commands = []
+        for index, entry in enumerate(entries):
+            if type(entry) is not dict or not isinstance(entry.get('device'), basestring) or not isinstance(entry.get('command'), basestring):
+                raise ValueError("Entry {index} must be an object with a device and a command".format(index=index))
+            
+            command = entry['command']
+            args = entry.get('args', {})
+            if type(args) is not dict:
+                raise ValueError("The args of entry {index} must be an object".format(index=index))
+            
+            try:
+                command = command.format(**args)
+            except (KeyError, IndexError, AttributeError, ValueError):
+                raise ValueError("Missing arguments or an invalid command format for entry {index}".format(index=index))
+            
+            commands.append((entry['device'], command))
+        
+        return commands
+
+    @inlineCallbacks
+    def _delayedRender(self, request):
+        results = yield self.deviceServerFactory.sendCommands(self.commands, PRIORITY_INTERACTIVE, request.getClientIP())
+        
+        if not self.do_render:
+            self.log.debug("Batch finished but nobody is waiting for the result")
+            returnValue(None)
+        
+        request.setHeader("content-type", "application/json")
+        request.write(json.dumps(results))
+        request.finish()
+
 class MacroResource(DeferredLeafResource):
     """
     A resource which will fire off the specified macro, wait for it to complete, and return the status. If all commands in the
-    macro are able to run successfully the result will be SUCCESS, otherwise a failure result will be provided.
+    macro are able to run successfully the result will be SUCCESS, otherwise a failure result will be provided. The macro is
+    cancelled if the client goes away before it's done. Its trace ID is sent in the X-Trace-Id header.
     """
     
     arg = "macroName"
@@ -190,11 +635,24 @@ class MacroResource(DeferredLeafResource):
         DeferredLeafResource.__init__(self, ('POST',))
         self.deviceServerFactory = deviceServerFactory
         self.macroName = macroName
+        self.macroDeferred = None
+
+    def dont_render(self, ignored):
+        DeferredLeafResource.dont_render(self, ignored)
+        
+        # nobody is waiting for the macro any more, stop it
+        if self.macroDeferred is not None:
+            self.macroDeferred.cancel()
 
     @inlineCallbacks
     def _delayedRender(self, request):
         
-        result = yield self.deviceServerFactory.runMacro(self.macroName)
+        self.macroDeferred = self.deviceServerFactory.runMacro(self.macroName, self._traceId(request))
+        result = yield self.macroDeferred
+        
+        if not self.do_render:
+            self.log.debug("Macro {macroName} finished with result {result} but nobody is waiting for the result", macroName=self.macroName, result=result)
+            returnValue(None)
         
         if result != SUCCESS:
             self.log.warn("Command failed in macro {macroName}, halting execution", macroName=self.macroName)
@@ -219,21 +677,15 @@ class MainPageRenderer(Element):
     @renderer
     def macroList(self, request, tag):
         if not CommandServer.isDisabled:
-            for macro in sorted(self.deviceServerFactory.macros, key=lambda x: self.deviceServerFactory.macros[x]['name']):
-                yield tag.clone().fillSlots(macroName = self.deviceServerFactory.macros[macro]['name'], macroId=macro)
+            for macro in sorted(self.deviceServerFactory.macros.values(), key=lambda x: x.name):
+                yield tag.clone().fillSlots(macroName = macro.name, macroId=macro.macroId)
     
     @renderer
     def deviceList(self, request, tag):
         if not CommandServer.isDisabled:
+            registry = self.deviceServerFactory.registry
             for device in sorted(self.deviceServerFactory.devices):
-                try:
-                    device_path = FilePath('hamjab/resources/devices/{device}/device.json'.format(device=device))
-                    with device_path.open() as device_file:
-                        device_data = json.load(device_file)
-                        deviceName = device_data['name'] 
-                except Exception:
-                    deviceName = device
-                yield tag.clone().fillSlots(deviceId = device, deviceName = deviceName)
+                yield tag.clone().fillSlots(deviceId = device, deviceName = registry.getName(device))
                 
     @renderer
     def status(self, request, tag):
@@ -259,55 +711,196 @@ class TemplateResource(Resource):
         request.setHeader("content-type", "text/html")
         return renderElement(request, self.renderer)
 
-class TemplateFile(File):
+def serveAsset(request, asset, contentType, maxAge=None):
+    """
+    Writes the headers for an L{Asset<hamjab.assets.Asset>} and returns the body to send: the variant for the
+    client's Accept-Encoding, or nothing if the client's If-None-Match already has it. Without a maxAge the client has
+    to revalidate every time.
+    """
+    data, encoding = asset.negotiate(request.getHeader('accept-encoding'))
+    
+    request.setHeader("content-type", contentType)
+    request.setHeader("vary", "accept-encoding")
+    if maxAge:
+        request.setHeader("cache-control", "public, max-age={maxAge}, immutable".format(maxAge=maxAge))
+    else:
+        request.setHeader("cache-control", "no-cache")
+    if encoding is not None:
+        request.setHeader("content-encoding", encoding)
+    
+    if request.setETag(asset.etag(encoding)) == http.CACHED:
+        return ''
+    
+    request.setHeader("content-length", str(len(data)))
+    return '' if request.method == 'HEAD' else data
+
+class StaticFile(File):
+    """
+    A L{File} which serves files from memory through the L{AssetIndex<hamjab.assets.AssetIndex>} in L{assets}:
+    compressed if the client accepts it, with an ETag and, when the URL has the file's current version in it (the ?v=
+    added to the URLs in pages), with a far-future Cache-Control. Pages are always revalidated. Directories and missing
+    files are handled like they are by a plain L{File}.
+    """
+    
+    assets = AssetIndex('hamjab/resources')
+    maxAge = 365 * 24 * 60 * 60
+    
+    def render_GET(self, request):
+        self.restat(False)
+        asset = self.assets.get(self.path) if self.isfile() else None
+        if asset is None:
+            return File.render_GET(self, request)
+        
+        contentType, ignored = getTypeAndEncoding(self.basename(), self.contentTypes, self.contentEncodings, self.defaultType)
+        versioned = contentType != 'text/html' and request.args.get('v') == [asset.version]
+        return serveAsset(request, asset, contentType, self.maxAge if versioned else None)
+    
+    render_HEAD = render_GET
+
+class CachedTemplateResource(TemplateResource):
+    """
+    A L{TemplateResource} which keeps the rendered page until the value returned by cacheKey changes. The page's local
+    URLs are versioned from the directory it's served from (see L{StaticFile}), it's compressed and it's served with an
+    ETag so a browser which already has this version gets a 304 instead of the page.
+    """
+    
+    def __init__(self, renderer, cacheKey, directory):
+        TemplateResource.__init__(self, renderer)
+        self.cacheKey = cacheKey
+        self.directory = directory
+        self._key = None
+        self._page = None
+    
+    def render_GET(self, request):
+        key = self.cacheKey()
+        if self._page is None or key != self._key:
+            rendered = []
+            flattenString(None, self.renderer).addCallbacks(rendered.append, lambda failure: None)
+            if not rendered:
+                # the template is waiting on something (or failed), render it the normal way and don't cache it
+                return TemplateResource.render_GET(self, request)
+            
+            page = StaticFile.assets.versionUrls('<!DOCTYPE html>\n' + rendered[0], os.path.abspath(self.directory))
+            variants = dict((encoding, compress(page, encoding)) for encoding, suffix in ENCODINGS)
+            self._key = key
+            self._page = Asset(None, None, len(page), page, dict((x, y) for x, y in variants.items() if y is not None))
+        
+        return serveAsset(request, self._page, "text/html")
+
+class TemplateFile(StaticFile):
     """
     A class which can optionally template any .html file if an appropriate renderer is provided. Any file which doesn't
     have a template renderer associated with it will just be served up like normal.
+    
+    The renderer can also be a resource (like a L{CachedTemplateResource}) which is then served as it is, without
+    looking for the file first.
     """
     
     def __init__(self, *args, **kwargs):
-        File.__init__(self, *args, **kwargs)
+        StaticFile.__init__(self, *args, **kwargs)
         self.processors = {'.html': self._processTemplate}
         self.renderers = {}
  
     def addRenderer(self, name, renderer):
         self.renderers[name] = renderer
+    
+    def getChild(self, path, request):
+        name, extension = os.path.splitext(path or self.indexNames[0])
+        if extension in ('', '.html') and isinstance(self.renderers.get(name), Resource):
+            return self.renderers[name]
+        return File.getChild(self, path, request)
  
     def _processTemplate(self, path, registry):
         file_name = os.path.splitext(os.path.basename(path))[0]
         if file_name in self.renderers:
-            return TemplateResource(self.renderers[file_name])
+            renderer = self.renderers[file_name]
+            return renderer if isinstance(renderer, Resource) else TemplateResource(renderer)
         else:
-            return File(path)
+            return StaticFile(path)
 
 class CommandServer(Resource):
     """
-    The root resource. Serves the root resources (devices, macro, and home).
+    The root resource. Serves the root resources (devices, macro, batch, events, metrics, trace and home).
+    
+    The time taken to answer every request is recorded in the factory's metrics by route: one of L{routes}, the device
+    and one of L{DeviceResource.routes} (or "other") for device requests or "other" for anything else, so a scan of
+    random paths can't grow the metrics.
+    
+    The children are built once and reused, device resources are kept by device ID (and rebuilt when a device
+    reconnects) and the rendered home page is kept until the devices, macros, device names or site status change.
     """
     
     isLeaf = False
     isDisabled = False
+    routes = frozenset(['home', 'toggleStatus', 'listDevices', 'events', 'batch', 'macro', 'metrics', 'trace'])
     
     def __init__(self, deviceServerFactory):
         Resource.__init__(self)
         self.deviceServerFactory = deviceServerFactory
+        self.eventStream = EventStream(deviceServerFactory)
+        
+        self.home = TemplateFile('hamjab/resources/home/')
+        self.home.addRenderer('index', CachedTemplateResource(MainPageRenderer(deviceServerFactory), self._homePageKey, 'hamjab/resources/home'))
+        self.metrics = MetricsResource(deviceServerFactory)
+        self.deviceList = DeviceListResource(deviceServerFactory)
+        self.events = EventStreamResource(self.eventStream)
+        self._deviceResources = {}
+    
+    def _homePageKey(self):
+        factory = self.deviceServerFactory
+        return (CommandServer.isDisabled, frozenset(factory.devices), factory.macros, factory.registry.version)
     
     def getChild(self, name, request):
+        child = self._getChild(name, request)
+        
+        if isinstance(child, DeviceResource):
+            resource = ''.join(request.postpath[:1])
+            route = '/%s/%s' % (name, resource if resource in DeviceResource.routes else 'other')
+        elif name in self.routes:
+            route = '/' + name
+        else:
+            route = 'other'
+        
+        started = reactor.seconds()
+        request.notifyFinish().addBoth(lambda ignored: self.deviceServerFactory.metrics.observeRequest(route, reactor.seconds() - started))
+        
+        return child
+    
+    def _getChild(self, name, request):
         
         if name == "home":
-            templateParser = TemplateFile('hamjab/resources/home/')
-            templateParser.addRenderer('index', MainPageRenderer(self.deviceServerFactory))
-            return templateParser
+            return self.home
 
         elif name == "toggleStatus":
             CommandServer.isDisabled = not CommandServer.isDisabled
             return ErrorPage(200, "Status", "Toggled the site status")
 
+        elif name == "metrics":
+            return self.metrics
+
         elif CommandServer.isDisabled:
             return ForbiddenResource("The site is disabled")
 
         elif name == "listDevices":
-            return DeviceListResource(self.deviceServerFactory)
+            return self.deviceList
+        
+        elif name == "events":
+            return self.events
+        
+        elif name == "trace":
+            return TraceResource(self.deviceServerFactory.tracer, ''.join(request.postpath[:1]))
+        
+        elif name == "batch":
+            if request.method != 'POST':
+                request.setHeader("allow", "POST")
+                return ErrorPage(405, "Method Not Allowed", "A batch has to be sent with a POST")
+            
+            try:
+                commands = BatchResource.parseCommands(request.content.read())
+            except ValueError as e:
+                return ErrorPage(500, "Invalid batch", str(e))
+            
+            return BatchResource(self.deviceServerFactory, commands)
         
         elif name == "macro":
             result = ArgUtils._check_arg("macroName", request.args)
@@ -325,7 +918,13 @@ class CommandServer(Resource):
             
             device = self.deviceServerFactory.getDevice(name)
             
-            return DeviceResource(device)
+            resource = self._deviceResources.get(name)
+            if resource is None or resource.device is not device:
+                resource = self._deviceResources[name] = DeviceResource(device, self.eventStream, self.deviceServerFactory.registry)
+            return resource
+        
+        elif self.deviceServerFactory.hasOutbox(name) and request.postpath[:1] in (['sendCommand'], ['command']):
+            return DeviceResource(OfflineDevice(self.deviceServerFactory, name), self.eventStream, self.deviceServerFactory.registry)
         
         
         return NoResource()
@@ -1,29 +1,37 @@
 import argparse
-import json
 import os
 
-from hamjab.lib import DeviceServerFactory, DEFAULT_DEVICE_SERVER_PORT
-from hamjab.web import CommandServer
+from hamjab.lib import DeviceRegistry, DeviceServerFactory, DeviceServerProtocol, DEFAULT_DEVICE_SERVER_PORT
+from hamjab.macros import loadMacroFile, MacroError, MacroFileWatcher
+from hamjab.web import CommandServer, StaticFile
 
 from control_logic import eventCallback, commandCallback
 
 from twisted.web import server
 from twisted.internet import reactor, endpoints
 
+# the device.json files and front ends of every device, shared by the macros, the device server and the web server
+registry = DeviceRegistry()
+
 def parse_macro_file(parser, macro_file_name):
     root = os.path.dirname(os.path.realpath(__file__))
     macro_file_path = os.path.join(root, macro_file_name)
     if not os.path.isfile(macro_file_path):
         parser.error("Invalid macro file provided: " + macro_file_name)
     
-    with open(macro_file_path) as macro_file:
-        macros = json.load(macro_file)
+    try:
+        macros, warnings = loadMacroFile(macro_file_path, registry.getConfig)
+    except MacroError as e:
+        parser.error("Invalid macros in {name}:\n  {errors}".format(name=macro_file_name, errors="\n  ".join(e.errors)))
+    
+    for warning in warnings:
+        print "Warning:", warning
     
-        print "Loaded the following macros from", macro_file_name
-        for macro in macros:
-            print macro
+    print "Loaded the following macros from", macro_file_name
+    for macro in macros:
+        print macro
 
-        return macros
+    return macro_file_path, macros
 
 parser = argparse.ArgumentParser(description='Run a device and control server')
 parser.add_argument('macros',
@@ -31,7 +39,7 @@ parser.add_argument('macros',
                     type=lambda x: parse_macro_file(parser, x),
                     metavar='macroFile',
                     nargs='?',
-                    default={})
+                    default=(None, {}))
 parser.add_argument('--controlServerPort',
                     help='The port of the control (web) server',
                     default=8080,
@@ -40,6 +48,30 @@ parser.add_argument('--deviceServerPort',
                     help='The port of the device server',
                     default=DEFAULT_DEVICE_SERVER_PORT,
                     type=int)
+parser.add_argument('--macroReloadInterval',
+                    help='How often (in seconds) to check the macro file for changes when inotify is not available',
+                    default=MacroFileWatcher.interval,
+                    type=float)
+parser.add_argument('--deviceReloadInterval',
+                    help='How often (in seconds) to check the device resources for changes when inotify is not available',
+                    default=DeviceRegistry.interval,
+                    type=float)
+parser.add_argument('--heartbeatInterval',
+                    help='How often (in seconds) to send heartbeats to the device clients',
+                    default=DeviceServerProtocol.heartbeatInterval,
+                    type=float)
+parser.add_argument('--heartbeatMisses',
+                    help='How many heartbeat intervals a device client can be silent for before it is disconnected',
+                    default=DeviceServerProtocol.heartbeatMisses,
+                    type=int)
+parser.add_argument('--outboxSize',
+                    help='How many commands to hold for a device client which has disconnected until it reconnects (0 to fail them right away)',
+                    default=DeviceServerFactory.outboxSize,
+                    type=int)
+parser.add_argument('--outboxTimeout',
+                    help='How long (in seconds) a held command waits for its device client to reconnect',
+                    default=DeviceServerFactory.outboxTimeout,
+                    type=float)
 parser.add_argument('--interface',
                     help='The interface that the ports should be bound to',
                     default='')
@@ -47,11 +79,28 @@ parser.add_argument('--interface',
 args = parser.parse_args()
 
 # start up the device server
-factory = DeviceServerFactory(args.macros, eventCallback, commandCallback)
+DeviceServerProtocol.heartbeatInterval = args.heartbeatInterval
+DeviceServerProtocol.heartbeatMisses = args.heartbeatMisses
+DeviceServerFactory.outboxSize = args.outboxSize
+DeviceServerFactory.outboxTimeout = args.outboxTimeout
+
+macro_file_path, macros = args.macros
+factory = DeviceServerFactory(macros, eventCallback, commandCallback, registry)
 endpoints.TCP4ServerEndpoint(reactor, args.deviceServerPort, interface=args.interface).listen(factory)
 
-# start up the control server
+# start up the control server, its static files are loaded (and compressed) up front so the first page loads are fast
+print "Loaded", StaticFile.assets.load(), "static files"
 endpoints.TCP4ServerEndpoint(reactor, args.controlServerPort, interface=args.interface).listen(server.Site(CommandServer(factory)))
 
+# reload the macros whenever the file changes
+if macro_file_path:
+    watcher = MacroFileWatcher(macro_file_path, factory, registry.getConfig)
+    watcher.interval = args.macroReloadInterval
+    watcher.start()
+
+# reload the device metadata whenever a device's resources change
+registry.interval = args.deviceReloadInterval
+registry.start()
+
 # start the run loop
 reactor.run()
\ No newline at end of file